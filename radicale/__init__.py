@@ -26,6 +26,7 @@ Can be used with an external WSGI server or the built-in server.
 import base64
 import contextlib
 import datetime
+import inspect
 import io
 import itertools
 import logging
@@ -45,7 +46,8 @@ from xml.etree import ElementTree as ET
 
 import vobject
 
-from radicale import auth, config, log, rights, storage, web, xmlutils
+from radicale import (auth, config, httputils, log, rights, storage, web,
+                      xmlutils)
 from radicale.log import logger
 
 VERSION = pkg_resources.get_distribution("radicale").version
@@ -88,6 +90,9 @@ DIRECTORY_LISTING = (
 INTERNAL_SERVER_ERROR = (
     client.INTERNAL_SERVER_ERROR, (("Content-Type", "text/plain"),),
     "A server error occurred.  Please contact the administrator.")
+SERVICE_UNAVAILABLE = (
+    client.SERVICE_UNAVAILABLE, (("Content-Type", "text/plain"),),
+    "The server is busy.  Please try again later.")
 
 DAV_HEADERS = "1, 2, 3, calendar-access, addressbook, extended-mkcol"
 
@@ -95,6 +100,9 @@ DAV_HEADERS = "1, 2, 3, calendar-access, addressbook, extended-mkcol"
 class Application:
     """WSGI application managing collections."""
 
+    # Size of the chunks of answers that are read from files
+    _file_chunk_size = 65536
+
     def __init__(self, configuration):
         """Initialize application."""
         super().__init__()
@@ -104,6 +112,16 @@ class Application:
         self.Rights = rights.load(configuration)
         self.Web = web.load(configuration)
         self.encoding = configuration.get("encoding", "request")
+        self._lock_timeouts = config.parse_lock_timeout(
+            configuration.get("storage", "lock_timeout"))
+        # Storage backends that override ``acquire_lock`` with the older
+        # signature ``(mode, user=None)`` lock the whole storage
+        parameters = inspect.signature(
+            self.Collection.acquire_lock).parameters.values()
+        self._lock_arguments = {
+            name for name in ("paths", "timeout") if any(
+                p.name == name or p.kind == p.VAR_KEYWORD
+                for p in parameters)}
 
     def headers_log(self, environ):
         """Sanitize headers for logging."""
@@ -144,20 +162,46 @@ class Application:
                 pass
         raise UnicodeDecodeError
 
-    def collect_allowed_items(self, items, user):
-        """Get items from request that user is allowed to access."""
+    def _authorized(self, user, path, permissions, rights_cache=None):
+        """Check rights with ``Rights.authorized``.
+
+        Decisions are memoized in the dict ``rights_cache`` (if not ``None``)
+        when the rights backend allows it.
+
+        """
+        if rights_cache is None or not self.Rights.cache_decisions:
+            return self.Rights.authorized(user, path, permissions)
+        key = (user, path, permissions)
+        granted = rights_cache.get(key)
+        if granted is None:
+            granted = rights_cache[key] = self.Rights.authorized(
+                user, path, permissions)
+        return granted
+
+    def collect_allowed_items(self, items, user, rights_cache=None):
+        """Get items from request that user is allowed to access.
+
+        ``rights_cache`` is a dict for memoizing rights decisions during the
+        request.
+
+        """
+        if rights_cache is None:
+            rights_cache = {}
         for item in items:
             if isinstance(item, storage.BaseCollection):
                 path = storage.sanitize_path("/%s/" % item.path)
                 if item.get_meta("tag"):
-                    permissions = self.Rights.authorized(user, path, "rw")
+                    permissions = self._authorized(
+                        user, path, "rw", rights_cache)
                     target = "collection with tag %r" % item.path
                 else:
-                    permissions = self.Rights.authorized(user, path, "RW")
+                    permissions = self._authorized(
+                        user, path, "RW", rights_cache)
                     target = "collection %r" % item.path
             else:
                 path = storage.sanitize_path("/%s/" % item.collection.path)
-                permissions = self.Rights.authorized(user, path, "rw")
+                permissions = self._authorized(
+                    user, path, "rw", rights_cache)
                 target = "item %r from %r" % (item.href, item.collection.path)
             if rights.intersect_permissions(permissions, "Ww"):
                 permission = "w"
@@ -187,9 +231,16 @@ class Application:
                     path = str(environ.get("PATH_INFO", ""))
                 except Exception:
                     path = ""
-                logger.error("An exception occurred during %s request on %r: "
-                             "%s", method, path, e, exc_info=True)
-                status, headers, answer = INTERNAL_SERVER_ERROR
+                if isinstance(e, storage.LockTimeoutError):
+                    logger.warning("Storage is busy during %s request on %r: "
+                                   "%s", method, path, e)
+                    status, headers, answer = SERVICE_UNAVAILABLE
+                    headers += (("Retry-After", str(max(1, round(
+                        self._lock_timeout(environ) or 0)))),)
+                else:
+                    logger.error("An exception occurred during %s request on "
+                                 "%r: %s", method, path, e, exc_info=True)
+                    status, headers, answer = INTERNAL_SERVER_ERROR
                 answer = answer.encode("ascii")
                 status = "%d %s" % (
                     status, client.responses.get(status, "Unknown"))
@@ -203,23 +254,28 @@ class Application:
         """Manage a request."""
         def response(status, headers=(), answer=None):
             headers = dict(headers)
+            answers = []
             # Set content length
-            if answer:
+            if hasattr(answer, "read"):
+                # Already encoded and compressed (see ``_write_answer``)
+                file_wrapper = environ.get("wsgi.file_wrapper")
+                if file_wrapper:
+                    answers = file_wrapper(answer, self._file_chunk_size)
+                else:
+                    answers = self._iter_file(answer)
+            elif answer:
                 if hasattr(answer, "encode"):
                     logger.debug("Response content:\n%s", answer)
                     headers["Content-Type"] += "; charset=%s" % self.encoding
                     answer = answer.encode(self.encoding)
-                accept_encoding = [
-                    encoding.strip() for encoding in
-                    environ.get("HTTP_ACCEPT_ENCODING", "").split(",")
-                    if encoding.strip()]
 
-                if "gzip" in accept_encoding:
+                if self._accepts_gzip(environ):
                     zcomp = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
                     answer = zcomp.compress(answer) + zcomp.flush()
                     headers["Content-Encoding"] = "gzip"
 
                 headers["Content-Length"] = str(len(answer))
+                answers = [answer]
 
             # Add extra headers set in configuration
             if self.configuration.has_section("headers"):
@@ -235,7 +291,7 @@ class Application:
                 environ["REQUEST_METHOD"], environ.get("PATH_INFO", ""),
                 depthinfo, (time_end - time_begin).total_seconds(), status)
             # Return response content
-            return status, list(headers.items()), [answer] if answer else []
+            return status, list(headers.items()), answers
 
         remote_host = "unknown"
         if environ.get("REMOTE_HOST"):
@@ -319,12 +375,14 @@ class Application:
         if user:
             principal_path = "/%s/" % user
             if self.Rights.authorized(user, principal_path, "W"):
-                with self.Collection.acquire_lock("r", user):
+                with self._acquire_lock("r", user, environ,
+                                        (principal_path,)):
                     principal = next(
                         self.Collection.discover(principal_path, depth="1"),
                         None)
                 if not principal:
-                    with self.Collection.acquire_lock("w", user):
+                    with self._acquire_lock("w", user, environ,
+                                            (principal_path,)):
                         try:
                             self.Collection.create_collection(principal_path)
                         except ValueError as e:
@@ -367,7 +425,53 @@ class Application:
 
         return response(status, headers, answer)
 
-    def _access(self, user, path, permission, item=None):
+    def _accepts_gzip(self, environ):
+        accept_encoding = [
+            encoding.strip() for encoding in
+            environ.get("HTTP_ACCEPT_ENCODING", "").split(",")
+            if encoding.strip()]
+        return "gzip" in accept_encoding
+
+    def _write_answer(self, f, chunks, gzip):
+        """Encode and compress (if ``gzip`` is set) the answer ``chunks``
+        (iterable of strings) into the binary file ``f``."""
+        zcomp = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if gzip else None
+        for chunk in chunks:
+            data = chunk.encode(self.encoding)
+            f.write(zcomp.compress(data) if zcomp else data)
+        if zcomp:
+            f.write(zcomp.flush())
+
+    def _iter_file(self, f):
+        try:
+            while True:
+                data = f.read(self._file_chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            f.close()
+
+    def _acquire_lock(self, mode, user, environ, paths):
+        """Lock the storage for accessing ``paths`` during the request.
+
+        ``paths`` and the timeout are only passed to storage backends that
+        support them.
+
+        """
+        kwargs = {"paths": paths, "timeout": self._lock_timeout(environ)}
+        return self.Collection.acquire_lock(mode, user, **{
+            key: value for key, value in kwargs.items()
+            if key in self._lock_arguments})
+
+    def _lock_timeout(self, environ):
+        """Get the timeout for locking the storage during the request or
+        ``None``."""
+        timeout = self._lock_timeouts.get(
+            environ["REQUEST_METHOD"].upper(), self._lock_timeouts.get("", 0))
+        return timeout or None
+
+    def _access(self, user, path, permission, item=None, rights_cache=None):
         if permission not in "rw":
             raise ValueError("Invalid permission argument: %r" % permission)
         if not item:
@@ -382,12 +486,14 @@ class Application:
         else:
             permissions = ""
             parent_permissions = permission
-        if permissions and self.Rights.authorized(user, path, permissions):
+        if permissions and self._authorized(user, path, permissions,
+                                            rights_cache):
             return True
         if parent_permissions:
             parent_path = storage.sanitize_path(
                 "/%s/" % posixpath.dirname(path.strip("/")))
-            if self.Rights.authorized(user, parent_path, parent_permissions):
+            if self._authorized(user, parent_path, parent_permissions,
+                                rights_cache):
                 return True
         return False
 
@@ -467,13 +573,14 @@ class Application:
 
     def do_DELETE(self, environ, base_prefix, path, user):
         """Manage DELETE request."""
-        if not self._access(user, path, "w"):
+        rights_cache = {}
+        if not self._access(user, path, "w", rights_cache=rights_cache):
             return NOT_ALLOWED
-        with self.Collection.acquire_lock("w", user):
+        with self._acquire_lock("w", user, environ, (path,)):
             item = next(self.Collection.discover(path), None)
             if not item:
                 return NOT_FOUND
-            if not self._access(user, path, "w", item):
+            if not self._access(user, path, "w", item, rights_cache):
                 return NOT_ALLOWED
             if_match = environ.get("HTTP_IF_MATCH", "*")
             if if_match not in ("*", item.etag):
@@ -501,13 +608,14 @@ class Application:
         # Dispatch .web URL to web module
         if path == "/.web" or path.startswith("/.web/"):
             return self.Web.get(environ, base_prefix, path, user)
-        if not self._access(user, path, "r"):
+        rights_cache = {}
+        if not self._access(user, path, "r", rights_cache=rights_cache):
             return NOT_ALLOWED
-        with self.Collection.acquire_lock("r", user):
+        with self._acquire_lock("r", user, environ, (path,)):
             item = next(self.Collection.discover(path), None)
             if not item:
                 return NOT_FOUND
-            if not self._access(user, path, "r", item):
+            if not self._access(user, path, "r", item, rights_cache):
                 return NOT_ALLOWED
             if isinstance(item, storage.BaseCollection):
                 tag = item.get_meta("tag")
@@ -525,13 +633,36 @@ class Application:
                 "ETag": item.etag}
             if content_disposition:
                 headers["Content-Disposition"] = content_disposition
-            answer = item.serialize()
+            # Check the conditions before the answer is generated
+            if httputils.not_modified(environ, item.etag, item.last_modified):
+                return client.NOT_MODIFIED, {
+                    "ETag": item.etag, "Last-Modified": item.last_modified
+                }, None
+            if isinstance(item, storage.BaseCollection):
+                # The collection can be large, the encoded answer is read
+                # from a (cached) file
+                gzip = self._accepts_gzip(environ)
+                answer = item.get_export(
+                    "%s;%s;%s" % (VERSION, self.encoding,
+                                  "gzip" if gzip else ""),
+                    lambda f: self._write_answer(
+                        f, item.serialize_chunks(), gzip))
+                headers["Content-Type"] += "; charset=%s" % self.encoding
+                if gzip:
+                    headers["Content-Encoding"] = "gzip"
+                answer.seek(0, os.SEEK_END)
+                headers["Content-Length"] = str(answer.tell())
+                answer.seek(0)
+            else:
+                answer = item.serialize()
             return client.OK, headers, answer
 
     def do_HEAD(self, environ, base_prefix, path, user):
         """Manage HEAD request."""
         status, headers, answer = self.do_GET(
             environ, base_prefix, path, user)
+        if hasattr(answer, "close"):
+            answer.close()
         return status, headers, None
 
     def do_MKCALENDAR(self, environ, base_prefix, path, user):
@@ -557,7 +688,7 @@ class Application:
         except ValueError as e:
             logger.warning(
                 "Bad MKCALENDAR request on %r: %s", path, e, exc_info=True)
-        with self.Collection.acquire_lock("w", user):
+        with self._acquire_lock("w", user, environ, (path,)):
             item = next(self.Collection.discover(path), None)
             if item:
                 return self._webdav_error_response(
@@ -603,7 +734,7 @@ class Application:
         if (props.get("tag") and "w" not in permissions or
                 not props.get("tag") and "W" not in permissions):
             return NOT_ALLOWED
-        with self.Collection.acquire_lock("w", user):
+        with self._acquire_lock("w", user, environ, (path,)):
             item = next(self.Collection.discover(path), None)
             if item:
                 return METHOD_NOT_ALLOWED
@@ -631,7 +762,8 @@ class Application:
             logger.info("Unsupported destination address: %r", raw_dest)
             # Remote destination server, not supported
             return REMOTE_DESTINATION
-        if not self._access(user, path, "w"):
+        rights_cache = {}
+        if not self._access(user, path, "w", rights_cache=rights_cache):
             return NOT_ALLOWED
         to_path = storage.sanitize_path(to_url.path)
         if not (to_path + "/").startswith(base_prefix + "/"):
@@ -639,15 +771,15 @@ class Application:
                            "start with base prefix", to_path, path)
             return NOT_ALLOWED
         to_path = to_path[len(base_prefix):]
-        if not self._access(user, to_path, "w"):
+        if not self._access(user, to_path, "w", rights_cache=rights_cache):
             return NOT_ALLOWED
 
-        with self.Collection.acquire_lock("w", user):
+        with self._acquire_lock("w", user, environ, (path, to_path)):
             item = next(self.Collection.discover(path), None)
             if not item:
                 return NOT_FOUND
-            if (not self._access(user, path, "w", item) or
-                    not self._access(user, to_path, "w", item)):
+            if (not self._access(user, path, "w", item, rights_cache) or
+                    not self._access(user, to_path, "w", item, rights_cache)):
                 return NOT_ALLOWED
             if isinstance(item, storage.BaseCollection):
                 # TODO: support moving collections
@@ -692,7 +824,8 @@ class Application:
 
     def do_PROPFIND(self, environ, base_prefix, path, user):
         """Manage PROPFIND request."""
-        if not self._access(user, path, "r"):
+        rights_cache = {}
+        if not self._access(user, path, "r", rights_cache=rights_cache):
             return NOT_ALLOWED
         try:
             xml_content = self._read_xml_content(environ)
@@ -703,20 +836,29 @@ class Application:
         except socket.timeout as e:
             logger.debug("client timed out", exc_info=True)
             return REQUEST_TIMEOUT
-        with self.Collection.acquire_lock("r", user):
+        with self._acquire_lock("r", user, environ, (path,)):
             items = self.Collection.discover(
                 path, environ.get("HTTP_DEPTH", "0"))
             # take root item for rights checking
             item = next(items, None)
             if not item:
                 return NOT_FOUND
-            if not self._access(user, path, "r", item):
+            if not self._access(user, path, "r", item, rights_cache):
                 return NOT_ALLOWED
-            # put item back
-            items = itertools.chain([item], items)
-            allowed_items = self.collect_allowed_items(items, user)
             headers = {"DAV": DAV_HEADERS,
                        "Content-Type": "text/xml; charset=%s" % self.encoding}
+            # The etag of calendars and address books changes with their
+            # properties and items (i.e. the ctag)
+            if (isinstance(item, storage.BaseCollection) and
+                    item.get_meta("tag")):
+                headers["ETag"] = item.etag
+                if httputils.not_modified(environ, item.etag):
+                    return (client.NOT_MODIFIED,
+                            {"DAV": DAV_HEADERS, "ETag": item.etag}, None)
+            # put item back
+            items = itertools.chain([item], items)
+            allowed_items = self.collect_allowed_items(items, user,
+                                                       rights_cache)
             status, xml_answer = xmlutils.propfind(
                 base_prefix, path, xml_content, allowed_items, user)
             if status == client.FORBIDDEN:
@@ -725,7 +867,8 @@ class Application:
 
     def do_PROPPATCH(self, environ, base_prefix, path, user):
         """Manage PROPPATCH request."""
-        if not self._access(user, path, "w"):
+        rights_cache = {}
+        if not self._access(user, path, "w", rights_cache=rights_cache):
             return NOT_ALLOWED
         try:
             xml_content = self._read_xml_content(environ)
@@ -736,11 +879,11 @@ class Application:
         except socket.timeout as e:
             logger.debug("client timed out", exc_info=True)
             return REQUEST_TIMEOUT
-        with self.Collection.acquire_lock("w", user):
+        with self._acquire_lock("w", user, environ, (path,)):
             item = next(self.Collection.discover(path), None)
             if not item:
                 return NOT_FOUND
-            if not self._access(user, path, "w", item):
+            if not self._access(user, path, "w", item, rights_cache):
                 return NOT_ALLOWED
             if not isinstance(item, storage.BaseCollection):
                 return FORBIDDEN
@@ -758,7 +901,8 @@ class Application:
 
     def do_PUT(self, environ, base_prefix, path, user):
         """Manage PUT request."""
-        if not self._access(user, path, "w"):
+        rights_cache = {}
+        if not self._access(user, path, "w", rights_cache=rights_cache):
             return NOT_ALLOWED
         try:
             content = self._read_content(environ)
@@ -771,8 +915,9 @@ class Application:
         # Prepare before locking
         parent_path = storage.sanitize_path(
             "/%s/" % posixpath.dirname(path.strip("/")))
-        permissions = self.Rights.authorized(user, path, "Ww")
-        parent_permissions = self.Rights.authorized(user, parent_path, "w")
+        permissions = self._authorized(user, path, "Ww", rights_cache)
+        parent_permissions = self._authorized(user, parent_path, "w",
+                                              rights_cache)
 
         def prepare(vobject_items, tag=None, write_whole_collection=None):
             if (write_whole_collection or
@@ -871,7 +1016,7 @@ class Application:
         (prepared_items, prepared_tag, prepared_write_whole_collection,
          prepared_props, prepared_exc_info) = prepare(vobject_items)
 
-        with self.Collection.acquire_lock("w", user):
+        with self._acquire_lock("w", user, environ, (path,)):
             item = next(self.Collection.discover(path), None)
             parent_item = next(self.Collection.discover(parent_path), None)
             if not parent_item:
@@ -887,9 +1032,10 @@ class Application:
                 tag = parent_item.get_meta("tag")
 
             if write_whole_collection:
-                if not self.Rights.authorized(user, path, "w" if tag else "W"):
+                if not self._authorized(user, path, "w" if tag else "W",
+                                        rights_cache):
                     return NOT_ALLOWED
-            elif not self.Rights.authorized(user, parent_path, "w"):
+            elif not self._authorized(user, parent_path, "w", rights_cache):
                 return NOT_ALLOWED
 
             etag = environ.get("HTTP_IF_MATCH", "")
@@ -946,7 +1092,8 @@ class Application:
 
     def do_REPORT(self, environ, base_prefix, path, user):
         """Manage REPORT request."""
-        if not self._access(user, path, "r"):
+        rights_cache = {}
+        if not self._access(user, path, "r", rights_cache=rights_cache):
             return NOT_ALLOWED
         try:
             xml_content = self._read_xml_content(environ)
@@ -958,11 +1105,12 @@ class Application:
             logger.debug("client timed out", exc_info=True)
             return REQUEST_TIMEOUT
         with contextlib.ExitStack() as lock_stack:
-            lock_stack.enter_context(self.Collection.acquire_lock("r", user))
+            lock_stack.enter_context(
+                self._acquire_lock("r", user, environ, (path,)))
             item = next(self.Collection.discover(path), None)
             if not item:
                 return NOT_FOUND
-            if not self._access(user, path, "r", item):
+            if not self._access(user, path, "r", item, rights_cache):
                 return NOT_ALLOWED
             if isinstance(item, storage.BaseCollection):
                 collection = item
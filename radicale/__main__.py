@@ -39,6 +39,8 @@ def run():
     parser.add_argument("--version", action="version", version=VERSION)
     parser.add_argument("--verify-storage", action="store_true",
                         help="check the storage for errors and exit")
+    parser.add_argument("--gc-storage", action="store_true",
+                        help="remove outdated data from the storage and exit")
     parser.add_argument(
         "-C", "--config", help="use a specific configuration file")
     parser.add_argument("-D", "--debug", action="store_true",
@@ -124,6 +126,18 @@ def run():
             exit(1)
         return
 
+    if args.gc_storage:
+        logger.info("Removing outdated data from storage")
+        try:
+            Collection = storage.load(configuration)
+            with Collection.acquire_gc_lock():
+                Collection.gc()
+        except Exception as e:
+            logger.error("An exception occurred during storage garbage "
+                         "collection: %s", e, exc_info=True)
+            exit(1)
+        return
+
     try:
         serve(configuration)
     except Exception as e:
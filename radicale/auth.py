@@ -36,7 +36,7 @@ The `is_authenticated(user, password)` function provided by this module
 verifies the user-given credentials by parsing the htpasswd credential file
 pointed to by the ``htpasswd_filename`` configuration value while assuming
 the password encryption method specified via the ``htpasswd_encryption``
-configuration value.
+configuration value. The parsed file is kept in memory until it changes.
 
 The following htpasswd password encrpytion methods are supported by Radicale
 out-of-the-box:
@@ -58,6 +58,9 @@ import functools
 import hashlib
 import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
 from importlib import import_module
 
 from radicale.log import logger
@@ -167,6 +170,20 @@ class Auth(BaseAuth):
                 "The htpasswd encryption method %r is not "
                 "supported." % self.encryption)
 
+        self._htpasswd_lock = threading.Lock()
+        self._htpasswd_stat_key = None
+        self._htpasswd = {}
+        self._dummy_hash_value = None
+
+        # Maps ``(login, HMAC of password)`` to the expiration time of
+        # verified credentials, in order of last use
+        self._cache = OrderedDict()
+        self._cache_expiry = configuration.getfloat(
+            "auth", "htpasswd_cache_expiry")
+        self._cache_size = configuration.getint("auth", "htpasswd_cache_size")
+        # Passwords are only kept as HMAC with a random key
+        self._cache_hmac_key = os.urandom(32)
+
     def _plain(self, hash_value, password):
         """Check if ``hash_value`` and ``password`` match, plain method."""
         return hmac.compare_digest(hash_value, password)
@@ -211,38 +228,95 @@ class Auth(BaseAuth):
         hash_value = hash_value.strip()
         return md5_apr1.verify(password, hash_value)
 
+    def _read_htpasswd(self):
+        """Get the credentials from the htpasswd file.
+
+        Returns a dict that maps logins to hashes. The file is parsed again
+        when it was modified, the first entry of a login is used.
+
+        """
+        try:
+            st = os.stat(self.filename)
+            stat_key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+            with self._htpasswd_lock:
+                if stat_key == self._htpasswd_stat_key:
+                    return self._htpasswd
+                htpasswd = {}
+                with open(self.filename) as f:
+                    st = os.fstat(f.fileno())
+                    stat_key = (st.st_dev, st.st_ino, st.st_mtime_ns,
+                                st.st_size)
+                    for line in f:
+                        line = line.rstrip("\n")
+                        if line.lstrip() and not line.lstrip().startswith("#"):
+                            try:
+                                hash_login, hash_value = line.split(
+                                    ":", maxsplit=1)
+                            except ValueError as e:
+                                raise RuntimeError(
+                                    "Invalid htpasswd file %r: %s" %
+                                    (self.filename, e)) from e
+                            htpasswd.setdefault(hash_login, hash_value)
+                self._htpasswd = htpasswd
+                self._htpasswd_stat_key = stat_key
+                self._cache.clear()
+                # Hash of the same scheme for logins that don't exist
+                self._dummy_hash_value = next(iter(htpasswd.values()), None)
+                logger.debug("Loaded %d logins from htpasswd file %r",
+                             len(htpasswd), self.filename)
+                return htpasswd
+        except OSError as e:
+            raise RuntimeError("Failed to load htpasswd file %r: %s" %
+                               (self.filename, e)) from e
+
     def login(self, login, password):
         """Validate credentials.
 
-        Iterate through htpasswd credential file until login matches, extract
-        hash (encrypted password) and check hash against password,
-        using the method specified in the Radicale config.
+        Look up the hash (encrypted password) of login in the htpasswd
+        credential file and check it against password, using the method
+        specified in the Radicale config.
 
-        The content of the file is not cached because reading is generally a
-        very cheap operation, and it's useful to get live updates of the
-        htpasswd file.
+        The content of the file is cached and reloaded when the file
+        changes. The password is verified exactly once per call, for unknown
+        logins against the hash of another login, to avoid timing attacks
+        (see #591). Successfully verified credentials are cached for
+        ``htpasswd_cache_expiry`` seconds or until the file changes.
 
         """
+        htpasswd = self._read_htpasswd()
+        cache_key = None
+        if self._cache_expiry > 0 and self._cache_size > 0:
+            cache_key = (login, hmac.new(
+                self._cache_hmac_key, password.encode(
+                    self.configuration.get("encoding", "stock")),
+                hashlib.sha256).digest())
+            with self._htpasswd_lock:
+                expiration = self._cache.get(cache_key)
+                if expiration is not None:
+                    if expiration > time.monotonic():
+                        self._cache.move_to_end(cache_key)
+                        return login
+                    del self._cache[cache_key]
+        hash_value = htpasswd.get(login)
+        if hash_value is None:
+            hash_value = self._dummy_hash_value
+            if hash_value is None:
+                return ""
         try:
-            with open(self.filename) as f:
-                for line in f:
-                    line = line.rstrip("\n")
-                    if line.lstrip() and not line.lstrip().startswith("#"):
-                        try:
-                            hash_login, hash_value = line.split(
-                                ":", maxsplit=1)
-                            # Always compare both login and password to avoid
-                            # timing attacks, see #591.
-                            login_ok = hmac.compare_digest(hash_login, login)
-                            password_ok = self.verify(hash_value, password)
-                            if login_ok and password_ok:
-                                return login
-                        except ValueError as e:
-                            raise RuntimeError("Invalid htpasswd file %r: %s" %
-                                               (self.filename, e)) from e
-        except OSError as e:
-            raise RuntimeError("Failed to load htpasswd file %r: %s" %
+            password_ok = self.verify(hash_value, password)
+        except ValueError as e:
+            raise RuntimeError("Invalid htpasswd file %r: %s" %
                                (self.filename, e)) from e
+        if password_ok and login in htpasswd:
+            if cache_key is not None:
+                with self._htpasswd_lock:
+                    if htpasswd is self._htpasswd:
+                        self._cache[cache_key] = (
+                            time.monotonic() + self._cache_expiry)
+                        self._cache.move_to_end(cache_key)
+                        while len(self._cache) > self._cache_size:
+                            self._cache.popitem(last=False)
+            return login
         return ""
 
 
@@ -49,6 +49,37 @@ def positive_float(value):
     return value
 
 
+def server_type(value):
+    if value not in ("threaded", "asyncio"):
+        raise ValueError("unsupported server type: %s" % value)
+    return value
+
+
+def lock_timeout(value):
+    parse_lock_timeout(value)
+    return value
+
+
+def parse_lock_timeout(value):
+    """Parse ``"TIMEOUT, METHOD=TIMEOUT, ..."``.
+
+    Returns a dict that maps the HTTP methods to timeouts, the default is
+    stored with the key ``""``.
+
+    """
+    timeouts = {}
+    for part in value.split(","):
+        method, _, timeout = part.strip().rpartition("=")
+        timeouts[method.strip().upper()] = positive_float(timeout)
+    return timeouts
+
+
+def item_cache_validation(value):
+    if value not in ("content", "stat"):
+        raise ValueError("unsupported validation method: %s" % value)
+    return value
+
+
 def logging_level(value):
     if value not in ("debug", "info", "warning", "error", "critical"):
         raise ValueError("unsupported level: %s" % value)
@@ -63,10 +94,24 @@ INITIAL_CONFIG = OrderedDict([
             "help": "set server hostnames including ports",
             "aliases": ["-H", "--hosts"],
             "type": str}),
+        ("type", {
+            "value": "threaded",
+            "help": "server implementation (threaded or asyncio)",
+            "type": server_type,
+            "internal": ("threaded", "asyncio")}),
         ("max_connections", {
             "value": "20",
             "help": "maximum number of parallel connections",
             "type": positive_int}),
+        ("workers", {
+            "value": "0",
+            "help": "number of worker processes (0 = number of CPUs)",
+            "type": positive_int}),
+        ("max_worker_requests", {
+            "value": "1000",
+            "help": "number of connections after which a worker process "
+                    "is replaced (0 = never)",
+            "type": positive_int}),
         ("max_content_length", {
             "value": "100000000",
             "help": "maximum size of request body in bytes",
@@ -131,6 +176,15 @@ INITIAL_CONFIG = OrderedDict([
             "value": "bcrypt",
             "help": "htpasswd encryption method",
             "type": str}),
+        ("htpasswd_cache_expiry", {
+            "value": "60",
+            "help": "time in seconds for which verified credentials are "
+                    "cached (0 = disabled)",
+            "type": positive_float}),
+        ("htpasswd_cache_size", {
+            "value": "1000",
+            "help": "maximum number of cached credentials",
+            "type": positive_int}),
         ("realm", {
             "value": "Radicale - Password Required",
             "help": "message displayed when a password is needed",
@@ -164,10 +218,38 @@ INITIAL_CONFIG = OrderedDict([
             "value": 2592000,  # 30 days
             "help": "delete sync token that are older",
             "type": int}),
+        ("gc_interval", {
+            "value": "86400",
+            "help": "minimal time in seconds between removing outdated "
+                    "data of a collection during changes "
+                    "(0 = only with --gc-storage)",
+            "type": positive_int}),
+        ("item_cache_validation", {
+            "value": "content",
+            "help": "validate item cache entries by the content (content) "
+                    "or the status (stat) of item files",
+            "type": item_cache_validation}),
+        ("item_memory_cache_size", {
+            "value": "16000000",
+            "help": "maximum memory in bytes used for keeping items in "
+                    "memory, if item_cache_validation is stat "
+                    "(0 = disabled)",
+            "type": positive_int}),
+        ("lock_timeout", {
+            "value": "0",
+            "help": "maximal time in seconds that requests wait for the "
+                    "storage lock, can be set per method "
+                    "(e.g. 30, PUT=60; 0 = no limit)",
+            "type": lock_timeout}),
         ("hook", {
             "value": "",
             "help": "command that is run after changes to storage",
-            "type": str})])),
+            "type": str}),
+        ("hook_background", {
+            "value": "False",
+            "help": "run the hook in the background, changes that happen "
+                    "while the hook runs are combined into one run",
+            "type": bool})])),
     ("web", OrderedDict([
         ("type", {
             "value": "internal",
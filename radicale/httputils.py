@@ -0,0 +1,49 @@
+# This file is part of Radicale Server - Calendar Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Radicale.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helper functions for HTTP.
+
+"""
+
+import email.utils
+
+
+def not_modified(environ, etag=None, last_modified=None):
+    """Check if the representation with ``etag`` and ``last_modified``
+    matches the ``If-None-Match`` or ``If-Modified-Since`` header of the
+    request (see RFC 7232).
+
+    ``last_modified`` is a HTTP-date like the ``Last-Modified`` header.
+
+    """
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        if not etag:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison
+        etag = etag[2:] if etag.startswith("W/") else etag
+        return any((tag[2:] if tag.startswith("W/") else tag) == etag
+                   for tag in map(str.strip, if_none_match.split(",")))
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since and last_modified:
+        try:
+            return (email.utils.parsedate_to_datetime(last_modified) <=
+                    email.utils.parsedate_to_datetime(if_modified_since))
+        except (TypeError, ValueError):
+            return False
+    return False
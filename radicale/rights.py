@@ -35,11 +35,15 @@ Section names are only used for naming the rule.
 
 Leading or ending slashes are trimmed from collection's path.
 
+The file is parsed once and reloaded when it changes.
+
 """
 
 import configparser
+import functools
 import os.path
 import re
+import threading
 from importlib import import_module
 
 from radicale import storage
@@ -75,6 +79,10 @@ def intersect_permissions(a, b="RrWw"):
 
 
 class BaseRights:
+    # Set to True if ``authorized`` only depends on its arguments, so that
+    # decisions can be reused during a request
+    cache_decisions = False
+
     def __init__(self, configuration):
         self.configuration = configuration
 
@@ -94,6 +102,8 @@ class BaseRights:
 
 
 class AuthenticatedRights(BaseRights):
+    cache_decisions = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._verify_user = self.configuration.get("auth", "type") != "none"
@@ -144,9 +154,89 @@ class OwnerOnlyRights(AuthenticatedRights):
 
 
 class Rights(BaseRights):
+    cache_decisions = True
+
+    # Values of the interpolation variables while parsing the rights file,
+    # they are replaced in the patterns for each request
+    _login_placeholder = "\x00login\x00"
+    _path_placeholder = "\x00path\x00"
+
     def __init__(self, configuration):
         super().__init__(configuration)
         self.filename = os.path.expanduser(configuration.get("rights", "file"))
+        self._rules_lock = threading.Lock()
+        self._rules_stat_key = None
+        self._rules = []
+        self._compile = functools.lru_cache(maxsize=1024)(re.compile)
+
+    def _compile_section_pattern(self, section, pattern):
+        try:
+            return self._compile(pattern)
+        except Exception as e:
+            raise RuntimeError("Error in section %r of rights file %r: "
+                               "%s" % (section, self.filename, e)) from e
+
+    def _read_rules(self):
+        """Get the rules from the rights file.
+
+        Returns a list of ``(section, user_pattern, collection_pattern,
+        permissions)`` tuples. Patterns that don't depend on the user or the
+        path are compiled, the others are strings with placeholders. The file
+        is parsed again when it was modified.
+
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            raise RuntimeError("Failed to load rights file %r: %s" % (
+                self.filename, "No such file: %r" % self.filename
+                if isinstance(e, FileNotFoundError) else e)) from e
+        stat_key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._rules_lock:
+            if stat_key == self._rules_stat_key:
+                return self._rules
+            rights_config = configparser.ConfigParser(
+                {"login": self._login_placeholder,
+                 "path": self._path_placeholder})
+            try:
+                if not rights_config.read(self.filename):
+                    raise RuntimeError("No such file: %r" %
+                                       self.filename)
+            except Exception as e:
+                raise RuntimeError("Failed to load rights file %r: %s" %
+                                   (self.filename, e)) from e
+            rules = []
+            for section in rights_config.sections():
+                try:
+                    user_pattern = rights_config.get(section, "user")
+                    collection_pattern = rights_config.get(
+                        section, "collection")
+                    permissions = rights_config.get(section, "permissions")
+                except Exception as e:
+                    raise RuntimeError(
+                        "Error in section %r of rights file %r: %s" %
+                        (section, self.filename, e)) from e
+                if not self._has_placeholder(user_pattern):
+                    user_pattern = self._compile_section_pattern(
+                        section, user_pattern)
+                if not (self._has_placeholder(collection_pattern) or
+                        "{" in collection_pattern or
+                        "}" in collection_pattern):
+                    collection_pattern = self._compile_section_pattern(
+                        section, collection_pattern)
+                rules.append((section, user_pattern, collection_pattern,
+                              permissions))
+            self._rules = rules
+            self._rules_stat_key = stat_key
+            return rules
+
+    def _has_placeholder(self, value):
+        return (self._login_placeholder in value or
+                self._path_placeholder in value)
+
+    def _interpolate(self, value, user_escaped, sane_path_escaped):
+        return value.replace(self._login_placeholder, user_escaped).replace(
+            self._path_placeholder, sane_path_escaped)
 
     def authorized(self, user, path, permissions):
         user = user or ""
@@ -154,35 +244,34 @@ class Rights(BaseRights):
         # Prevent "regex injection"
         user_escaped = re.escape(user)
         sane_path_escaped = re.escape(sane_path)
-        rights_config = configparser.ConfigParser(
-            {"login": user_escaped, "path": sane_path_escaped})
-        try:
-            if not rights_config.read(self.filename):
-                raise RuntimeError("No such file: %r" %
-                                   self.filename)
-        except Exception as e:
-            raise RuntimeError("Failed to load rights file %r: %s" %
-                               (self.filename, e)) from e
-        for section in rights_config.sections():
+        for (section, user_pattern, collection_pattern,
+             rule_permissions) in self._read_rules():
             try:
-                user_pattern = rights_config.get(section, "user")
-                collection_pattern = rights_config.get(section, "collection")
-                user_match = re.fullmatch(user_pattern, user)
-                collection_match = user_match and re.fullmatch(
-                    collection_pattern.format(
-                        *map(re.escape, user_match.groups())), sane_path)
+                if isinstance(user_pattern, str):
+                    user_pattern = self._compile(self._interpolate(
+                        user_pattern, user_escaped, sane_path_escaped))
+                user_match = user_pattern.fullmatch(user)
+                if user_match and isinstance(collection_pattern, str):
+                    collection_pattern = self._compile(self._interpolate(
+                        collection_pattern, user_escaped, sane_path_escaped
+                    ).format(*map(re.escape, user_match.groups())))
+                collection_match = (user_match and
+                                    collection_pattern.fullmatch(sane_path))
             except Exception as e:
                 raise RuntimeError("Error in section %r of rights file %r: "
                                    "%s" % (section, self.filename, e)) from e
             if user_match and collection_match:
                 logger.debug("Rule %r:%r matches %r:%r from section %r",
-                             user, sane_path, user_pattern,
-                             collection_pattern, section)
+                             user, sane_path, user_pattern.pattern,
+                             collection_pattern.pattern, section)
                 return intersect_permissions(
-                    permissions, rights_config.get(section, "permissions"))
+                    permissions, self._interpolate(
+                        rule_permissions, user_escaped, sane_path_escaped))
             else:
                 logger.debug("Rule %r:%r doesn't match %r:%r from section %r",
-                             user, sane_path, user_pattern,
-                             collection_pattern, section)
+                             user, sane_path, user_pattern.pattern,
+                             collection_pattern if isinstance(
+                                 collection_pattern, str)
+                             else collection_pattern.pattern, section)
         logger.info("Rights: %r:%r doesn't match any section", user, sane_path)
         return ""
@@ -21,7 +21,10 @@ Radicale WSGI server.
 
 """
 
+import asyncio
+import concurrent.futures
 import contextlib
+import email.utils
 import multiprocessing
 import os
 import select
@@ -31,24 +34,23 @@ import socketserver
 import ssl
 import sys
 import wsgiref.simple_server
+from http import client
 from urllib.parse import unquote
 
 from radicale import Application
 from radicale.log import logger
 
-if hasattr(socketserver, "ForkingMixIn"):
-    ParallelizationMixIn = socketserver.ForkingMixIn
-else:
-    ParallelizationMixIn = socketserver.ThreadingMixIn
 
-
-class ParallelHTTPServer(ParallelizationMixIn,
+class ParallelHTTPServer(socketserver.ThreadingMixIn,
                          wsgiref.simple_server.WSGIServer):
 
     # These class attributes must be set before creating instance
     client_timeout = None
     max_connections = None
 
+    # Number of connections accepted by this process
+    handled_connections = 0
+
     def __init__(self, address, handler, bind_and_activate=True):
         """Create server."""
         ipv6 = ":" in address[0]
@@ -81,10 +83,15 @@ class ParallelHTTPServer(ParallelizationMixIn,
     def get_request(self):
         # Set timeout for client
         socket_, address = super().get_request()
-        if self.client_timeout:
-            socket_.settimeout(self.client_timeout)
+        # The listening socket might be non-blocking (see ``serve``), reset
+        # the blocking mode explicitly
+        socket_.settimeout(self.client_timeout or None)
         return socket_, address
 
+    def process_request(self, request, client_address):
+        self.handled_connections += 1
+        return super().process_request(request, client_address)
+
     def finish_request(self, request, client_address):
         with self.connections_guard:
             return super().finish_request(request, client_address)
@@ -195,6 +202,531 @@ class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
         handler.run(self.server.get_app())
 
 
+class AsyncioRequestBody:
+    """File-like object for the body of a request.
+
+    The body is read from the event loop by the thread that calls the WSGI
+    application.
+
+    """
+
+    def __init__(self, loop, reader, writer, content_length, timeout,
+                 expect_continue=False):
+        self._loop = loop
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self.remaining = content_length
+        self.expect_continue = expect_continue
+        self.continue_sent = False
+
+    async def _read(self, size):
+        if self.expect_continue and not self.continue_sent:
+            self.continue_sent = True
+            self._writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        return await asyncio.wait_for(
+            self._reader.readexactly(size), self._timeout)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b""
+        try:
+            data = asyncio.run_coroutine_threadsafe(
+                self._read(size), self._loop).result()
+        except asyncio.TimeoutError as e:
+            raise socket.timeout("timed out") from e
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionError("connection closed by client") from e
+        self.remaining -= len(data)
+        return data
+
+
+class AsyncioHTTPServer:
+    """HTTP server that multiplexes connections on an asyncio event loop.
+
+    Connections are persistent (HTTP/1.1 keep-alive) and pipelined requests
+    are handled one after another. The WSGI application is called in a
+    thread pool with ``max_connections`` threads.
+
+    """
+
+    # These class attributes must be set before creating instance
+    client_timeout = None
+    max_connections = None
+    dns_lookup = True
+    certificate = None
+    key = None
+    protocol = None
+    ciphers = None
+    certificate_authority = None
+
+    # Maximum size of the request line and of each header line
+    max_line_length = 65536
+    # Maximum number of header lines
+    max_headers = 100
+    # Unread request bodies up to this size are discarded, larger bodies
+    # close the connection
+    max_discard_length = 65536
+
+    def __init__(self, address, application):
+        """Create server."""
+        self.application = application
+        ipv6 = ":" in address[0]
+        self.socket = socket.socket(
+            socket.AF_INET6 if ipv6 else socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if ipv6:
+                # Only allow IPv6 connections to the IPv6 socket
+                self.socket.setsockopt(
+                    socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            self.socket.bind(address)
+            self.socket.listen(socket.SOMAXCONN)
+            self.socket.setblocking(False)
+        except BaseException:
+            self.socket.close()
+            raise
+        host, self.server_port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+
+        self.ssl_context = None
+        if self.certificate:
+            self.ssl_context = ssl.SSLContext(self.protocol)
+            self.ssl_context.load_cert_chain(self.certificate, self.key)
+            if self.certificate_authority:
+                self.ssl_context.load_verify_locations(
+                    self.certificate_authority)
+                self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+            if self.ciphers:
+                self.ssl_context.set_ciphers(self.ciphers)
+
+        if self.max_connections:
+            self.connections_guard = multiprocessing.BoundedSemaphore(
+                self.max_connections)
+        else:
+            # use dummy context manager
+            self.connections_guard = contextlib.ExitStack()
+
+        self.handled_connections = 0
+        # Maps the writers of open connections to ``[busy, closed]``
+        self._connections = {}
+        self._closing = False
+        self._loop = None
+        self._executor = None
+        self._server = None
+
+    async def start(self, loop, executor):
+        """Start accepting connections on ``loop``."""
+        self._loop = loop
+        self._executor = executor
+        self._server = await asyncio.start_server(
+            self._handle_connection, sock=self.socket, ssl=self.ssl_context,
+            limit=self.max_line_length + 2)
+
+    async def close(self):
+        """Stop accepting connections and wait for active requests."""
+        self._closing = True
+        if self._server:
+            self._server.close()
+        for writer, (busy, closed) in list(self._connections.items()):
+            if not busy:
+                writer.close()
+        closed_futures = [closed for _, closed in self._connections.values()]
+        if closed_futures:
+            await asyncio.wait(closed_futures)
+        if self._server:
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        self.handled_connections += 1
+        state = self._connections[writer] = [False, self._loop.create_future()]
+        try:
+            while not self._closing:
+                try:
+                    keep_alive = await self._handle_request(
+                        reader, writer, state)
+                except (asyncio.TimeoutError, OSError, EOFError):
+                    logger.debug("Connection closed", exc_info=True)
+                    break
+                if not keep_alive:
+                    break
+        except Exception as e:
+            logger.error("An exception occurred during request: %s", e,
+                         exc_info=True)
+        finally:
+            writer.close()
+            del self._connections[writer]
+            state[1].set_result(None)
+
+    async def _read_request_head(self, reader):
+        """Read the request line and the headers of the next request.
+
+        Returns ``None`` if the client closed the connection, otherwise the
+        request line and a list of ``(name, value)`` tuples. Raises
+        ``ValueError`` with an HTTP status code for malformed requests.
+
+        """
+        request_line = b""
+        while not request_line.strip():
+            # RFC 7230: Ignore empty lines before the request line
+            request_line = await reader.readline()
+            if not request_line:
+                return None
+        headers = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise EOFError("connection closed by client")
+            if line in (b"\r\n", b"\n"):
+                break
+            if len(headers) >= self.max_headers or line[:1] in b" \t":
+                raise ValueError(client.BAD_REQUEST)
+            name, sep, value = line.decode("iso-8859-1").partition(":")
+            if not sep or not name or name != name.strip():
+                raise ValueError(client.BAD_REQUEST)
+            headers.append((name, value.strip()))
+        return request_line.decode("iso-8859-1").rstrip("\r\n"), headers
+
+    async def _write_error(self, writer, status):
+        body = ("%d %s" % (status, client.responses.get(status, "Unknown"))
+                ).encode("ascii")
+        writer.write((
+            "HTTP/1.1 %d %s\r\nDate: %s\r\nContent-Type: text/plain\r\n"
+            "Content-Length: %d\r\nConnection: close\r\n\r\n" % (
+                status, client.responses.get(status, "Unknown"),
+                email.utils.formatdate(usegmt=True), len(body))
+        ).encode("ascii") + body)
+        await writer.drain()
+
+    async def _handle_request(self, reader, writer, state):
+        """Handle one request of a connection.
+
+        Returns ``True`` if the connection can be reused.
+
+        """
+        try:
+            # Wait for the next request of the (idle) connection
+            try:
+                head = await asyncio.wait_for(
+                    self._read_request_head(reader),
+                    self.client_timeout or None)
+            except ValueError as e:
+                # Lines that exceed the limit of the reader raise ValueError
+                # too
+                status = e.args[0] if e.args and isinstance(
+                    e.args[0], int) else client.REQUEST_HEADER_FIELDS_TOO_LARGE
+                await self._write_error(writer, status)
+                return False
+            if head is None:
+                return False
+            state[0] = True
+            request_line, headers = head
+            words = request_line.split()
+            if len(words) != 3:
+                await self._write_error(writer, client.BAD_REQUEST)
+                return False
+            method, target, version = words
+            if version not in ("HTTP/1.0", "HTTP/1.1"):
+                await self._write_error(
+                    writer, client.HTTP_VERSION_NOT_SUPPORTED)
+                return False
+
+            environ = self._get_environ(writer, method, target, version,
+                                        headers)
+            connection = {token.strip().lower() for token in environ.get(
+                "HTTP_CONNECTION", "").split(",")}
+            if version == "HTTP/1.1":
+                keep_alive = "close" not in connection
+            else:
+                keep_alive = "keep-alive" in connection
+            if environ.get("HTTP_TRANSFER_ENCODING", "identity").lower(
+                    ) != "identity":
+                await self._write_error(writer, client.NOT_IMPLEMENTED)
+                return False
+            try:
+                content_length = int(environ.get("CONTENT_LENGTH") or 0)
+                if content_length < 0:
+                    raise ValueError("negative content length")
+            except ValueError:
+                await self._write_error(writer, client.BAD_REQUEST)
+                return False
+            body = AsyncioRequestBody(
+                self._loop, reader, writer, content_length,
+                self.client_timeout or None,
+                version == "HTTP/1.1" and environ.get(
+                    "HTTP_EXPECT", "").lower() == "100-continue")
+            environ["wsgi.input"] = body
+
+            keep_alive = await self._loop.run_in_executor(
+                self._executor, self._run_application, writer, environ,
+                method, keep_alive)
+
+            # Discard the unread part of the request body
+            if keep_alive and body.remaining:
+                if (body.expect_continue and not body.continue_sent or
+                        body.remaining > self.max_discard_length):
+                    keep_alive = False
+                else:
+                    await asyncio.wait_for(
+                        reader.readexactly(body.remaining),
+                        self.client_timeout or None)
+            return keep_alive
+        finally:
+            state[0] = False
+
+    def _get_environ(self, writer, method, target, version, headers):
+        path, _, query = target.partition("?")
+        peername = writer.get_extra_info("peername")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.server_name,
+            "SERVER_PORT": str(self.server_port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peername[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "https" if self.ssl_context else "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False}
+        peercert = writer.get_extra_info("peercert")
+        if self.ssl_context:
+            # The certificate can be evaluated by the auth module
+            environ["REMOTE_CERTIFICATE"] = peercert
+        for name, value in headers:
+            if "_" in name:
+                # Ambiguous in environ (e.g. X-Script-Name / X_Script_Name)
+                continue
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            if key in environ:
+                environ[key] += "," + value
+            else:
+                environ[key] = value
+        return environ
+
+    def _write(self, writer, data):
+        """Write ``data`` from a thread of the executor."""
+        async def write():
+            writer.write(data)
+            await asyncio.wait_for(writer.drain(),
+                                   self.client_timeout or None)
+        asyncio.run_coroutine_threadsafe(write(), self._loop).result()
+
+    def _run_application(self, writer, environ, method, keep_alive):
+        """Call the WSGI application and send the response.
+
+        This is called in a thread of the executor. Returns ``True`` if the
+        connection can be reused.
+
+        """
+        if self.dns_lookup:
+            remote_host = socket.getfqdn(environ["REMOTE_ADDR"])
+            if remote_host != environ["REMOTE_ADDR"]:
+                environ["REMOTE_HOST"] = remote_host
+        response = {}
+        headers_sent = False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and headers_sent:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"] = status
+            response["headers"] = list(headers)
+            return write
+
+        def send_headers():
+            nonlocal headers_sent, keep_alive
+            status = response["status"]
+            headers = response["headers"]
+            code = int(status.split(" ", 1)[0])
+            response["body"] = not (method.upper() == "HEAD" or
+                                    100 <= code < 200 or code in (204, 304))
+            response["chunked"] = False
+            if response["body"] and not any(
+                    name.lower() == "content-length" for name, _ in headers):
+                if environ["SERVER_PROTOCOL"] == "HTTP/1.1":
+                    response["chunked"] = True
+                    headers.append(("Transfer-Encoding", "chunked"))
+                else:
+                    keep_alive = False
+            body = environ["wsgi.input"]
+            if body.remaining and (
+                    body.expect_continue and not body.continue_sent or
+                    body.remaining > self.max_discard_length):
+                # The unread part of the request body can't be discarded
+                keep_alive = False
+            if not keep_alive:
+                headers.append(("Connection", "close"))
+            elif environ["SERVER_PROTOCOL"] == "HTTP/1.0":
+                headers.append(("Connection", "keep-alive"))
+            self._write(writer, (
+                "HTTP/1.1 %s\r\nDate: %s\r\n%s\r\n" % (
+                    status, email.utils.formatdate(usegmt=True),
+                    "".join("%s: %s\r\n" % header for header in headers))
+            ).encode("iso-8859-1"))
+            headers_sent = True
+
+        def write(data):
+            if not headers_sent:
+                send_headers()
+            if not data or not response["body"]:
+                return
+            if response["chunked"]:
+                data = b"%x\r\n%s\r\n" % (len(data), data)
+            self._write(writer, data)
+
+        with self.connections_guard:
+            result = None
+            try:
+                result = self.application(environ, start_response)
+                for data in result:
+                    write(data)
+                if not headers_sent:
+                    send_headers()
+                if response["chunked"]:
+                    self._write(writer, b"0\r\n\r\n")
+            except Exception as e:
+                if isinstance(e, (socket.timeout, ConnectionError)):
+                    logger.info("Connection closed during request: %s", e,
+                                exc_info=True)
+                else:
+                    logger.error("An exception occurred during request: %s",
+                                 e, exc_info=True)
+                if not headers_sent and "status" not in response:
+                    start_response("500 Internal Server Error",
+                                   [("Content-Length", "0")])
+                    with contextlib.suppress(Exception):
+                        send_headers()
+                return False
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        return keep_alive
+
+
+def _serve_asyncio_loop(servers, shutdown_sockets, max_connections=0):
+    """Handle connections on an event loop until one of ``shutdown_sockets``
+    is readable.
+
+    ``servers`` maps listening sockets to instances of
+    ``AsyncioHTTPServer``.
+
+    If ``max_connections`` is not ``0``, the loop also stops after this
+    number of connections was accepted.
+
+    """
+    # The default event loop on Windows (``ProactorEventLoop``) doesn't
+    # support ``add_reader``
+    loop = asyncio.SelectorEventLoop()
+    asyncio.set_event_loop(loop)
+    # The size of the pool is limited by ``max_connections`` of the servers
+    executor = concurrent.futures.ThreadPoolExecutor(max(
+        (server.max_connections for server in servers.values()),
+        default=0) or None)
+    stop = asyncio.Event()
+
+    def check_stop(socket_=None):
+        if socket_ is not None:
+            # The shutdown socket stays readable
+            loop.remove_reader(socket_)
+            stop.set()
+        elif max_connections and sum(server.handled_connections
+                                     for server in servers.values()
+                                     ) >= max_connections:
+            stop.set()
+        else:
+            loop.call_later(1, check_stop)
+
+    async def main():
+        for server in servers.values():
+            await server.start(loop, executor)
+        for socket_ in shutdown_sockets:
+            loop.add_reader(socket_, check_stop, socket_)
+        check_stop()
+        await stop.wait()
+        for server in servers.values():
+            await server.close()
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        executor.shutdown()
+        loop.close()
+
+
+def _serve_loop(servers, shutdown_sockets, max_connections=0):
+    """Handle connections until one of ``shutdown_sockets`` is readable.
+
+    ``servers`` maps listening sockets to servers.
+
+    If ``max_connections`` is not ``0``, the loop also stops after this
+    number of connections was accepted.
+
+    """
+    sockets = list(servers.keys()) + list(shutdown_sockets)
+    select_timeout = None
+    if os.name == "nt":
+        # Fallback to busy waiting. (select.select blocks SIGINT on Windows.)
+        select_timeout = 1.0
+    while True:
+        try:
+            rlist, _, xlist = select.select(
+                sockets, [], sockets, select_timeout)
+        except (KeyboardInterrupt, select.error):
+            # SIGINT is handled by signal handler
+            rlist, xlist = [], []
+        if xlist:
+            raise RuntimeError("unhandled socket error")
+        if any(s in rlist for s in shutdown_sockets):
+            break
+        for socket_ in rlist:
+            server = servers.get(socket_)
+            if server:
+                # Don't block when another worker accepted the connection
+                server._handle_request_noblock()
+        if max_connections and sum(server.handled_connections
+                                   for server in servers.values()
+                                   ) >= max_connections:
+            break
+    for server in servers.values():
+        # Waits for the threads of active connections
+        server.server_close()
+
+
+def _shutdown_applications(applications):
+    """Wait for background tasks of the applications."""
+    for application in applications:
+        application.Collection.shutdown()
+
+
+def _serve_worker(serve_loop, servers, shutdown_socket, max_connections,
+                  applications=()):
+    """Run the main loop of a worker process.
+
+    The worker stops when the supervisor signals shutdown via
+    ``shutdown_socket``, when it receives SIGTERM or SIGINT itself or after
+    ``max_connections`` connections (if not ``0``). Active connections and
+    background tasks of ``applications`` are finished before the function
+    returns.
+
+    """
+    stop_socket_in, stop_socket_out = socket.socketpair()
+
+    def stop(*args):
+        stop_socket_in.sendall(b" ")
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    serve_loop(servers, [shutdown_socket, stop_socket_out], max_connections)
+    _shutdown_applications(applications)
+
+
 def serve(configuration):
     """Serve radicale from configuration."""
     logger.info("Starting Radicale")
@@ -202,8 +734,16 @@ def serve(configuration):
 
     # Create collection servers
     servers = {}
-    if configuration.getboolean("server", "ssl"):
+    if configuration.get("server", "type") == "asyncio":
+        server_class = AsyncioHTTPServer
+        serve_loop = _serve_asyncio_loop
+    elif configuration.getboolean("server", "ssl"):
         server_class = ParallelHTTPSServer
+        serve_loop = _serve_loop
+    else:
+        server_class = ParallelHTTPServer
+        serve_loop = _serve_loop
+    if configuration.getboolean("server", "ssl"):
         server_class.certificate = configuration.get("server", "certificate")
         server_class.key = configuration.get("server", "key")
         server_class.certificate_authority = configuration.get(
@@ -221,17 +761,17 @@ def serve(configuration):
             except OSError as e:
                 raise RuntimeError("Failed to read SSL %s %r: %s" %
                                    (name, filename, e)) from e
-    else:
-        server_class = ParallelHTTPServer
     server_class.client_timeout = configuration.getint("server", "timeout")
     server_class.max_connections = configuration.getint(
         "server", "max_connections")
 
     if not configuration.getboolean("server", "dns_lookup"):
         RequestHandler.address_string = lambda self: self.client_address[0]
+        AsyncioHTTPServer.dns_lookup = False
 
     shutdown_program = False
 
+    applications = []
     for host in configuration.get("server", "hosts").split(","):
         try:
             address, port = host.strip().rsplit(":", 1)
@@ -240,9 +780,13 @@ def serve(configuration):
             raise RuntimeError(
                 "Failed to parse address %r: %s" % (host, e)) from e
         application = Application(configuration)
+        applications.append(application)
         try:
-            server = wsgiref.simple_server.make_server(
-                address, port, application, server_class, RequestHandler)
+            if server_class is AsyncioHTTPServer:
+                server = server_class((address, port), application)
+            else:
+                server = wsgiref.simple_server.make_server(
+                    address, port, application, server_class, RequestHandler)
         except OSError as e:
             raise RuntimeError(
                 "Failed to start server %r: %s" % (host, e)) from e
@@ -268,25 +812,80 @@ def serve(configuration):
     signal.signal(signal.SIGTERM, shutdown)
     signal.signal(signal.SIGINT, shutdown)
 
-    # Main loop: wait for requests on any of the servers or program shutdown
-    sockets = list(servers.keys())
-    # Use socket pair to get notified of program shutdown
-    sockets.append(shutdown_program_socket_out)
-    select_timeout = None
-    if os.name == "nt":
-        # Fallback to busy waiting. (select.select blocks SIGINT on Windows.)
-        select_timeout = 1.0
-    logger.info("Radicale server ready")
-    while not shutdown_program:
+    if not hasattr(os, "fork"):
+        # Handle all connections in this process
+        logger.info("Radicale server ready")
+        serve_loop(servers, [shutdown_program_socket_out])
+        _shutdown_applications(applications)
+        return
+
+    # Start a pool of worker processes that accept connections on the
+    # listening sockets. Workers are long-lived, so that in-process caches
+    # survive between requests. They are replaced after handling
+    # ``max_worker_requests`` connections.
+    worker_count = (configuration.getint("server", "workers") or
+                    os.cpu_count() or 1)
+    max_worker_requests = configuration.getint(
+        "server", "max_worker_requests")
+    for server in servers.values():
+        # Another worker might accept the connection first
+        server.socket.setblocking(False)
+
+    # Create a socket pair to notify the select syscall of terminated workers
+    child_exit_socket_in, child_exit_socket_out = socket.socketpair()
+    child_exit_socket_in.setblocking(False)
+    child_exit_socket_out.setblocking(False)
+
+    def child_exit(*args):
         try:
-            rlist, _, xlist = select.select(
-                sockets, [], sockets, select_timeout)
+            child_exit_socket_in.send(b" ")
+        except BlockingIOError:
+            # A notification is already pending
+            pass
+    signal.signal(signal.SIGCHLD, child_exit)
+
+    workers = set()
+    logger.info("Radicale server ready (%d worker processes)", worker_count)
+    while True:
+        # Start new workers until the pool is complete
+        while not shutdown_program and len(workers) < worker_count:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    _serve_worker(serve_loop, servers,
+                                  shutdown_program_socket_out,
+                                  max_worker_requests, applications)
+                    status = 0
+                except BaseException as e:
+                    logger.error("An exception occurred in worker process: "
+                                 "%s", e, exc_info=True)
+                finally:
+                    os._exit(status)
+            logger.debug("Started worker process %d", pid)
+            workers.add(pid)
+        if shutdown_program and not workers:
+            break
+        try:
+            select.select([shutdown_program_socket_out,
+                           child_exit_socket_out], [], [])
         except (KeyboardInterrupt, select.error):
             # SIGINT is handled by signal handler above
-            rlist, xlist = [], []
-        if xlist:
-            raise RuntimeError("unhandled socket error")
-        if rlist:
-            server = servers.get(rlist[0])
-            if server:
-                server.handle_request()
+            pass
+        try:
+            while child_exit_socket_out.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        # Collect terminated workers
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG if not shutdown_program
+                                     else 0)
+            if pid == 0:
+                break
+            workers.discard(pid)
+            if status != 0:
+                logger.warning("Worker process %d terminated with status "
+                               "%d", pid, status)
+            else:
+                logger.debug("Worker process %d terminated", pid)
@@ -26,22 +26,31 @@ entry.
 """
 
 import binascii
+import bisect
 import contextlib
 import json
 import logging
+import mmap
 import os
 import pickle
 import posixpath
 import shlex
+import shutil
+import stat
+import struct
 import subprocess
+import sys
 import threading
 import time
+import zlib
+from collections import OrderedDict
 from contextlib import contextmanager
 from hashlib import md5
 from importlib import import_module
 from itertools import chain
 from random import getrandbits
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tempfile import (NamedTemporaryFile, SpooledTemporaryFile,
+                      TemporaryDirectory)
 
 import pkg_resources
 import vobject
@@ -54,7 +63,9 @@ if os.name == "nt":
     import ctypes.wintypes
     import msvcrt
 
+    LOCKFILE_FAIL_IMMEDIATELY = 1
     LOCKFILE_EXCLUSIVE_LOCK = 2
+    ERROR_LOCK_VIOLATION = 33
     if ctypes.sizeof(ctypes.c_void_p) == 4:
         ULONG_PTR = ctypes.c_uint32
     else:
@@ -85,9 +96,20 @@ if os.name == "nt":
         ctypes.wintypes.DWORD,
         ctypes.POINTER(Overlapped)]
     unlock_file_ex.restype = ctypes.wintypes.BOOL
+    syncfs = None
 elif os.name == "posix":
+    import ctypes
     import fcntl
 
+    # Sync all files of a file system at once (only available on Linux)
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (AttributeError, OSError):
+        syncfs = None
+    else:
+        syncfs.argtypes = [ctypes.c_int]
+        syncfs.restype = ctypes.c_int
+
 INTERNAL_TYPES = ("multifilesystem",)
 
 DEPS = ("radicale", "vobject", "python-dateutil",)
@@ -329,13 +351,16 @@ def is_safe_filesystem_path_component(path):
         is_safe_path_component(path))
 
 
-def path_to_filesystem(root, *paths):
+def path_to_filesystem(root, *paths, check_collisions=True):
     """Convert path to a local filesystem path relative to base_folder.
 
     `root` must be a secure filesystem path, it will be prepend to the path.
 
     Conversion of `paths` is done in a secure manner, or raises ``ValueError``.
 
+    If `check_collisions` is false, the parent directories are not scanned
+    for conflicting files (see ``filesystem_may_collide``).
+
     """
     paths = [sanitize_path(path).strip("/") for path in paths]
     safe_path = root
@@ -349,13 +374,35 @@ def path_to_filesystem(root, *paths):
             safe_path = os.path.join(safe_path, part)
             # Check for conflicting files (e.g. case-insensitive file systems
             # or short names on Windows file systems)
-            if (os.path.lexists(safe_path) and
+            if (check_collisions and os.path.lexists(safe_path) and
                     part not in (e.name for e in
                                  os.scandir(safe_path_parent))):
                 raise CollidingPathError(part)
     return safe_path
 
 
+def filesystem_may_collide(folder):
+    """Check if different file names can refer to the same file in `folder`.
+
+    This is the case on case-insensitive file systems, on file systems that
+    normalize Unicode and for short names on Windows file systems.
+
+    """
+    if os.name == "nt":
+        return True
+    try:
+        with TemporaryDirectory(prefix=".Radicale.tmp-", dir=folder) as tmp:
+            for name, other_name in (("a", "A"), ("\u00e9", "e\u0301")):
+                open(os.path.join(tmp, name), "w").close()
+                if os.path.lexists(os.path.join(tmp, other_name)):
+                    return True
+    except (OSError, ValueError) as e:
+        logger.debug("Failed to test file system of %r for colliding file "
+                     "names: %s", folder, e, exc_info=True)
+        return True
+    return False
+
+
 class UnsafePathError(ValueError):
     def __init__(self, path):
         message = "Can't translate name safely to filesystem: %r" % path
@@ -380,6 +427,13 @@ class ComponentNotFoundError(ValueError):
         super().__init__(message)
 
 
+class LockTimeoutError(RuntimeError):
+    def __init__(self, path, timeout):
+        message = "Timeout after %.3f seconds while locking %r" % (
+            timeout, path)
+        super().__init__(message)
+
+
 class Item:
     def __init__(self, collection_path=None, collection=None,
                  vobject_item=None, href=None, last_modified=None, text=None,
@@ -702,44 +756,17 @@ class BaseCollection:
 
     def serialize(self):
         """Get the unicode string representing the whole collection."""
+        return "".join(self.serialize_chunks())
+
+    def serialize_chunks(self):
+        """Get the unicode string representing the whole collection in
+        chunks.
+
+        Returns an iterable of strings. The storage must stay locked until
+        it's exhausted.
+
+        """
         if self.get_meta("tag") == "VCALENDAR":
-            in_vcalendar = False
-            vtimezones = ""
-            included_tzids = set()
-            vtimezone = []
-            tzid = None
-            components = ""
-            # Concatenate all child elements of VCALENDAR from all items
-            # together, while preventing duplicated VTIMEZONE entries.
-            # VTIMEZONEs are only distinguished by their TZID, if different
-            # timezones share the same TZID this produces errornous ouput.
-            # VObject fails at this too.
-            for item in self.get_all():
-                depth = 0
-                for line in item.serialize().split("\r\n"):
-                    if line.startswith("BEGIN:"):
-                        depth += 1
-                    if depth == 1 and line == "BEGIN:VCALENDAR":
-                        in_vcalendar = True
-                    elif in_vcalendar:
-                        if depth == 1 and line.startswith("END:"):
-                            in_vcalendar = False
-                        if depth == 2 and line == "BEGIN:VTIMEZONE":
-                            vtimezone.append(line + "\r\n")
-                        elif vtimezone:
-                            vtimezone.append(line + "\r\n")
-                            if depth == 2 and line.startswith("TZID:"):
-                                tzid = line[len("TZID:"):]
-                            elif depth == 2 and line.startswith("END:"):
-                                if tzid is None or tzid not in included_tzids:
-                                    vtimezones += "".join(vtimezone)
-                                    included_tzids.add(tzid)
-                                vtimezone.clear()
-                                tzid = None
-                        elif depth >= 2:
-                            components += line + "\r\n"
-                    if line.startswith("END:"):
-                        depth -= 1
             template = vobject.iCalendar()
             displayname = self.get_meta("D:displayname")
             if displayname:
@@ -754,35 +781,161 @@ class BaseCollection:
             template = template.serialize()
             template_insert_pos = template.find("\r\nEND:VCALENDAR\r\n") + 2
             assert template_insert_pos != -1
-            return (template[:template_insert_pos] +
-                    vtimezones + components +
-                    template[template_insert_pos:])
+            yield template[:template_insert_pos]
+            # Concatenate all child elements of VCALENDAR from all items
+            # together, while preventing duplicated VTIMEZONE entries.
+            # VTIMEZONEs are only distinguished by their TZID, if different
+            # timezones share the same TZID this produces errornous ouput.
+            # VObject fails at this too.
+            # The VTIMEZONEs must come first, they are collected in a
+            # separate pass over the items.
+            included_tzids = set()
+            for item in self.get_all():
+                text = item.serialize()
+                if "BEGIN:VTIMEZONE" not in text:
+                    continue
+                vtimezones, _ = self._split_vcalendar(text)
+                for tzid, vtimezone in vtimezones:
+                    if tzid is None or tzid not in included_tzids:
+                        included_tzids.add(tzid)
+                        yield vtimezone
+            for item in self.get_all():
+                _, components = self._split_vcalendar(item.serialize())
+                if components:
+                    yield components
+            yield template[template_insert_pos:]
         elif self.get_meta("tag") == "VADDRESSBOOK":
-            return "".join((item.serialize() for item in self.get_all()))
-        return ""
+            for item in self.get_all():
+                yield item.serialize()
+
+    @staticmethod
+    def _split_vcalendar(text):
+        """Split the child elements of VCALENDAR in ``text``.
+
+        Returns a tuple ``(vtimezones, components)``. ``vtimezones`` is a
+        list of ``(tzid, text)`` tuples and ``components`` contains the
+        other elements.
+
+        """
+        in_vcalendar = False
+        vtimezones = []
+        vtimezone = []
+        tzid = None
+        components = []
+        depth = 0
+        for line in text.split("\r\n"):
+            if line.startswith("BEGIN:"):
+                depth += 1
+            if depth == 1 and line == "BEGIN:VCALENDAR":
+                in_vcalendar = True
+            elif in_vcalendar:
+                if depth == 1 and line.startswith("END:"):
+                    in_vcalendar = False
+                if depth == 2 and line == "BEGIN:VTIMEZONE":
+                    vtimezone.append(line + "\r\n")
+                elif vtimezone:
+                    vtimezone.append(line + "\r\n")
+                    if depth == 2 and line.startswith("TZID:"):
+                        tzid = line[len("TZID:"):]
+                    elif depth == 2 and line.startswith("END:"):
+                        vtimezones.append((tzid, "".join(vtimezone)))
+                        vtimezone.clear()
+                        tzid = None
+                elif depth >= 2:
+                    components.append(line + "\r\n")
+            if line.startswith("END:"):
+                depth -= 1
+        return vtimezones, "".join(components)
+
+    def get_export(self, name, export):
+        """Get data that is derived from the whole collection (e.g. the
+        encoded result of ``serialize_chunks``).
+
+        ``name`` identifies the kind of data. ``export`` is called with a
+        binary file to write the data, if it's not cached. The data may be
+        cached until the etag of the collection changes.
+
+        Returns a binary file that is positioned at the start of the data.
+        The caller must close it, the file can be read after the storage
+        was unlocked.
+
+        """
+        f = SpooledTemporaryFile(max_size=1024 * 1024)
+        try:
+            export(f)
+            f.seek(0)
+        except BaseException:
+            f.close()
+            raise
+        return f
 
     @classmethod
     @contextmanager
-    def acquire_lock(cls, mode, user=None):
-        """Set a context manager to lock the whole storage.
+    def acquire_lock(cls, mode, user=None, paths=None, timeout=None):
+        """Set a context manager to lock the storage.
 
         ``mode`` must either be "r" for shared access or "w" for exclusive
         access.
 
         ``user`` is the name of the logged in user or empty.
 
+        ``paths`` is an iterable of the sanitized paths that are accessed.
+        Collections outside of the paths and their children must not be
+        accessed. The whole storage is locked if ``paths`` is ``None``.
+
+        ``timeout`` is the maximal time in seconds to wait for the lock or
+        ``None`` to wait indefinitely. ``LockTimeoutError`` is raised when
+        it's exceeded.
+
         """
         raise NotImplementedError
 
+    @classmethod
+    @contextmanager
+    def acquire_gc_lock(cls):
+        """Set a context manager to lock the whole storage for ``gc``.
+
+        Unlike ``acquire_lock`` in mode "w", the hook is not run, because
+        the garbage collection doesn't change the collections.
+
+        """
+        with cls.acquire_lock("w"):
+            yield
+
     @classmethod
     def verify(cls):
         """Check the storage for errors."""
         return True
 
+    @classmethod
+    def shutdown(cls):
+        """Wait for background tasks (e.g. the hook) before the process
+        exits."""
+
+    @classmethod
+    def gc(cls):
+        """Remove outdated data from the storage (e.g. from caches).
+
+        The storage must be locked with ``acquire_gc_lock``.
+
+        """
+
 
 class Collection(BaseCollection):
     """Collection stored in several files per calendar."""
 
+    # Set by ``static_init``
+    _filesystem_may_collide = True
+
+    # Maximum number of cache files (e.g. item caches) that are kept loaded,
+    # each mapped file might keep a file descriptor open (see ``RecordLog``)
+    _max_cache_files = 256
+    # Minimal age in seconds of item files for validating the item cache by
+    # the status of the files
+    _item_file_stat_min_age = 2
+    # Minimal age in seconds of left over temporary files that are removed
+    _tmp_file_min_age = 3600
+
     @classmethod
     def static_init(cls):
         # init storage lock
@@ -790,7 +943,46 @@ class Collection(BaseCollection):
             "storage", "filesystem_folder"))
         cls._makedirs_synced(folder)
         lock_path = os.path.join(folder, ".Radicale.lock")
-        cls._lock = FileBackedRwLock(lock_path)
+        cls._lock = FileBackedRwLock(lock_path, fair=True)
+        # Locks of the principal collections and their children
+        cls._principal_locks_folder = os.path.join(folder, ".Radicale.locks")
+        cls._makedirs_synced(cls._principal_locks_folder)
+        cls._principal_locks = {}
+        cls._principal_locks_lock = threading.Lock()
+        # The mode of the lock that is held by the current thread
+        cls._lock_state = threading.local()
+        # Scanning directories for colliding file names is expensive and
+        # only required on some file systems
+        cls._filesystem_may_collide = filesystem_may_collide(folder)
+        logger.debug("File names in storage folder %r may collide: %s",
+                     folder, cls._filesystem_may_collide)
+        cls._item_cache_validation = cls.configuration.get(
+            "storage", "item_cache_validation")
+        # Cache files of recently used collections, shared between requests
+        cls._cache_files = OrderedDict()
+        cls._cache_files_lock = threading.Lock()
+        # Recently used items, validated by the status of their files
+        cls._item_memory_cache = MemoryCache(cls.configuration.getint(
+            "storage", "item_memory_cache_size"))
+        # Runner of the hook in the background, the pending marker is
+        # shared between processes and only one process runs the hook
+        cls._hook_pending_path = os.path.join(cls._principal_locks_folder,
+                                              "hook.pending")
+        cls._hook_running_path = os.path.join(cls._principal_locks_folder,
+                                              "hook.running")
+        cls._hook_lock = FileBackedRwLock(os.path.join(
+            cls._principal_locks_folder, "hook.lock"))
+        # Held shared by writers and exclusively while the hook runs in the
+        # background, readers are not blocked by the hook
+        cls._hook_writers_lock = FileBackedRwLock(os.path.join(
+            cls._principal_locks_folder, "hook.writers"), fair=True)
+        cls._hook_thread = None
+        cls._hook_thread_lock = threading.Lock()
+
+    @classmethod
+    def _path_to_filesystem(cls, root, *paths):
+        return path_to_filesystem(
+            root, *paths, check_collisions=cls._filesystem_may_collide)
 
     def __init__(self, path, filesystem_path=None):
         folder = self._get_collection_root_folder()
@@ -798,13 +990,16 @@ class Collection(BaseCollection):
         self.path = sanitize_path(path).strip("/")
         self._encoding = self.configuration.get("encoding", "stock")
         if filesystem_path is None:
-            filesystem_path = path_to_filesystem(folder, self.path)
+            filesystem_path = self._path_to_filesystem(folder, self.path)
         self._filesystem_path = filesystem_path
         self._props_path = os.path.join(
             self._filesystem_path, ".Radicale.props")
         self._meta_cache = None
         self._etag_cache = None
+        self._item_cache = None
         self._item_cache_cleaned = False
+        self._journal = None
+        self._journal_verified = False
 
     @classmethod
     def _get_collection_root_folder(cls):
@@ -814,7 +1009,13 @@ class Collection(BaseCollection):
 
     @contextmanager
     def _atomic_write(self, path, mode="w", newline=None, sync_directory=True,
-                      replace_fn=os.replace):
+                      replace_fn=os.replace, sync_file=True):
+        """Write the file ``path`` atomically.
+
+        If ``sync_file`` is not set, the file must be synced with
+        ``_sync_folder_files`` before the folder becomes visible.
+
+        """
         directory = os.path.dirname(path)
         tmp = NamedTemporaryFile(
             mode=mode, dir=directory, delete=False, prefix=".Radicale.tmp-",
@@ -822,11 +1023,12 @@ class Collection(BaseCollection):
         try:
             yield tmp
             tmp.flush()
-            try:
-                self._fsync(tmp.fileno())
-            except OSError as e:
-                raise RuntimeError("Fsync'ing file %r failed: %s" %
-                                   (path, e)) from e
+            if sync_file:
+                try:
+                    self._fsync(tmp.fileno())
+                except OSError as e:
+                    raise RuntimeError("Fsync'ing file %r failed: %s" %
+                                       (path, e)) from e
             tmp.close()
             replace_fn(tmp.name, path)
         except BaseException:
@@ -864,6 +1066,45 @@ class Collection(BaseCollection):
                 raise RuntimeError("Fsync'ing directory %r failed: %s" %
                                    (path, e)) from e
 
+    @classmethod
+    def _sync_folder_files(cls, path):
+        """Sync the files in a folder and the folder itself to disk.
+
+        This is used for group commits of files that were written without
+        syncing them. The whole file system is synced with one ``syncfs``
+        call if available, otherwise the files are synced one after another.
+
+        """
+        if not cls.configuration.getboolean("internal", "filesystem_fsync"):
+            return
+        if syncfs is not None:
+            try:
+                fd = os.open(path, 0)
+                try:
+                    if syncfs(fd) != 0:
+                        errno = ctypes.get_errno()
+                        raise OSError(errno, os.strerror(errno))
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                raise RuntimeError("Syncing file system of %r failed: %s" %
+                                   (path, e)) from e
+            return
+        for entry in os.scandir(path):
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                fd = os.open(entry.path,
+                             os.O_RDWR | getattr(os, "O_BINARY", 0))
+                try:
+                    cls._fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                raise RuntimeError("Fsync'ing file %r failed: %s" %
+                                   (entry.path, e)) from e
+        cls._sync_directory(path)
+
     @classmethod
     def _makedirs_synced(cls, filesystem_path):
         """Recursively create a directory and its parents in a sync'ed way.
@@ -893,7 +1134,7 @@ class Collection(BaseCollection):
         # Create the root collection
         cls._makedirs_synced(folder)
         try:
-            filesystem_path = path_to_filesystem(folder, sane_path)
+            filesystem_path = cls._path_to_filesystem(folder, sane_path)
         except ValueError as e:
             # Path is unsafe
             logger.debug("Unsafe path %r requested from storage: %s",
@@ -963,7 +1204,6 @@ class Collection(BaseCollection):
             with exception_cm(path):
                 saved_item_errors = item_errors
                 collection = None
-                uids = set()
                 has_child_collections = False
                 for item in cls.discover(path, "1", exception_cm):
                     if not collection:
@@ -973,28 +1213,51 @@ class Collection(BaseCollection):
                     if isinstance(item, BaseCollection):
                         has_child_collections = True
                         remaining_paths.append(item.path)
-                    elif item.uid in uids:
-                        cls.logger.error(
-                            "Invalid item %r in %r: UID conflict %r",
-                            item.href, path.strip("/"), item.uid)
                     else:
-                        uids.add(item.uid)
                         logger.debug("Verified item %r in %r", item.href, path)
                 if item_errors == saved_item_errors:
                     collection.sync()
+                    with collection._acquire_index(UidIndex) as index:
+                        duplicates = index.duplicates()
+                    for uid, hrefs in sorted(duplicates.items()):
+                        for href in hrefs[1:]:
+                            item_errors += 1
+                            logger.error(
+                                "Invalid item %r in %r: UID conflict %r",
+                                href, path.strip("/"), uid)
                 if has_child_collections and collection.get_meta("tag"):
-                    cls.logger.error("Invalid collection %r: %r must not have "
-                                     "child collections", path.strip("/"),
-                                     collection.get_meta("tag"))
+                    collection_errors += 1
+                    logger.error("Invalid collection %r: %r must not have "
+                                 "child collections", path.strip("/"),
+                                 collection.get_meta("tag"))
         return item_errors == 0 and collection_errors == 0
 
+    @classmethod
+    def gc(cls):
+        # The collections are found by walking the folders, without loading
+        # any items
+        folder = cls._get_collection_root_folder()
+        cls._makedirs_synced(folder)
+        remaining_collections = [("", folder)]
+        while remaining_collections:
+            path, filesystem_path = remaining_collections.pop(0)
+            if path:
+                logger.debug("Garbage collecting collection %r", path)
+                cls(path, filesystem_path)._gc()
+            for entry in os.scandir(filesystem_path):
+                if (not entry.is_dir() or
+                        not is_safe_filesystem_path_component(entry.name)):
+                    continue
+                remaining_collections.append(
+                    (posixpath.join(path, entry.name), entry.path))
+
     @classmethod
     def create_collection(cls, href, items=None, props=None):
         folder = cls._get_collection_root_folder()
 
         # Path should already be sanitized
         sane_path = sanitize_path(href).strip("/")
-        filesystem_path = path_to_filesystem(folder, sane_path)
+        filesystem_path = cls._path_to_filesystem(folder, sane_path)
 
         if not props:
             cls._makedirs_synced(filesystem_path)
@@ -1010,12 +1273,17 @@ class Collection(BaseCollection):
             tmp_filesystem_path = os.path.join(tmp_dir, "collection")
             os.makedirs(tmp_filesystem_path)
             self = cls(sane_path, filesystem_path=tmp_filesystem_path)
-            self.set_meta(props)
+            with self._atomic_write(self._props_path, "w") as f:
+                json.dump(props, f, sort_keys=True)
+            state = {}
             if items is not None:
                 if props.get("tag") == "VCALENDAR":
-                    self._upload_all_nonatomic(items, suffix=".ics")
+                    state = self._upload_all_nonatomic(items, suffix=".ics")
                 elif props.get("tag") == "VADDRESSBOOK":
-                    self._upload_all_nonatomic(items, suffix=".vcf")
+                    state = self._upload_all_nonatomic(items, suffix=".vcf")
+            # The journal is created after all files are written, the
+            # status of the folder might not change with the uploads
+            self._create_journal(state)
 
             # This operation is not atomic on the filesystem level but it's
             # very unlikely that one rename operations succeeds while the
@@ -1031,12 +1299,13 @@ class Collection(BaseCollection):
         """Upload a new set of items.
 
         This takes a list of vobject items and
-        uploads them nonatomic and without existence checks.
+        uploads them nonatomic and without existence checks. The files are
+        synced as a group, the collection must not be visible yet.
+
+        Returns the etags of the uploaded items (``{href: etag}``).
 
         """
-        cache_folder = os.path.join(self._filesystem_path,
-                                    ".Radicale.cache", "item")
-        self._makedirs_synced(cache_folder)
+        cache_entries = []
         hrefs = set()
         for item in items:
             uid = item.uid
@@ -1067,7 +1336,7 @@ class Collection(BaseCollection):
                             raise UnsafePathError(href)
                         continue
                     try:
-                        return os.replace(source, path_to_filesystem(
+                        return os.replace(source, self._path_to_filesystem(
                             self._filesystem_path, href))
                     except OSError as e:
                         if href_candidates and (
@@ -1076,228 +1345,288 @@ class Collection(BaseCollection):
                             continue
                         raise
 
+            # The files are synced together at the end
             with self._atomic_write(os.path.join(self._filesystem_path, "ign"),
                                     newline="", sync_directory=False,
-                                    replace_fn=replace_fn) as f:
+                                    replace_fn=replace_fn,
+                                    sync_file=False) as f:
                 f.write(item.serialize())
             hrefs.add(href)
-            with self._atomic_write(os.path.join(cache_folder, href), "wb",
-                                    sync_directory=False) as f:
-                pickle.dump(cache_content, f)
-        self._sync_directory(cache_folder)
-        self._sync_directory(self._filesystem_path)
+            cache_entries.append((href, cache_content))
+        self._store_item_cache_entries(cache_entries)
+        self._sync_folder_files(self._filesystem_path)
+        return {href: content[2] for href, content in cache_entries}
 
     @classmethod
     def move(cls, item, to_collection, to_href):
         if not is_safe_filesystem_path_component(to_href):
             raise UnsafePathError(to_href)
+        item.collection._update_journal()
+        to_collection._update_journal()
         os.replace(
-            path_to_filesystem(item.collection._filesystem_path, item.href),
-            path_to_filesystem(to_collection._filesystem_path, to_href))
+            cls._path_to_filesystem(
+                item.collection._filesystem_path, item.href),
+            cls._path_to_filesystem(to_collection._filesystem_path, to_href))
         cls._sync_directory(to_collection._filesystem_path)
         if item.collection._filesystem_path != to_collection._filesystem_path:
             cls._sync_directory(item.collection._filesystem_path)
+        cls._item_memory_cache.pop(
+            (item.collection._filesystem_path, item.href))
+        cls._item_memory_cache.pop((to_collection._filesystem_path, to_href))
         # Move the item cache entry
-        cache_folder = os.path.join(item.collection._filesystem_path,
-                                    ".Radicale.cache", "item")
-        to_cache_folder = os.path.join(to_collection._filesystem_path,
-                                       ".Radicale.cache", "item")
-        cls._makedirs_synced(to_cache_folder)
-        try:
-            os.replace(os.path.join(cache_folder, item.href),
-                       os.path.join(to_cache_folder, to_href))
-        except FileNotFoundError:
-            pass
+        cache_entry = item.collection._get_item_cache().get(item.href)
+        if item.collection._filesystem_path == to_collection._filesystem_path:
+            item.collection._store_item_cache_entries(
+                [(item.href, None), (to_href, cache_entry)])
         else:
-            cls._makedirs_synced(to_cache_folder)
-            if cache_folder != to_cache_folder:
-                cls._makedirs_synced(cache_folder)
+            to_collection._store_item_cache_entries([(to_href, cache_entry)])
+            item.collection._store_item_cache_entries([(item.href, None)])
         # Track the change
-        to_collection._update_history_etag(to_href, item)
-        item.collection._update_history_etag(item.href, None)
-        to_collection._clean_history_cache()
-        if item.collection._filesystem_path != to_collection._filesystem_path:
-            item.collection._clean_history_cache()
+        if item.collection._filesystem_path == to_collection._filesystem_path:
+            to_collection._record_changes(
+                [(item.href, ""), (to_href, item.etag)])
+        else:
+            to_collection._record_changes([(to_href, item.etag)])
+            item.collection._record_changes([(item.href, "")])
+
+    def _folder_stat(self, check_age=False):
+        """Get the key for detecting changes of the collection folder.
+
+        If ``check_age`` is set, ``None`` is returned when the folder was
+        modified too recently, because later changes with the same
+        timestamp couldn't be detected.
 
-    @classmethod
-    def _clean_cache(cls, folder, names, max_age=None):
-        """Delete all ``names`` in ``folder`` that are older than ``max_age``.
         """
-        age_limit = time.time() - max_age if max_age is not None else None
-        modified = False
-        for name in names:
-            if not is_safe_filesystem_path_component(name):
-                continue
-            if age_limit is not None:
-                try:
-                    # Race: Another process might have deleted the file.
-                    mtime = os.path.getmtime(os.path.join(folder, name))
-                except FileNotFoundError:
-                    continue
-                if mtime > age_limit:
-                    continue
-            logger.debug("Found expired item in cache: %r", name)
-            # Race: Another process might have deleted or locked the
-            # file.
+        st = os.stat(self._filesystem_path)
+        if (check_age and
+                time.time() - st.st_mtime < self._item_file_stat_min_age):
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _load_journal(self):
+        if self._journal is None:
+            self._journal, _ = self._get_cache_file("journal", ChangeJournal)
+        self._journal.load()
+        return self._journal
+
+    def _update_journal(self, verify_items=True):
+        """Get the ``ChangeJournal`` of the collection.
+
+        The journal is created or updated by scanning all items, if the
+        collection folder was modified outside of Radicale.
+
+        Items that are edited in place don't modify the folder. Unless
+        ``item_cache_validation`` is ``stat``, the items are compared with
+        the journal once per instance, if ``verify_items`` is set.
+
+        """
+        journal = self._load_journal()
+        trust_folder = (not verify_items or self._journal_verified or
+                        self._item_cache_validation == "stat")
+        if (journal.journal_id is not None and
+                journal.folder_stat == self._folder_stat()):
+            if trust_folder:
+                return journal
+            state = {item.href: item.etag for item in self.get_all()}
+            if state == journal.state:
+                self._journal_verified = True
+                return journal
+        cache_folder = os.path.join(self._filesystem_path, ".Radicale.cache")
+        self._makedirs_synced(cache_folder)
+        with self._acquire_cache_lock("journal"):
+            journal.load()
+            folder_stat = self._folder_stat()
+            if (trust_folder and journal.journal_id is not None and
+                    journal.folder_stat == folder_stat):
+                return journal
+            folder_stat = self._folder_stat(check_age=True)
+            state = {item.href: item.etag for item in self.get_all()}
             try:
-                os.remove(os.path.join(folder, name))
-            except (FileNotFoundError, PermissionError):
-                continue
-            modified = True
-        if modified:
-            cls._sync_directory(folder)
+                if journal.journal_id is None:
+                    logger.debug("Creating journal of %r", self.path)
+                    journal.create(state, folder_stat, self._atomic_write)
+                    # Remove the history and sync tokens of older versions
+                    for name in ("history", "sync-token"):
+                        shutil.rmtree(os.path.join(cache_folder, name),
+                                      ignore_errors=True)
+                else:
+                    logger.debug("Updating journal of %r", self.path)
+                    journal.append_changes(chain(
+                        state.items(), ((href, "") for href in journal.state
+                                        if href not in state)),
+                        folder_stat, fsync=self._fsync)
+            except OSError as e:
+                raise RuntimeError("Failed to update journal of collection "
+                                   "%r: %s" % (self.path, e)) from e
+            self._store_summary(journal)
+        if verify_items:
+            self._journal_verified = True
+        return journal
 
-    def _update_history_etag(self, href, item):
-        """Updates and retrieves the history etag from the history cache.
+    def _verify_journal(self):
+        """Update the journal before the summary is used, if items that are
+        edited in place are only detected by their content."""
+        if self._item_cache_validation != "stat":
+            self._update_journal()
+
+    def _create_journal(self, state):
+        """Create the journal of a new collection with ``state``
+        (``{href: etag}``) and store the summary.
+
+        The collection must not be visible yet.
 
-        The history cache contains a file for each current and deleted item
-        of the collection. These files contain the etag of the item (empty
-        string for deleted items) and a history etag, which is a hash over
-        the previous history etag and the etag separated by "/".
         """
-        history_folder = os.path.join(self._filesystem_path,
-                                      ".Radicale.cache", "history")
+        journal = self._load_journal()
+        # The cache folder is created before recording the status of the
+        # collection folder
+        self._makedirs_synced(os.path.join(self._filesystem_path,
+                                           ".Radicale.cache"))
         try:
-            with open(os.path.join(history_folder, href), "rb") as f:
-                cache_etag, history_etag = pickle.load(f)
-        except (FileNotFoundError, pickle.UnpicklingError, ValueError) as e:
-            if isinstance(e, (pickle.UnpicklingError, ValueError)):
-                logger.warning(
-                    "Failed to load history cache entry %r in %r: %s",
-                    href, self.path, e, exc_info=True)
-            cache_etag = ""
-            # Initialize with random data to prevent collisions with cleaned
-            # expired items.
-            history_etag = binascii.hexlify(os.urandom(16)).decode("ascii")
-        etag = item.etag if item else ""
-        if etag != cache_etag:
-            self._makedirs_synced(history_folder)
-            history_etag = get_etag(history_etag + "/" + etag).strip("\"")
+            journal.create(state, self._folder_stat(), self._atomic_write)
+        except OSError as e:
+            raise RuntimeError("Failed to create journal of collection %r: "
+                               "%s" % (self.path, e)) from e
+        self._journal_verified = True
+        self._store_summary(journal)
+
+    def _record_changes(self, changes):
+        """Append ``changes`` (iterable of ``(href, etag)`` tuples, ``etag``
+        is empty for deleted items) to the journal.
+
+        The collection must be locked for writing and ``_update_journal``
+        must have been called before modifying the collection.
+
+        """
+        journal = self._load_journal()
+        # Readers of the root collection might update the journal
+        with self._acquire_cache_lock("journal"):
             try:
-                # Race: Other processes might have created and locked the file.
-                with self._atomic_write(os.path.join(history_folder, href),
-                                        "wb") as f:
-                    pickle.dump([etag, history_etag], f)
-            except PermissionError:
-                pass
-        return history_etag
+                # The status of the folder is recorded without checking its
+                # age, other processes must lock the collection for changing
+                # it.
+                journal.append_changes(changes, self._folder_stat(),
+                                       fsync=self._fsync)
+                journal.compact(self.configuration.getint(
+                    "storage", "max_sync_token_age"), self._atomic_write)
+            except OSError as e:
+                raise RuntimeError("Failed to update journal of collection "
+                                   "%r: %s" % (self.path, e)) from e
+            self._gc_if_due()
+            # Items are replaced atomically, which updates the modification
+            # time of the folder
+            summary = self._load_summary(valid_only=False)
+            last_modified = os.path.getmtime(self._filesystem_path)
+            if summary is not None:
+                last_modified = max(last_modified, summary[2])
+            self._store_summary(journal, last_modified)
+
+    def _load_summary(self, valid_only=True):
+        """Load the summary of the collection.
+
+        Returns a tuple ``(etag, sync_token, last_modified)`` or ``None`` if
+        it's missing or if ``valid_only`` is set and the collection folder
+        was modified since the summary was stored.
 
-    def _get_deleted_history_hrefs(self):
-        """Returns the hrefs of all deleted items that are still in the
-        history cache."""
-        history_folder = os.path.join(self._filesystem_path,
-                                      ".Radicale.cache", "history")
+        """
+        path = os.path.join(self._filesystem_path, ".Radicale.cache",
+                            "summary")
         try:
-            for entry in os.scandir(history_folder):
-                href = entry.name
-                if not is_safe_filesystem_path_component(href):
-                    continue
-                if os.path.isfile(os.path.join(self._filesystem_path, href)):
-                    continue
-                yield href
+            with open(path, "rb") as f:
+                folder_stat, summary = pickle.load(f)
         except FileNotFoundError:
-            pass
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError,
+                TypeError) as e:
+            logger.warning("Failed to load summary of collection %r: %s",
+                           self.path, e, exc_info=True)
+            return None
+        if valid_only and (folder_stat is None or
+                           folder_stat != self._folder_stat()):
+            return None
+        return summary
+
+    def _store_summary(self, journal, last_modified=None):
+        """Store the summary of the collection for the current state of
+        ``journal``.
 
-    def _clean_history_cache(self):
-        # Delete all expired cache entries of deleted items.
-        history_folder = os.path.join(self._filesystem_path,
-                                      ".Radicale.cache", "history")
-        self._clean_cache(history_folder, self._get_deleted_history_hrefs(),
-                          max_age=self.configuration.getint(
-                              "storage", "max_sync_token_age"))
+        ``last_modified`` is found by checking all items if it's ``None``.
+        The storage or the journal must be locked for writing.
+
+        """
+        etag = md5(journal.state_hash.to_bytes(16, "big"))
+        etag.update(json.dumps(self.get_meta(), sort_keys=True).encode())
+        journal_id, revision, _ = journal.changes_since(revision=None)
+        if last_modified is None:
+            relevant_files = chain(
+                (self._filesystem_path,),
+                (self._props_path,) if os.path.exists(self._props_path)
+                else (),
+                (os.path.join(self._filesystem_path, h) for h in self.list()))
+            last_modified = max(map(os.path.getmtime, relevant_files))
+        summary = ('"%s"' % etag.hexdigest(),
+                   self._sync_token(journal_id, revision), last_modified)
+        path = os.path.join(self._filesystem_path, ".Radicale.cache",
+                            "summary")
+        try:
+            with self._atomic_write(path, "wb") as f:
+                pickle.dump((journal.folder_stat, summary), f)
+        except OSError as e:
+            raise RuntimeError("Failed to store summary of collection %r: "
+                               "%s" % (self.path, e)) from e
+        return summary
+
+    def _get_summary(self):
+        """Get the summary of the collection (see ``_load_summary``)."""
+        self._verify_journal()
+        summary = self._load_summary()
+        if summary is None:
+            journal = self._update_journal()
+            with self._acquire_cache_lock("journal"):
+                summary = self._load_summary()
+                if summary is None:
+                    summary = self._store_summary(journal)
+        return summary
+
+    @staticmethod
+    def _sync_token(journal_id, revision):
+        return "http://radicale.org/ns/sync/%s-%d" % (journal_id, revision)
 
     def sync(self, old_token=None):
         # The sync token has the form http://radicale.org/ns/sync/TOKEN_NAME
-        # where TOKEN_NAME is the md5 hash of all history etags of present and
-        # past items of the collection.
-        def check_token_name(token_name):
-            if len(token_name) != 32:
-                return False
-            for c in token_name:
-                if c not in "0123456789abcdef":
-                    return False
-            return True
-
-        old_token_name = None
+        # where TOKEN_NAME is the identifier of the journal and the revision
+        # separated by "-".
+        old_journal_id = None
+        old_revision = 0
         if old_token:
             # Extract the token name from the sync token
             if not old_token.startswith("http://radicale.org/ns/sync/"):
                 raise ValueError("Malformed token: %r" % old_token)
             old_token_name = old_token[len("http://radicale.org/ns/sync/"):]
-            if not check_token_name(old_token_name):
+            old_journal_id, _, old_revision = old_token_name.partition("-")
+            if (len(old_journal_id) != 32 or
+                    old_journal_id.strip("0123456789abcdef") or
+                    not old_revision or
+                    old_revision.strip("0123456789")):
                 raise ValueError("Malformed token: %r" % old_token)
-        # Get the current state and sync-token of the collection.
-        state = {}
-        token_name_hash = md5()
-        # Find the history of all existing and deleted items
-        for href, item in chain(
-                ((item.href, item) for item in self.get_all()),
-                ((href, None) for href in self._get_deleted_history_hrefs())):
-            history_etag = self._update_history_etag(href, item)
-            state[href] = history_etag
-            token_name_hash.update((href + "/" + history_etag).encode("utf-8"))
-        token_name = token_name_hash.hexdigest()
-        token = "http://radicale.org/ns/sync/%s" % token_name
-        if token_name == old_token_name:
-            # Nothing changed
-            return token, ()
-        token_folder = os.path.join(self._filesystem_path,
-                                    ".Radicale.cache", "sync-token")
-        token_path = os.path.join(token_folder, token_name)
-        old_state = {}
-        if old_token_name:
-            # load the old token state
-            old_token_path = os.path.join(token_folder, old_token_name)
-            try:
-                # Race: Another process might have deleted the file.
-                with open(old_token_path, "rb") as f:
-                    old_state = pickle.load(f)
-            except (FileNotFoundError, pickle.UnpicklingError,
-                    ValueError) as e:
-                if isinstance(e, (pickle.UnpicklingError, ValueError)):
-                    logger.warning(
-                        "Failed to load stored sync token %r in %r: %s",
-                        old_token_name, self.path, e, exc_info=True)
-                    # Delete the damaged file
-                    try:
-                        os.remove(old_token_path)
-                    except (FileNotFoundError, PermissionError):
-                        pass
-                raise ValueError("Token not found: %r" % old_token)
-        # write the new token state or update the modification time of
-        # existing token state
-        if not os.path.exists(token_path):
-            self._makedirs_synced(token_folder)
-            try:
-                # Race: Other processes might have created and locked the file.
-                with self._atomic_write(token_path, "wb") as f:
-                    pickle.dump(state, f)
-            except PermissionError:
-                pass
-            else:
-                # clean up old sync tokens and item cache
-                self._clean_cache(token_folder, os.listdir(token_folder),
-                                  max_age=self.configuration.getint(
-                                      "storage", "max_sync_token_age"))
-                self._clean_history_cache()
-        else:
-            # Try to update the modification time
-            try:
-                # Race: Another process might have deleted the file.
-                os.utime(token_path)
-            except FileNotFoundError:
-                pass
-        changes = []
-        # Find all new, changed and deleted (that are still in the item cache)
-        # items
-        for href, history_etag in state.items():
-            if history_etag != old_state.get(href):
-                changes.append(href)
-        # Find all deleted items that are no longer in the item cache
-        for href, history_etag in old_state.items():
-            if href not in state:
-                changes.append(href)
-        return token, changes
+            old_revision = int(old_revision)
+        self._verify_journal()
+        summary = self._load_summary()
+        if summary is not None:
+            # Answer without loading the journal, if nothing changed or all
+            # items are requested (e.g. for the sync-token property)
+            token = summary[1]
+            if old_token == token:
+                return token, ()
+            if not old_token:
+                return token, self._list_from_journal()
+        journal_id, revision, changes = self._update_journal().changes_since(
+            old_journal_id, old_revision)
+        if changes is None:
+            raise ValueError("Token not found: %r" % old_token)
+        return self._sync_token(journal_id, revision), changes
+
+    def _list_from_journal(self):
+        yield from self._update_journal().changes_since()[2]
 
     def list(self):
         for entry in os.scandir(self._filesystem_path):
@@ -1316,67 +1645,260 @@ class Collection(BaseCollection):
         _hash.update(raw_text)
         return _hash.hexdigest()
 
-    def _item_cache_content(self, item, cache_hash=None):
+    def _item_cache_content(self, item, cache_hash=None, file_stat=None):
         text = item.serialize()
         if cache_hash is None:
             cache_hash = self._item_cache_hash(text.encode(self._encoding))
         return (cache_hash, item.uid, item.etag, text, item.name,
-                item.component_name, *item.time_range)
+                item.component_name, *item.time_range, file_stat)
+
+    def _get_cache_file(self, name, cache_class):
+        """Get the instance of ``cache_class`` for the file ``name`` in the
+        cache folder of the collection.
+
+        Instances are shared with other instances of the collection in this
+        process. Returns a tuple ``(cache, created)``.
+
+        """
+        path = os.path.join(self._filesystem_path, ".Radicale.cache", name)
+        with self._cache_files_lock:
+            cache = self._cache_files.pop(path, None)
+            created = cache is None
+            if created:
+                cache = cache_class(path)
+            self._cache_files[path] = cache
+            while len(self._cache_files) > self._max_cache_files:
+                self._cache_files.popitem(last=False)
+        return cache, created
+
+    def _get_item_cache(self):
+        """Get the ``ItemCache`` of the collection.
+
+        The cache is loaded once per instance. Caches are shared with other
+        instances of the collection in this process.
 
-    def _store_item_cache(self, href, item, cache_hash=None):
+        """
+        if self._item_cache is None:
+            cache, created = self._get_cache_file("items", ItemCache)
+            cache.load()
+            self._item_cache = cache
+            if created:
+                self._migrate_item_cache()
+        return self._item_cache
+
+    def _migrate_item_cache(self):
+        """Import the item cache from the old layout with one file per
+        item."""
         cache_folder = os.path.join(self._filesystem_path, ".Radicale.cache",
                                     "item")
-        content = self._item_cache_content(item, cache_hash)
-        self._makedirs_synced(cache_folder)
-        try:
-            # Race: Other processes might have created and locked the
-            # file.
-            with self._atomic_write(os.path.join(cache_folder, href),
-                                    "wb") as f:
-                pickle.dump(content, f)
-        except PermissionError:
-            pass
+        if not os.path.isdir(cache_folder):
+            return
+        with self._acquire_cache_lock("item"):
+            cache = self._get_item_cache()
+            cache.load()
+            cache_entries = []
+            try:
+                for entry in os.scandir(cache_folder):
+                    href = entry.name
+                    if (not is_safe_filesystem_path_component(href) or
+                            cache.get(href) is not None):
+                        continue
+                    try:
+                        with open(entry.path, "rb") as f:
+                            cache_entry = tuple(pickle.load(f))
+                        if len(cache_entry) != 8:
+                            raise ValueError("invalid entry")
+                        cache_entry += (None,)
+                    except (pickle.UnpicklingError, ValueError,
+                            TypeError) as e:
+                        logger.warning(
+                            "Failed to load item cache entry %r in %r: %s",
+                            href, self.path, e, exc_info=True)
+                        continue
+                    cache_entries.append((href, cache_entry))
+            except FileNotFoundError:
+                # Race: Another process migrated the cache
+                return
+            logger.debug("Migrating %d item cache entries in %r",
+                         len(cache_entries), self.path)
+            self._store_item_cache_entries(cache_entries)
+            shutil.rmtree(cache_folder, ignore_errors=True)
+
+    def _store_item_cache_entries(self, cache_entries):
+        """Store ``cache_entries`` (iterable of ``(href, content)``) in the
+        item cache.
+
+        ``content`` is the result of ``_item_cache_content`` or ``None`` to
+        remove the entry.
+
+        """
+        cache = self._get_item_cache()
+        self._makedirs_synced(os.path.dirname(cache.path))
+        with self._acquire_cache_lock("item"):
+            try:
+                cache.store(cache_entries, fsync=self._fsync,
+                            atomic_write=self._atomic_write)
+            except OSError as e:
+                raise RuntimeError("Failed to store item cache of collection "
+                                   "%r: %s" % (self.path, e)) from e
+
+    def _store_item_cache(self, href, item, cache_hash=None, file_stat=None):
+        content = self._item_cache_content(item, cache_hash, file_stat)
+        self._store_item_cache_entries([(href, content)])
         return content
 
+    @contextmanager
     def _acquire_cache_lock(self, ns=""):
-        if self._lock.locked == "w":
-            return contextlib.ExitStack()
+        """Lock the cache files ``ns`` of the collection for writing.
+
+        The lock is only skipped if the whole storage is locked exclusively.
+        Writers of a principal collection must lock the caches too, because
+        readers of the root collection might update them. The lock can be
+        acquired again by the same thread.
+
+        """
+        if self._storage_locked == "w":
+            yield
+            return
         cache_folder = os.path.join(self._filesystem_path, ".Radicale.cache")
-        self._makedirs_synced(cache_folder)
         lock_path = os.path.join(cache_folder,
                                  ".Radicale.lock" + (".%s" % ns if ns else ""))
-        lock = FileBackedRwLock(lock_path)
-        return lock.acquire("w")
+        held_locks = self._lock_state.__dict__.setdefault("cache_locks",
+                                                          set())
+        if lock_path in held_locks:
+            yield
+            return
+        self._makedirs_synced(cache_folder)
+        # The deadline of the request also applies to the cache locks
+        deadline = getattr(self._lock_state, "deadline", None)
+        with FileBackedRwLock(lock_path).acquire("w", deadline):
+            held_locks.add(lock_path)
+            try:
+                yield
+            finally:
+                held_locks.discard(lock_path)
+
+    def get_export(self, name, export):
+        # The files are named after the etag of the collection, exports for
+        # other etags are outdated. The etag follows items that are edited
+        # in place, unless ``item_cache_validation`` is ``stat`` (see
+        # ``_update_journal``).
+        etag = self.etag.strip('"')
+        filename = "%s-%s" % (etag, md5(name.encode()).hexdigest())
+        folder = os.path.join(self._filesystem_path, ".Radicale.cache",
+                              "export")
+        path = os.path.join(folder, filename)
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            pass
+        self._makedirs_synced(folder)
+        with self._acquire_cache_lock("export"):
+            try:
+                return open(path, "rb")
+            except FileNotFoundError:
+                pass
+            logger.debug("Exporting %r to %r", self.path, path)
+            try:
+                with self._atomic_write(path, "wb") as f:
+                    export(f)
+                for entry in os.scandir(folder):
+                    if not entry.name.startswith(etag + "-"):
+                        try:
+                            os.remove(entry.path)
+                        except OSError as e:
+                            # The file might be removed by another process
+                            # or still be open (e.g. on Windows)
+                            logger.debug("Failed to remove outdated export "
+                                         "%r: %s", entry.path, e)
+            except OSError as e:
+                raise RuntimeError("Failed to export collection %r: %s" %
+                                   (self.path, e)) from e
+            return open(path, "rb")
 
-    def _load_item_cache(self, href, input_hash):
-        cache_folder = os.path.join(self._filesystem_path, ".Radicale.cache",
-                                    "item")
-        cache_hash = uid = etag = text = name = tag = start = end = None
+    def _gc_if_due(self):
+        """Run ``_gc`` if the last run is longer ago than ``gc_interval``.
+
+        The time of the last run is the modification time of a file in the
+        cache folder, checking it costs a single ``stat`` per change.
+
+        """
+        interval = self.configuration.getint("storage", "gc_interval")
+        if not interval:
+            return
+        path = os.path.join(self._filesystem_path, ".Radicale.cache", "gc")
         try:
-            with open(os.path.join(cache_folder, href), "rb") as f:
-                cache_hash, *content = pickle.load(f)
-                if cache_hash == input_hash:
-                    uid, etag, text, name, tag, start, end = content
-        except FileNotFoundError as e:
+            if time.time() - os.path.getmtime(path) < interval:
+                return
+        except FileNotFoundError:
             pass
-        except (pickle.UnpicklingError, ValueError) as e:
-            logger.warning("Failed to load item cache entry %r in %r: %s",
-                           href, self.path, e, exc_info=True)
-        return cache_hash, uid, etag, text, name, tag, start, end
+        self._gc()
+        with open(path, "w"):
+            pass
+
+    def _gc(self):
+        """Remove outdated data of the collection.
+
+        This compacts the journal and the item cache and removes temporary
+        files that were left over by crashed processes. The storage must be
+        locked for writing.
+
+        """
+        journal = self._update_journal(verify_items=False)
+        with self._acquire_cache_lock("journal"):
+            try:
+                journal.compact(self.configuration.getint(
+                    "storage", "max_sync_token_age"), self._atomic_write,
+                    force=True)
+            except OSError as e:
+                raise RuntimeError("Failed to compact journal of collection "
+                                   "%r: %s" % (self.path, e)) from e
+        self._clean_item_cache()
+        age_limit = time.time() - self._tmp_file_min_age
+        for entry in os.scandir(self._filesystem_path):
+            if (not entry.name.startswith(".Radicale.tmp-") or
+                    entry.stat(follow_symlinks=False).st_mtime > age_limit):
+                continue
+            logger.debug("Removing temporary file %r", entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _load_item_cache(self, href, input_hash):
+        content = self._get_item_cache().get(href)
+        if content is None or content[0] != input_hash:
+            return None
+        return content
 
     def _clean_item_cache(self):
-        cache_folder = os.path.join(self._filesystem_path, ".Radicale.cache",
-                                    "item")
-        self._clean_cache(cache_folder, (
-            e.name for e in os.scandir(cache_folder) if not
-            os.path.isfile(os.path.join(self._filesystem_path, e.name))))
+        cache = self._get_item_cache()
+        with self._acquire_cache_lock("item"):
+            hrefs = set(self.list())
+            if not hrefs.issuperset(cache.hrefs()):
+                cache.compact(self._atomic_write, keep=hrefs)
+
+    def _item_file_stat(self, st):
+        """Get the key for validating the item cache from ``os.stat_result``.
+
+        Returns ``None`` if the file was modified too recently, because
+        later changes with the same timestamps couldn't be detected.
+
+        """
+        if (time.time() - max(st.st_mtime, st.st_ctime) <
+                self._item_file_stat_min_age):
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
 
     def get(self, href, verify_href=True):
         if verify_href:
             try:
                 if not is_safe_filesystem_path_component(href):
                     raise UnsafePathError(href)
-                path = path_to_filesystem(self._filesystem_path, href)
+                path = self._path_to_filesystem(self._filesystem_path, href)
             except ValueError as e:
                 logger.debug(
                     "Can't translate name %r safely to filesystem in %r: %s",
@@ -1384,9 +1906,33 @@ class Collection(BaseCollection):
                 return None
         else:
             path = os.path.join(self._filesystem_path, href)
+        validate_stat = self._item_cache_validation == "stat"
+        if validate_stat:
+            # Use the cache entry without reading the file, if the status of
+            # the file didn't change
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return None
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            file_stat = self._item_file_stat(st)
+            if file_stat is not None:
+                memory_key = (self._filesystem_path, href)
+                content = self._item_memory_cache.get(memory_key)
+                if content is None or content[8] != file_stat:
+                    content = self._get_item_cache().get(href)
+                    if content is None or content[8] != file_stat:
+                        content = None
+                    else:
+                        self._item_memory_cache.put(
+                            memory_key, content, len(content[3]))
+                if content is not None:
+                    return self._item_from_cache_content(href, content, st)
         try:
             with open(path, "rb") as f:
                 raw_text = f.read()
+                st = os.fstat(f.fileno())
         except (FileNotFoundError, IsADirectoryError):
             return None
         except PermissionError:
@@ -1395,21 +1941,27 @@ class Collection(BaseCollection):
                     os.path.isdir(path) and os.access(path, os.R_OK)):
                 return None
             raise
+        file_stat = self._item_file_stat(st) if validate_stat else None
         # The hash of the component in the file system. This is used to check,
         # if the entry in the cache is still valid.
         input_hash = self._item_cache_hash(raw_text)
-        cache_hash, uid, etag, text, name, tag, start, end = \
-            self._load_item_cache(href, input_hash)
-        if input_hash != cache_hash:
+        content = self._load_item_cache(href, input_hash)
+        if content is None or file_stat not in (None, content[8]):
             with self._acquire_cache_lock("item"):
                 # Lock the item cache to prevent multpile processes from
                 # generating the same data in parallel.
                 # This improves the performance for multiple requests.
-                if self._lock.locked == "r":
-                    # Check if another process created the file in the meantime
-                    cache_hash, uid, etag, text, name, tag, start, end = \
-                        self._load_item_cache(href, input_hash)
-                if input_hash != cache_hash:
+                if self._storage_locked != "w":
+                    # Check if another process created the entry in the
+                    # meantime
+                    self._get_item_cache().load()
+                    content = self._load_item_cache(href, input_hash)
+                if content is not None:
+                    if file_stat not in (None, content[8]):
+                        # Only the status of the file changed
+                        content = content[:8] + (file_stat,)
+                        self._store_item_cache_entries([(href, content)])
+                else:
                     try:
                         vobject_items = tuple(vobject.readComponents(
                             raw_text.decode(self._encoding)))
@@ -1418,9 +1970,8 @@ class Collection(BaseCollection):
                         vobject_item, = vobject_items
                         temp_item = Item(collection=self,
                                          vobject_item=vobject_item)
-                        cache_hash, uid, etag, text, name, tag, start, end = \
-                            self._store_item_cache(
-                                href, temp_item, input_hash)
+                        content = self._store_item_cache(
+                            href, temp_item, input_hash, file_stat)
                     except Exception as e:
                         raise RuntimeError("Failed to load item %r in %r: %s" %
                                            (href, self.path, e)) from e
@@ -1429,9 +1980,15 @@ class Collection(BaseCollection):
                     if not self._item_cache_cleaned:
                         self._item_cache_cleaned = True
                         self._clean_item_cache()
-        last_modified = time.strftime(
-            "%a, %d %b %Y %H:%M:%S GMT",
-            time.gmtime(os.path.getmtime(path)))
+        if file_stat is not None:
+            self._item_memory_cache.put((self._filesystem_path, href),
+                                        content, len(content[3]))
+        return self._item_from_cache_content(href, content, st)
+
+    def _item_from_cache_content(self, href, content, st):
+        _, uid, etag, text, name, tag, start, end, _ = content
+        last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                      time.gmtime(st.st_mtime))
         # Don't keep reference to ``vobject_item``, because it requires a lot
         # of memory.
         return Item(
@@ -1444,13 +2001,14 @@ class Collection(BaseCollection):
         # we only need to call os.listdir once.
         files = None
         for href in hrefs:
-            if files is None:
+            if files is None and self._filesystem_may_collide:
                 # List dir after hrefs returned one item, the iterator may be
                 # empty and the for-loop is never executed.
                 files = os.listdir(self._filesystem_path)
             path = os.path.join(self._filesystem_path, href)
             if (not is_safe_filesystem_path_component(href) or
-                    href not in files and os.path.lexists(path)):
+                    files is not None and href not in files and
+                    os.path.lexists(path)):
                 logger.debug(
                     "Can't translate name safely to filesystem: %r", href)
                 yield (href, None)
@@ -1462,6 +2020,50 @@ class Collection(BaseCollection):
         # are from os.listdir.
         return (self.get(href, verify_href=False) for href in self.list())
 
+    @contextmanager
+    def _acquire_index(self, index_class):
+        """Get the index ``index_class`` (subclass of ``ItemIndex``) of the
+        items.
+
+        Indexes are kept with the journal and updated with its changes. The
+        index must only be used in the context.
+
+        """
+        journal = self._update_journal()
+        item_cache = self._get_item_cache()
+        item_cache.load()
+        with journal.indexes_lock:
+            journal_id, revision, index = journal.indexes.get(
+                index_class, (None, 0, None))
+            journal_id, revision, complete, etags = journal.changed_etags(
+                journal_id, revision)
+            if complete:
+                index = index_class()
+            for href, etag in etags.items():
+                if not etag:
+                    index.remove(href)
+                    continue
+                meta = item_cache.get_meta(href)
+                index.add(href, etag, meta if meta and meta[2] == etag
+                          else None)
+            # Promote unknown items that were loaded in the meantime
+            for href, etag in list(index.unknown.items()):
+                meta = item_cache.get_meta(href)
+                if meta and meta[2] == etag:
+                    index.add(href, etag, meta)
+            journal.indexes[index_class] = (journal_id, revision, index)
+            yield index
+
+    def has_uid(self, uid):
+        with self._acquire_index(UidIndex) as index:
+            if index.find(uid):
+                return True
+            unknown = sorted(index.unknown)
+        for item in (self.get(h, verify_href=False) for h in unknown):
+            if item is not None and item.uid == uid:
+                return True
+        return False
+
     def get_all_filtered(self, filters):
         tag, start, end, simple = xmlutils.simplify_prefilters(
             filters, collection_tag=self.get_meta("tag"))
@@ -1469,7 +2071,12 @@ class Collection(BaseCollection):
             # no filter
             yield from ((item, simple) for item in self.get_all())
             return
-        for item in (self.get(h, verify_href=False) for h in self.list()):
+        with self._acquire_index(TimeRangeIndex) as index:
+            hrefs = index.find(tag, start, end)
+        for item in (self.get(h, verify_href=False) for h in sorted(hrefs)):
+            if item is None:
+                # Race: The item was deleted outside of Radicale
+                continue
             istart, iend = item.time_range
             if tag == item.component_name and istart < end and iend > start:
                 yield item, simple and (start <= istart or iend <= end)
@@ -1477,20 +2084,20 @@ class Collection(BaseCollection):
     def upload(self, href, item):
         if not is_safe_filesystem_path_component(href):
             raise UnsafePathError(href)
+        self._item_memory_cache.pop((self._filesystem_path, href))
+        self._update_journal()
         try:
-            self._store_item_cache(href, item)
+            cache_content = self._item_cache_content(item)
         except Exception as e:
             raise ValueError("Failed to store item %r in collection %r: %s" %
                              (href, self.path, e)) from e
-        path = path_to_filesystem(self._filesystem_path, href)
+        # Errors of the cache lock (e.g. ``LockTimeoutError``) are passed on
+        self._store_item_cache_entries([(href, cache_content)])
+        path = self._path_to_filesystem(self._filesystem_path, href)
         with self._atomic_write(path, newline="") as fd:
             fd.write(item.serialize())
-        # Clean the cache after the actual item is stored, or the cache entry
-        # will be removed again.
-        self._clean_item_cache()
         # Track the change
-        self._update_history_etag(href, item)
-        self._clean_history_cache()
+        self._record_changes([(href, item.etag)])
         return self.get(href, verify_href=False)
 
     def delete(self, href=None):
@@ -1511,18 +2118,20 @@ class Collection(BaseCollection):
             # Delete an item
             if not is_safe_filesystem_path_component(href):
                 raise UnsafePathError(href)
-            path = path_to_filesystem(self._filesystem_path, href)
+            path = self._path_to_filesystem(self._filesystem_path, href)
             if not os.path.isfile(path):
                 raise ComponentNotFoundError(href)
+            self._update_journal()
             os.remove(path)
             self._sync_directory(os.path.dirname(path))
+            self._item_memory_cache.pop((self._filesystem_path, href))
+            self._store_item_cache_entries([(href, None)])
             # Track the change
-            self._update_history_etag(href, None)
-            self._clean_history_cache()
+            self._record_changes([(href, "")])
 
     def get_meta(self, key=None):
         # reuse cached value if the storage is read-only
-        if self._lock.locked == "w" or self._meta_cache is None:
+        if self._locked == "w" or self._meta_cache is None:
             try:
                 try:
                     with open(self._props_path, encoding=self._encoding) as f:
@@ -1536,57 +2145,239 @@ class Collection(BaseCollection):
         return self._meta_cache.get(key) if key else self._meta_cache
 
     def set_meta(self, props):
+        self._update_journal()
         with self._atomic_write(self._props_path, "w") as f:
             json.dump(props, f, sort_keys=True)
+        # Track the change of the collection folder
+        self._record_changes(())
 
     @property
     def last_modified(self):
-        relevant_files = chain(
-            (self._filesystem_path,),
-            (self._props_path,) if os.path.exists(self._props_path) else (),
-            (os.path.join(self._filesystem_path, h) for h in self.list()))
-        last = max(map(os.path.getmtime, relevant_files))
+        last = self._get_summary()[2]
         return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(last))
 
     @property
     def etag(self):
         # reuse cached value if the storage is read-only
-        if self._lock.locked == "w" or self._etag_cache is None:
-            self._etag_cache = super().etag
+        if self._locked == "w" or self._etag_cache is None:
+            self._etag_cache = self._get_summary()[0]
         return self._etag_cache
 
+    @property
+    def _locked(self):
+        """The mode of the lock that is held by the current thread."""
+        return getattr(self._lock_state, "mode", "")
+
+    @property
+    def _storage_locked(self):
+        """The mode of the storage lock that is held by the current
+        thread."""
+        return getattr(self._lock_state, "storage_mode", "")
+
+    @classmethod
+    def _get_principal_lock(cls, principal):
+        with cls._principal_locks_lock:
+            lock = cls._principal_locks.get(principal)
+            if lock is None:
+                # The name of the principal might not be safe or collide
+                # on the file system
+                lock = FileBackedRwLock(os.path.join(
+                    cls._principal_locks_folder,
+                    md5(principal.encode()).hexdigest()), fair=True)
+                cls._principal_locks[principal] = lock
+            return lock
+
     @classmethod
     @contextmanager
-    def acquire_lock(cls, mode, user=None):
-        with cls._lock.acquire(mode):
+    def acquire_lock(cls, mode, user=None, paths=None, timeout=None):
+        deadline = time.monotonic() + timeout if timeout else None
+        with cls._acquire_locks(mode, paths, deadline):
             yield
-            # execute hook
-            hook = cls.configuration.get("storage", "hook")
-            if mode == "w" and hook:
-                folder = os.path.expanduser(cls.configuration.get(
-                    "storage", "filesystem_folder"))
-                logger.debug("Running hook")
-                debug = logger.isEnabledFor(logging.DEBUG)
-                p = subprocess.Popen(
-                    hook % {"user": shlex.quote(user or "Anonymous")},
-                    stdin=subprocess.DEVNULL,
-                    stdout=subprocess.PIPE if debug else subprocess.DEVNULL,
-                    stderr=subprocess.PIPE if debug else subprocess.DEVNULL,
-                    shell=True, universal_newlines=True, cwd=folder)
-                stdout_data, stderr_data = p.communicate()
-                if stdout_data:
-                    logger.debug("Captured stdout hook:\n%s", stdout_data)
-                if stderr_data:
-                    logger.debug("Captured stderr hook:\n%s", stderr_data)
-                if p.returncode != 0:
-                    raise subprocess.CalledProcessError(p.returncode, p.args)
+        # execute hook
+        hook = cls.configuration.get("storage", "hook")
+        if mode == "w" and hook:
+            if cls.configuration.getboolean("storage", "hook_background"):
+                cls._schedule_hook(user)
+                return
+            # Wait for other requests, the hook should see a consistent state
+            with cls._lock.acquire("w", deadline):
+                cls._run_hook(hook, user)
+
+    @classmethod
+    @contextmanager
+    def acquire_gc_lock(cls):
+        with cls._acquire_locks("w"):
+            yield
+
+    @classmethod
+    @contextmanager
+    def _acquire_locks(cls, mode, paths=None, deadline=None):
+        """Lock the storage like ``acquire_lock`` without running the
+        hook.
+
+        ``deadline`` is a value of ``time.monotonic`` after which
+        ``LockTimeoutError`` is raised. It also applies to the cache locks
+        that are acquired in the context.
+
+        """
+        # The storage lock is held shared while the affected principal
+        # collections are locked in ``mode`` (in sorted order to prevent
+        # deadlocks). Requests on the root collection and requests without
+        # ``paths`` lock the storage in ``mode`` or exclusively.
+        if paths is None:
+            storage_mode, principals = "w", ()
+        else:
+            principals = {sanitize_path(path).strip("/").split("/")[0]
+                          for path in paths}
+            if "" in principals:
+                storage_mode, principals = mode, ()
+            else:
+                storage_mode, principals = "r", sorted(principals)
+        hook = cls.configuration.get("storage", "hook")
+        hook_background = cls.configuration.getboolean("storage",
+                                                       "hook_background")
+        with contextlib.ExitStack() as lock_stack:
+            if mode == "w" and hook and hook_background:
+                lock_stack.enter_context(cls._hook_writers_lock.acquire(
+                    "r", deadline))
+            lock_stack.enter_context(cls._lock.acquire(storage_mode,
+                                                       deadline))
+            for principal in principals:
+                lock_stack.enter_context(
+                    cls._get_principal_lock(principal).acquire(mode,
+                                                               deadline))
+            cls._lock_state.mode = mode
+            cls._lock_state.storage_mode = storage_mode
+            cls._lock_state.deadline = deadline
+            try:
+                yield
+            finally:
+                cls._lock_state.mode = ""
+                cls._lock_state.storage_mode = ""
+                cls._lock_state.deadline = None
+
+    @classmethod
+    def _schedule_hook(cls, user):
+        """Mark the hook as pending and start the runner if required."""
+        with open(cls._hook_pending_path, "w", encoding="utf-8") as f:
+            f.write(user or "")
+        cls._start_hook_runner()
+
+    @classmethod
+    def _start_hook_runner(cls):
+        with cls._hook_thread_lock:
+            if cls._hook_thread is None:
+                cls._hook_thread = threading.Thread(
+                    target=cls._hook_runner, daemon=True)
+                cls._hook_thread.start()
+
+    @classmethod
+    def _hook_is_pending(cls):
+        return (os.path.exists(cls._hook_pending_path) or
+                os.path.exists(cls._hook_running_path))
+
+    @classmethod
+    def _hook_runner(cls):
+        """Run the hook until no changes are pending.
+
+        Changes that are scheduled while the hook runs are handled by a
+        single additional run. If another process holds the runner lock, it
+        will find the pending marker after releasing the lock.
+
+        The pending marker is renamed while the hook runs and only removed
+        after the hook succeeded. It's restored if the hook fails and it's
+        picked up by the next runner if the process was terminated.
+
+        Writers are blocked while the hook runs, readers continue.
+
+        """
+        hook = cls.configuration.get("storage", "hook")
+        while True:
+            retry = False
+            try:
+                with cls._hook_lock.acquire("w", time.monotonic()):
+                    while True:
+                        try:
+                            os.replace(cls._hook_pending_path,
+                                       cls._hook_running_path)
+                        except FileNotFoundError:
+                            # Continue an interrupted run
+                            if not os.path.exists(cls._hook_running_path):
+                                retry = True
+                                break
+                        with open(cls._hook_running_path,
+                                  encoding="utf-8") as f:
+                            user = f.read()
+                        start = time.monotonic()
+                        try:
+                            # The hook should see a consistent state, only
+                            # writers are blocked
+                            with cls._hook_writers_lock.acquire("w"):
+                                cls._run_hook(hook, user)
+                        except Exception as e:
+                            logger.error("Hook failed: %s", e, exc_info=True)
+                            # Keep the marker, the hook is run again after
+                            # the next change
+                            if os.path.exists(cls._hook_pending_path):
+                                os.remove(cls._hook_running_path)
+                            else:
+                                os.replace(cls._hook_running_path,
+                                           cls._hook_pending_path)
+                            break
+                        os.remove(cls._hook_running_path)
+                        logger.debug("Hook finished in %.3f seconds",
+                                     time.monotonic() - start)
+            except LockTimeoutError:
+                # The hook is run by another process
+                pass
+            except Exception as e:
+                logger.error("Failed to run hook: %s", e, exc_info=True)
+            with cls._hook_thread_lock:
+                if not retry or not cls._hook_is_pending():
+                    cls._hook_thread = None
+                    return
+
+    @classmethod
+    def shutdown(cls):
+        thread = cls._hook_thread
+        while thread:
+            thread.join()
+            thread = cls._hook_thread
+
+    @classmethod
+    def _run_hook(cls, hook, user):
+        folder = os.path.expanduser(cls.configuration.get(
+            "storage", "filesystem_folder"))
+        logger.debug("Running hook")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        p = subprocess.Popen(
+            hook % {"user": shlex.quote(user or "Anonymous")},
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE if debug else subprocess.DEVNULL,
+            stderr=subprocess.PIPE if debug else subprocess.DEVNULL,
+            shell=True, universal_newlines=True, cwd=folder)
+        stdout_data, stderr_data = p.communicate()
+        if stdout_data:
+            logger.debug("Captured stdout hook:\n%s", stdout_data)
+        if stderr_data:
+            logger.debug("Captured stderr hook:\n%s", stderr_data)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
 
 
 class FileBackedRwLock:
-    """A readers-Writer lock that locks a file."""
+    """A readers-Writer lock that locks a file.
 
-    def __init__(self, path):
+    If ``fair`` is set, the lock prefers writers: A second file
+    (``path + ".intent"``) is locked exclusively by writers while they wait
+    and shared by readers before they lock ``path``. Waiting writers block new
+    readers while the active readers finish, across processes.
+
+    """
+
+    def __init__(self, path, fair=False):
         self._path = path
+        self._intent_path = path + ".intent" if fair else None
         self._readers = 0
         self._writer = False
         self._lock = threading.Lock()
@@ -1600,28 +2391,78 @@ class FileBackedRwLock:
                 return "w"
             return ""
 
+    def _try_lock(self, lock_file, mode, blocking):
+        """Lock ``lock_file``.
+
+        Returns ``False`` if ``blocking`` isn't set and the file is locked.
+
+        """
+        if os.name == "nt":
+            handle = msvcrt.get_osfhandle(lock_file.fileno())
+            flags = LOCKFILE_EXCLUSIVE_LOCK if mode == "w" else 0
+            if not blocking:
+                flags |= LOCKFILE_FAIL_IMMEDIATELY
+            overlapped = Overlapped()
+            if not lock_file_ex(handle, flags, 0, 1, 0, overlapped):
+                if (not blocking and
+                        ctypes.GetLastError() == ERROR_LOCK_VIOLATION):
+                    return False
+                raise RuntimeError("Locking the storage failed: %s" %
+                                   ctypes.FormatError())
+        elif os.name == "posix":
+            _cmd = fcntl.LOCK_EX if mode == "w" else fcntl.LOCK_SH
+            if not blocking:
+                _cmd |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file.fileno(), _cmd)
+            except BlockingIOError:
+                if not blocking:
+                    return False
+                raise
+            except OSError as e:
+                raise RuntimeError("Locking the storage failed: %s" %
+                                   e) from e
+        else:
+            raise RuntimeError("Locking the storage failed: "
+                               "Unsupported operating system")
+        return True
+
+    def _wait_lock(self, lock_file, mode, deadline, start):
+        if deadline is None:
+            self._try_lock(lock_file, mode, blocking=True)
+            return
+        # Retry with exponential backoff
+        delay = 0.001
+        while not self._try_lock(lock_file, mode, blocking=False):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LockTimeoutError(self._path, time.monotonic() - start)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+
     @contextmanager
-    def acquire(self, mode):
+    def acquire(self, mode, deadline=None):
+        """Lock the file.
+
+        ``deadline`` is a value of ``time.monotonic`` after which
+        ``LockTimeoutError`` is raised, instead of waiting indefinitely.
+
+        """
         if mode not in "rw":
             raise ValueError("Invalid mode: %r" % mode)
+        start = time.monotonic()
         with open(self._path, "w+") as lock_file:
-            if os.name == "nt":
-                handle = msvcrt.get_osfhandle(lock_file.fileno())
-                flags = LOCKFILE_EXCLUSIVE_LOCK if mode == "w" else 0
-                overlapped = Overlapped()
-                if not lock_file_ex(handle, flags, 0, 1, 0, overlapped):
-                    raise RuntimeError("Locking the storage failed: %s" %
-                                       ctypes.FormatError())
-            elif os.name == "posix":
-                _cmd = fcntl.LOCK_EX if mode == "w" else fcntl.LOCK_SH
-                try:
-                    fcntl.flock(lock_file.fileno(), _cmd)
-                except OSError as e:
-                    raise RuntimeError("Locking the storage failed: %s" %
-                                       e) from e
+            if self._intent_path is None:
+                self._wait_lock(lock_file, mode, deadline, start)
             else:
-                raise RuntimeError("Locking the storage failed: "
-                                   "Unsupported operating system")
+                # The intent lock is only held until the lock is acquired
+                with open(self._intent_path, "w+") as intent_file:
+                    self._wait_lock(intent_file, mode, deadline, start)
+                    self._wait_lock(lock_file, mode, deadline, start)
+            waited = time.monotonic() - start
+            if waited >= 0.1:
+                logger.debug("Waited %.3f seconds for lock %r",
+                             waited, self._path)
             with self._lock:
                 if self._writer or mode == "w" and self._readers != 0:
                     raise RuntimeError("Locking the storage failed: "
@@ -1637,3 +2478,782 @@ class FileBackedRwLock:
                     if mode == "r":
                         self._readers -= 1
                     self._writer = False
+
+
+class MemoryCache:
+    """Size-bounded LRU cache that is shared between requests.
+
+    ``max_size`` is the maximal sum of the sizes of the entries (``0``
+    disables the cache).
+
+    """
+
+    # Estimated memory usage of an entry in addition to its size
+    entry_overhead = 512
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the value for ``key`` or ``None``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Store ``value`` for ``key``, ``size`` is used for limiting the
+        memory usage."""
+        size += self.entry_overhead
+        if size > self.max_size:
+            self.pop(key)
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._size -= old_size
+
+    def pop(self, key):
+        """Remove the entry for ``key``."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+
+class RecordLog:
+    """File with a sequence of records, new records are appended.
+
+    Each record consists of a header with the length and the CRC32 checksum
+    of the data followed by the data. Readers ignore incomplete or damaged
+    records at the end of the file (e.g. after a crash or while another
+    process is appending) and the next writer discards them.
+
+    The file is memory-mapped for reading. Writes must be protected by a lock
+    (e.g. the cache lock of the collection). The file is only replaced
+    atomically (see ``rewrite``), so readers always see a consistent prefix.
+
+    """
+
+    # Identifies the type and version of the file
+    magic = b"Radicale.log.1\n"
+
+    # Mapped files can't be replaced or truncated on Windows, they are read
+    # into memory instead
+    map_file = os.name != "nt"
+    # The mapping keeps a duplicate of the file descriptor open, unless
+    # ``trackfd`` is supported
+    _mmap_args = {"trackfd": False} if sys.version_info >= (3, 13) else {}
+
+    _header = struct.Struct("<II")
+    _length = struct.Struct("<I")
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        # Identity of the mapped file
+        self._file_id = None
+        self._buffer = b""
+        # End of the last valid record
+        self._end = 0
+
+    def refresh(self):
+        """Map changes of the file.
+
+        Returns a tuple ``(reset, records)``. If ``reset`` is true, the file
+        was replaced and all previously returned records are invalid.
+        ``records`` is a list of ``(offset, length)`` tuples of the data of
+        new records in ``buffer``.
+
+        """
+        with self._lock:
+            try:
+                with open(self.path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    file_id = (st.st_dev, st.st_ino)
+                    if file_id == self._file_id and (
+                            st.st_size == len(self._buffer)):
+                        return False, []
+                    reset = (file_id != self._file_id or
+                             st.st_size < self._end)
+                    if st.st_size == 0:
+                        buffer = b""
+                    elif self.map_file:
+                        buffer = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ,
+                                           **self._mmap_args)
+                    else:
+                        buffer = f.read()
+            except FileNotFoundError:
+                file_id, buffer, reset = None, b"", self._file_id is not None
+            if buffer[:len(self.magic)] != self.magic:
+                if buffer:
+                    logger.warning("Ignoring invalid file %r", self.path)
+                buffer = b""
+            # Old buffers are closed when they are no longer referenced
+            self._file_id = file_id
+            self._buffer = buffer
+            if reset or not self._end:
+                self._end = len(self.magic) if buffer else 0
+            records = []
+            view = memoryview(buffer)
+            try:
+                while self._end + self._header.size <= len(buffer):
+                    length, checksum = self._header.unpack_from(
+                        buffer, self._end)
+                    offset = self._end + self._header.size
+                    if (offset + length > len(buffer) or
+                            self._checksum(view[offset:offset + length]) !=
+                            checksum):
+                        break
+                    records.append((offset, length))
+                    self._end = offset + length
+            finally:
+                view.release()
+            return reset, records
+
+    @property
+    def buffer(self):
+        """The mapped (or read) content of the file."""
+        return self._buffer
+
+    @property
+    def size(self):
+        """Size of the valid part of the file."""
+        return self._end
+
+    def _checksum(self, data):
+        # The length is included, otherwise zeros would be a valid record
+        return zlib.crc32(data, zlib.crc32(self._length.pack(len(data))))
+
+    def _encode(self, data):
+        return self._header.pack(len(data), self._checksum(data)) + data
+
+    def append(self, records, fsync=None):
+        """Append ``records`` (bytes-like objects) to the file.
+
+        The caller must hold the lock for writing. ``fsync`` is called with
+        the file descriptor before the file is closed.
+
+        """
+        with self._lock:
+            self.refresh()
+            with open(self.path, "ab") as f:
+                if f.tell() != self._end:
+                    # Discard incomplete records
+                    f.truncate(self._end)
+                if not self._end:
+                    f.write(self.magic)
+                for data in records:
+                    f.write(self._encode(data))
+                f.flush()
+                if fsync:
+                    fsync(f.fileno())
+
+    def rewrite(self, records, atomic_write):
+        """Replace the file with one containing ``records``.
+
+        The caller must hold the lock for writing. ``atomic_write`` is a
+        context manager like ``Collection._atomic_write``.
+
+        """
+        with self._lock:
+            with atomic_write(self.path, "wb") as f:
+                f.write(self.magic)
+                for data in records:
+                    f.write(self._encode(data))
+
+
+class ItemCache(RecordLog):
+    """Cache for the items of a collection.
+
+    Entries are tuples ``(cache_hash, uid, etag, text, name, tag, start,
+    end, file_stat)`` like the result of
+    ``Collection._item_cache_content``. Records contain the pickled metadata
+    of the entry followed by the encoded text, removed entries are marked by
+    records without metadata. Only the metadata is kept in memory, the text
+    is read from the mapped file.
+
+    """
+
+    magic = b"Radicale.items.2\n"
+
+    _meta_length = struct.Struct("<I")
+
+    # The file is compacted when it's larger than twice the size of the
+    # current entries and at least this large
+    compact_size = 65536
+
+    def __init__(self, path):
+        super().__init__(path)
+        # Maps hrefs to tuples ``(meta, offset, length)`` where ``offset``
+        # and ``length`` locate the record in ``buffer``
+        self._entries = {}
+        self._live_size = 0
+
+    def load(self):
+        """Update the entries from the file."""
+        with self._lock:
+            reset, records = self.refresh()
+            if reset:
+                self._entries.clear()
+                self._live_size = 0
+            buffer = self.buffer
+            for offset, length in records:
+                meta_length, = self._meta_length.unpack_from(buffer, offset)
+                meta_offset = offset + self._meta_length.size
+                try:
+                    href, meta = pickle.loads(
+                        buffer[meta_offset:meta_offset + meta_length])
+                except (pickle.UnpicklingError, EOFError, ValueError,
+                        TypeError) as e:
+                    logger.warning("Failed to load item cache entry in %r: "
+                                   "%s", self.path, e, exc_info=True)
+                    continue
+                old_entry = self._entries.pop(href, None)
+                if old_entry:
+                    self._live_size -= old_entry[2] + self._header.size
+                if meta is not None:
+                    self._entries[href] = (meta, offset, length)
+                    self._live_size += length + self._header.size
+
+    def hrefs(self):
+        with self._lock:
+            return list(self._entries)
+
+    def get_meta(self, href):
+        """Get the entry for ``href`` without the text or ``None``.
+
+        Returns a tuple ``(cache_hash, uid, etag, name, tag, start, end,
+        file_stat)``.
+
+        """
+        with self._lock:
+            entry = self._entries.get(href)
+        return entry[0] if entry else None
+
+    def get(self, href):
+        """Get the entry for ``href`` or ``None``."""
+        with self._lock:
+            entry = self._entries.get(href)
+            buffer = self.buffer
+        if entry is None:
+            return None
+        (cache_hash, uid, etag, name, tag, start, end,
+         file_stat), offset, length = entry
+        meta_length, = self._meta_length.unpack_from(buffer, offset)
+        text_offset = offset + self._meta_length.size + meta_length
+        text = bytes(buffer[text_offset:offset + length]).decode("utf-8")
+        return cache_hash, uid, etag, text, name, tag, start, end, file_stat
+
+    def _encode_entry(self, href, entry):
+        if entry is None:
+            meta, text = None, b""
+        else:
+            (cache_hash, uid, etag, text, name, tag, start, end,
+             file_stat) = entry
+            meta = (cache_hash, uid, etag, name, tag, start, end, file_stat)
+            text = text.encode("utf-8")
+        meta = pickle.dumps((href, meta), pickle.HIGHEST_PROTOCOL)
+        return self._meta_length.pack(len(meta)) + meta + text
+
+    def store(self, entries, fsync=None, atomic_write=None):
+        """Store ``entries`` (iterable of ``(href, entry)`` tuples).
+
+        ``entry`` is ``None`` to remove ``href``. The caller must hold the
+        lock for writing. If ``atomic_write`` is set, the file is compacted
+        when it contains too much outdated data.
+
+        """
+        with self._lock:
+            self.append((self._encode_entry(href, entry)
+                         for href, entry in entries), fsync)
+            self.load()
+            if (atomic_write and self.size > self.compact_size and
+                    self.size > 2 * (self._live_size + len(self.magic))):
+                self.compact(atomic_write)
+
+    def compact(self, atomic_write, keep=None):
+        """Rewrite the file with the current entries.
+
+        Entries for hrefs that are not in ``keep`` are removed (if set).
+
+        """
+        with self._lock:
+            self.load()
+            buffer = self.buffer
+            logger.debug("Compacting item cache %r", self.path)
+            self.rewrite((
+                buffer[offset:offset + length] for href, (_, offset, length)
+                in self._entries.items() if keep is None or href in keep),
+                atomic_write)
+            self.load()
+
+
+class ChangeJournal(RecordLog):
+    """Journal of the changes of the items of a collection.
+
+    The first record contains the identifier of the journal, the revision
+    and the state (``{href: etag}``) of the collection when the journal was
+    created or compacted. Each following change of an item increments the
+    revision. Sync tokens refer to revisions, the changes since a token are
+    found without looking at the items.
+
+    The status of the collection folder is recorded with the changes, to
+    detect changes outside of Radicale.
+
+    The XOR of the hashes of all items is kept up to date for computing the
+    etag of the collection.
+
+    Records are tuples ``("base", journal_id, revision, state)``,
+    ``("change", href, etag, time)`` and ``("folder", folder_stat)``. They
+    are stored in a compact binary encoding, etags produced by ``get_etag``
+    take 17 bytes.
+
+    """
+
+    magic = b"Radicale.journal.2\n"
+
+    # Kind of the record, journal identifier and revision
+    _base_header = struct.Struct("<c16sQ")
+    # Kind of the record and time
+    _change_header = struct.Struct("<cq")
+    # Kind of the record, inode and modification time
+    _folder_record = struct.Struct("<cQq")
+    _string_length = struct.Struct("<H")
+
+    # The file is compacted when it's larger and more than half of the
+    # changes are expired
+    compact_size = 65536
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._reset_state()
+        # Indexes of the items (see ``Collection._get_index``)
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
+
+    def _reset_state(self):
+        # ``None`` if the journal is missing or damaged
+        self.journal_id = None
+        self.revision = 0
+        self.folder_stat = None
+        # Current etags of the items
+        self.state = {}
+        # XOR of the hashes of all entries in ``state``
+        self.state_hash = 0
+        self._base_revision = 0
+        # Location ``(offset, length)`` of the base record in ``buffer``
+        self._base_record = None
+        # List of ``(href, etag, time)`` tuples for the revisions after
+        # ``_base_revision``
+        self._changes = []
+
+    def load(self):
+        """Update the state from the file."""
+        with self._lock:
+            reset, records = self.refresh()
+            if reset:
+                self._reset_state()
+            buffer = self.buffer
+            for offset, length in records:
+                try:
+                    record = self._decode_record(
+                        buffer[offset:offset + length])
+                    kind = record[0]
+                    if kind == "base":
+                        _, journal_id, revision, state = record
+                        self._reset_state()
+                        self.journal_id = journal_id
+                        self._base_revision = self.revision = revision
+                        self._base_record = (offset, length)
+                        for href, etag in state.items():
+                            self._set_state(href, etag)
+                    elif self.journal_id is None:
+                        raise ValueError("missing base record")
+                    elif kind == "change":
+                        _, href, etag, change_time = record
+                        self.revision += 1
+                        self._changes.append((href, etag, change_time))
+                        self._set_state(href, etag)
+                    elif kind == "folder":
+                        _, self.folder_stat = record
+                    else:
+                        raise ValueError("unknown record %r" % kind)
+                except (struct.error, ValueError, IndexError) as e:
+                    logger.warning("Failed to load journal %r: %s",
+                                   self.path, e, exc_info=True)
+                    # The journal is rebuilt
+                    self._reset_state()
+                    break
+
+    @classmethod
+    def _encode_string(cls, value):
+        data = value.encode("utf-8")
+        return cls._string_length.pack(len(data)) + data
+
+    @classmethod
+    def _decode_string(cls, data, offset):
+        length, = cls._string_length.unpack_from(data, offset)
+        offset += cls._string_length.size
+        if offset + length > len(data):
+            raise ValueError("truncated string")
+        return str(data[offset:offset + length], "utf-8"), offset + length
+
+    @classmethod
+    def _encode_etag(cls, etag):
+        # Etags from ``get_etag`` are stored as binary MD5 hash
+        if (len(etag) == 34 and etag[0] == etag[-1] == '"' and
+                all(c in "0123456789abcdef" for c in etag[1:-1])):
+            return b"\x00" + bytes.fromhex(etag[1:-1])
+        return b"\x01" + cls._encode_string(etag)
+
+    @classmethod
+    def _decode_etag(cls, data, offset):
+        if data[offset] == 0:
+            digest = bytes(data[offset + 1:offset + 17])
+            if len(digest) != 16:
+                raise ValueError("truncated etag")
+            return '"%s"' % digest.hex(), offset + 17
+        if data[offset] == 1:
+            return cls._decode_string(data, offset + 1)
+        raise ValueError("invalid etag")
+
+    def _encode_record(self, record):
+        kind = record[0]
+        if kind == "base":
+            _, journal_id, revision, state = record
+            return self._base_header.pack(
+                b"B", bytes.fromhex(journal_id), revision) + b"".join(
+                    self._encode_string(href) + self._encode_etag(etag)
+                    for href, etag in state.items())
+        if kind == "change":
+            # The href is stored at the end, deleted items have no etag
+            _, href, etag, change_time = record
+            return (self._change_header.pack(b"C", change_time) +
+                    (self._encode_etag(etag) if etag else b"\x02") +
+                    href.encode("utf-8"))
+        if kind == "folder":
+            _, folder_stat = record
+            if folder_stat is None:
+                return b"F"
+            return self._folder_record.pack(b"F", *folder_stat)
+        raise ValueError("unknown record %r" % kind)
+
+    def _decode_record(self, data):
+        kind = bytes(data[:1])
+        if kind == b"B":
+            _, journal_id, revision = self._base_header.unpack_from(data)
+            offset = self._base_header.size
+            state = {}
+            while offset < len(data):
+                href, offset = self._decode_string(data, offset)
+                state[href], offset = self._decode_etag(data, offset)
+            return "base", journal_id.hex(), revision, state
+        if kind == b"C":
+            _, change_time = self._change_header.unpack_from(data)
+            offset = self._change_header.size
+            if data[offset] == 2:
+                etag, offset = "", offset + 1
+            else:
+                etag, offset = self._decode_etag(data, offset)
+            return "change", str(data[offset:], "utf-8"), etag, change_time
+        if kind == b"F":
+            if len(data) == 1:
+                return "folder", None
+            _, *folder_stat = self._folder_record.unpack(data)
+            return "folder", tuple(folder_stat)
+        raise ValueError("unknown record %r" % kind)
+
+    @staticmethod
+    def _entry_hash(href, etag):
+        return int.from_bytes(
+            md5((href + "/" + etag).encode("utf-8")).digest(), "big")
+
+    def _set_state(self, href, etag):
+        old_etag = self.state.pop(href, None)
+        if old_etag is not None:
+            self.state_hash ^= self._entry_hash(href, old_etag)
+        if etag:
+            self.state[href] = etag
+            self.state_hash ^= self._entry_hash(href, etag)
+
+    def changes_since(self, journal_id=None, revision=0):
+        """Get the changes since ``revision`` of the journal ``journal_id``.
+
+        Returns a tuple ``(journal_id, revision, hrefs)`` with the current
+        identifier and revision. ``hrefs`` contains all current items if
+        ``journal_id`` is ``None``, is ``None`` if the revision is unknown
+        and is empty if ``revision`` is ``None``.
+
+        """
+        with self._lock:
+            if revision is None:
+                hrefs = []
+            elif journal_id is None:
+                hrefs = list(self.state)
+            elif (journal_id != self.journal_id or
+                    not self._base_revision <= revision <= self.revision):
+                hrefs = None
+            else:
+                hrefs = list(OrderedDict.fromkeys(
+                    href for href, _, _ in
+                    self._changes[revision - self._base_revision:]))
+            return self.journal_id, self.revision, hrefs
+
+    def changed_etags(self, journal_id=None, revision=0):
+        """Get the current etags of the items that changed since
+        ``revision`` of the journal ``journal_id``.
+
+        Returns a tuple ``(journal_id, revision, complete, etags)``. If
+        ``complete`` is true, ``etags`` contains all current items,
+        because the revision is unknown. Otherwise deleted items are
+        included with an empty etag.
+
+        """
+        with self._lock:
+            _, current_revision, hrefs = self.changes_since(journal_id,
+                                                            revision)
+            if journal_id is None or hrefs is None:
+                return self.journal_id, current_revision, True, dict(
+                    self.state)
+            return self.journal_id, current_revision, False, {
+                href: self.state.get(href, "") for href in hrefs}
+
+    def create(self, state, folder_stat, atomic_write):
+        """Replace the journal with a new one for ``state``.
+
+        The caller must hold the lock for writing.
+
+        """
+        journal_id = binascii.hexlify(os.urandom(16)).decode("ascii")
+        with self._lock:
+            self.rewrite((self._encode_record(record)
+                          for record in (("base", journal_id, 0, state),
+                                         ("folder", folder_stat))),
+                         atomic_write)
+            self.load()
+
+    def append_changes(self, changes, folder_stat, fsync=None):
+        """Append ``changes`` (iterable of ``(href, etag)`` tuples, ``etag``
+        is empty for deleted items) and the status of the collection folder.
+
+        Changes that don't modify the state are skipped. The caller must
+        hold the lock for writing.
+
+        """
+        with self._lock:
+            self.load()
+            state = dict(self.state)
+            records = []
+            change_time = int(time.time())
+            for href, etag in changes:
+                if state.get(href, "") == etag:
+                    continue
+                if etag:
+                    state[href] = etag
+                else:
+                    del state[href]
+                records.append(("change", href, etag, change_time))
+            if not records and folder_stat == self.folder_stat:
+                return
+            records.append(("folder", folder_stat))
+            self.append((self._encode_record(record)
+                         for record in records), fsync)
+            self.load()
+
+    def compact(self, max_age, atomic_write, force=False):
+        """Remove changes that are older than ``max_age`` seconds, if they
+        are the majority and the file is large.
+
+        All expired changes are removed if ``force`` is set. The caller must
+        hold the lock for writing.
+
+        """
+        with self._lock:
+            self.load()
+            if not force and self.size <= self.compact_size:
+                return
+            age_limit = time.time() - max_age
+            expired = 0
+            for _, _, change_time in self._changes:
+                if change_time > age_limit:
+                    break
+                expired += 1
+            if not expired or (not force and
+                               expired <= len(self._changes) // 2):
+                return
+            logger.debug("Compacting journal %r", self.path)
+            offset, length = self._base_record
+            _, _, _, state = self._decode_record(
+                self.buffer[offset:offset + length])
+            for href, etag, _ in self._changes[:expired]:
+                if etag:
+                    state[href] = etag
+                else:
+                    state.pop(href, None)
+            records = [("base", self.journal_id,
+                        self._base_revision + expired, state)]
+            records.extend(("change", href, etag, change_time) for
+                           href, etag, change_time in self._changes[expired:])
+            records.append(("folder", self.folder_stat))
+            self.rewrite((self._encode_record(record)
+                          for record in records), atomic_write)
+            self.load()
+
+
+class ItemIndex:
+    """Index of the items of a collection, derived from the item cache.
+
+    Items without valid entry in the item cache are unknown and must be
+    checked by the user of the index.
+
+    """
+
+    def __init__(self):
+        # Maps the hrefs of unknown items to their etags
+        self.unknown = {}
+
+    def add(self, href, etag, meta):
+        """Add the item ``href`` with ``etag``.
+
+        ``meta`` is the result of ``ItemCache.get_meta`` or ``None`` if the
+        item is unknown.
+
+        """
+        if meta is None:
+            self.unknown[href] = etag
+
+    def remove(self, href):
+        """Remove the item ``href``."""
+        self.unknown.pop(href, None)
+
+
+class TimeRangeIndex(ItemIndex):
+    """Index of the time ranges of the items of a collection.
+
+    Items are sorted by the start of their time range. Items with a long
+    time range (e.g. recurring events) are kept separately, for the others
+    the maximal duration limits the items that must be checked.
+
+    """
+
+    long_duration = 366 * 24 * 60 * 60
+
+    def __init__(self):
+        super().__init__()
+        # Maps hrefs to ``(tag, start, end)`` tuples
+        self._entries = {}
+        # Maps tags to lists of ``(start, end, href)`` tuples, they are
+        # sorted when required
+        self._short = {}
+        self._unsorted_tags = set()
+        # Maps tags to the maximal duration of the items in ``_short``
+        self._max_duration = {}
+        # Maps tags to sets of hrefs
+        self._long = {}
+
+    def add(self, href, etag, meta):
+        self.remove(href)
+        if meta is None:
+            super().add(href, etag, meta)
+            return
+        _, _, _, _, tag, start, end, _ = meta
+        self._entries[href] = (tag, start, end)
+        if end - start > self.long_duration:
+            self._long.setdefault(tag, set()).add(href)
+        else:
+            self._short.setdefault(tag, []).append((start, end, href))
+            self._unsorted_tags.add(tag)
+            self._max_duration[tag] = max(
+                self._max_duration.get(tag, 0), end - start)
+
+    def _get_short(self, tag):
+        entries = self._short.get(tag, [])
+        if tag in self._unsorted_tags:
+            self._unsorted_tags.remove(tag)
+            entries.sort()
+        return entries
+
+    def remove(self, href):
+        super().remove(href)
+        entry = self._entries.pop(href, None)
+        if entry is None:
+            return
+        tag, start, end = entry
+        if end - start > self.long_duration:
+            self._long[tag].discard(href)
+        else:
+            entries = self._get_short(tag)
+            del entries[bisect.bisect_left(entries, (start, end, href))]
+
+    def find(self, tag, start, end):
+        """Get the hrefs of the items with the component ``tag`` that
+        overlap the time range from ``start`` to ``end``.
+
+        The result includes unknown items.
+
+        """
+        hrefs = set(self.unknown)
+        for href in self._long.get(tag, ()):
+            _, istart, iend = self._entries[href]
+            if istart < end and iend > start:
+                hrefs.add(href)
+        entries = self._get_short(tag)
+        for istart, iend, href in entries[
+                bisect.bisect_left(
+                    entries, (start - self._max_duration.get(tag, 0),)):
+                bisect.bisect_left(entries, (end,))]:
+            if iend > start:
+                hrefs.add(href)
+        return hrefs
+
+
+class UidIndex(ItemIndex):
+    """Index of the UIDs of the items of a collection."""
+
+    def __init__(self):
+        super().__init__()
+        # Maps hrefs to UIDs
+        self._uids = {}
+        # Maps UIDs to sets of hrefs
+        self._hrefs = {}
+
+    def add(self, href, etag, meta):
+        self.remove(href)
+        if meta is None:
+            super().add(href, etag, meta)
+            return
+        uid = meta[1]
+        self._uids[href] = uid
+        self._hrefs.setdefault(uid, set()).add(href)
+
+    def remove(self, href):
+        super().remove(href)
+        uid = self._uids.pop(href, None)
+        if uid is None:
+            return
+        hrefs = self._hrefs[uid]
+        hrefs.discard(href)
+        if not hrefs:
+            del self._hrefs[uid]
+
+    def find(self, uid):
+        """Get the hrefs of the known items with ``uid``."""
+        return set(self._hrefs.get(uid, ()))
+
+    def duplicates(self):
+        """Get a dict that maps UIDs of multiple known items to the sorted
+        list of their hrefs."""
+        return {uid: sorted(hrefs) for uid, hrefs in self._hrefs.items()
+                if len(hrefs) > 1}
@@ -55,7 +55,7 @@ class BaseTest:
             nonlocal status, headers
             status = status_
             headers = headers_
-        answer = self.application(args, start_response)
+        answer = b"".join(self.application(args, start_response))
 
         return (int(status.split()[0]), dict(headers),
-                answer[0].decode("utf-8") if answer else None)
+                answer.decode("utf-8") if answer else None)
@@ -127,6 +127,56 @@ class TestBaseAuthRequests(BaseTest):
     def test_htpasswd_comment(self):
         self._test_htpasswd("plain", "#comment\n #comment\n \ntmp:bepo\n\n")
 
+    def test_htpasswd_reload(self):
+        self._test_htpasswd("plain", "tmp:bepo")
+        htpasswd_file_path = os.path.join(self.colpath, ".htpasswd")
+        with open(htpasswd_file_path, "w") as f:
+            f.write("tmp:bepo2\n")
+        for password, expected_status in (("bepo", 401), ("bepo2", 207)):
+            status, _, _ = self.request(
+                "PROPFIND", "/",
+                HTTP_AUTHORIZATION="Basic %s" % base64.b64encode(
+                    ("tmp:%s" % password).encode()).decode())
+            assert status == expected_status
+
+    def test_htpasswd_cache(self):
+        self._test_htpasswd("plain", "tmp:bepo")
+        verify = self.application.Auth.verify
+        calls = []
+
+        def counting_verify(*args):
+            calls.append(args)
+            return verify(*args)
+        self.application.Auth.verify = counting_verify
+        for user, password, expected_status, expected_calls in (
+                ("tmp", "bepo", 207, 0), ("tmp", "tmp", 401, 1),
+                ("unk", "bepo", 401, 2)):
+            status, _, _ = self.request(
+                "PROPFIND", "/",
+                HTTP_AUTHORIZATION="Basic %s" % base64.b64encode(
+                    ("%s:%s" % (user, password)).encode()).decode())
+            assert status == expected_status
+            assert len(calls) == expected_calls
+
+    def test_htpasswd_cache_disabled(self):
+        self.configuration["auth"]["htpasswd_cache_expiry"] = "0"
+        self._test_htpasswd("plain", "tmp:bepo")
+        verify = self.application.Auth.verify
+        calls = []
+
+        def counting_verify(*args):
+            calls.append(args)
+            return verify(*args)
+        self.application.Auth.verify = counting_verify
+        status, _, _ = self.request(
+            "PROPFIND", "/", HTTP_AUTHORIZATION="Basic %s" %
+            base64.b64encode(b"tmp:bepo").decode())
+        assert status == 207
+        assert len(calls) == 1
+
+    def test_htpasswd_first_entry(self):
+        self._test_htpasswd("plain", "tmp:bepo\ntmp:tmp")
+
     def test_remote_user(self):
         self.configuration["auth"]["type"] = "remote_user"
         self.application = Application(self.configuration)
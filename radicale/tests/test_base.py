@@ -20,17 +20,20 @@ Radicale tests with simple requests.
 """
 
 import base64
+import gzip
 import os
+import pickle
 import posixpath
 import shutil
 import sys
 import tempfile
+import threading
 import xml.etree.ElementTree as ET
 from functools import partial
 
 import pytest
 
-from radicale import Application, config
+from radicale import Application, config, storage, web
 
 from . import BaseTest
 from .helpers import get_file_content
@@ -291,6 +294,77 @@ class BaseRequestsMixIn:
         status, _, _ = self.request("HEAD", "/")
         assert status == 302
 
+    def test_conditional_get(self):
+        """Test GET and HEAD requests with If-None-Match and
+           If-Modified-Since."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        for path in ("/calendar.ics/", "/calendar.ics/event1.ics"):
+            status, headers, _ = self.request("GET", path)
+            assert status == 200
+            etag, last_modified = headers["ETag"], headers["Last-Modified"]
+            for method in ("GET", "HEAD"):
+                status, headers, answer = self.request(
+                    method, path, HTTP_IF_NONE_MATCH='"x", %s' % etag)
+                assert status == 304
+                assert headers["ETag"] == etag
+                assert not answer
+                status, _, _ = self.request(
+                    method, path, HTTP_IF_MODIFIED_SINCE=last_modified)
+                assert status == 304
+            status, _, answer = self.request("GET", path,
+                                             HTTP_IF_NONE_MATCH='"x"')
+            assert status == 200
+            assert answer
+            # If-Modified-Since is ignored if If-None-Match is present
+            status, _, _ = self.request(
+                "GET", path, HTTP_IF_NONE_MATCH='"x"',
+                HTTP_IF_MODIFIED_SINCE=last_modified)
+            assert status == 200
+            status, _, _ = self.request(
+                "GET", path,
+                HTTP_IF_MODIFIED_SINCE="Thu, 01 Jan 1970 00:00:00 GMT")
+            assert status == 200
+
+    def test_conditional_get_web(self, monkeypatch):
+        """Test GET requests of the web interface with
+           If-Modified-Since."""
+        status, headers, _ = self.request("GET", "/.web/")
+        assert status == 200
+        if "Last-Modified" not in headers:
+            pytest.skip("web interface does not support Last-Modified")
+        # The file is not read
+        monkeypatch.setattr(web, "open", None, raising=False)
+        status, _, answer = self.request(
+            "GET", "/.web/", HTTP_IF_MODIFIED_SINCE=headers["Last-Modified"])
+        assert status == 304
+        assert not answer
+
+    def test_conditional_propfind(self):
+        """Test PROPFIND requests on a calendar with If-None-Match."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        status, headers, _ = self.request("PROPFIND", "/calendar.ics/",
+                                          HTTP_DEPTH="1")
+        assert status == 207
+        etag = headers["ETag"]
+        status, _, answer = self.request(
+            "PROPFIND", "/calendar.ics/", HTTP_DEPTH="1",
+            HTTP_IF_NONE_MATCH=etag)
+        assert status == 304
+        assert not answer
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        status, headers, _ = self.request(
+            "PROPFIND", "/calendar.ics/", HTTP_DEPTH="1",
+            HTTP_IF_NONE_MATCH=etag)
+        assert status == 207
+        assert headers["ETag"] != etag
+
     def test_options(self):
         status, headers, _ = self.request("OPTIONS", "/")
         assert status == 200
@@ -1454,6 +1528,93 @@ class TestMultiFileSystem(BaseFileSystemTest, BaseRequestsMixIn):
         status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
         assert status == 201
 
+    def test_fsync_upload_whole_calendar(self):
+        """Verify that the items of a new calendar are synced together."""
+        self.configuration["internal"]["filesystem_fsync"] = "True"
+        self.application = Application(self.configuration)
+        Collection = self.application.Collection
+        fsync = Collection._fsync
+        fsync_calls = []
+
+        def counting_fsync(fd):
+            fsync_calls.append(fd)
+            fsync(fd)
+        Collection._fsync = staticmethod(counting_fsync)
+        event = get_file_content("event1.ics")
+        start = event.index("BEGIN:VEVENT")
+        end = event.index("END:VCALENDAR")
+        events = "".join(
+            event[start:end].replace("UID:event1", "UID:event%d" % i)
+            for i in range(50))
+        status, _, _ = self.request(
+            "PUT", "/calendar.ics/", event[:start] + events + event[end:])
+        assert status == 201
+        if storage.syncfs is not None:
+            assert len(fsync_calls) < 50
+        status, _, answer = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert answer.count("BEGIN:VEVENT") == 50
+
+    def test_get_calendar_streamed(self):
+        """Verify that calendars are streamed from a file."""
+        self.application._file_chunk_size = 64
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        for i in range(20):
+            status, _, _ = self.request(
+                "PUT", "/calendar.ics/event%d.ics" % i,
+                event.replace("UID:event1", "UID:event%d" % i))
+            assert status == 201
+        status, headers, answer = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert int(headers["Content-Length"]) == len(answer.encode())
+        assert answer.count("BEGIN:VTIMEZONE") == 1
+        assert answer.count("BEGIN:VEVENT") == 20
+        assert answer.index("END:VTIMEZONE") < answer.index("BEGIN:VEVENT")
+        response = {}
+
+        def start_response(status, headers):
+            response.update(headers)
+        chunks = list(self.application({
+            "REQUEST_METHOD": "GET", "PATH_INFO": "/calendar.ics/",
+            "HTTP_ACCEPT_ENCODING": "gzip", "wsgi.errors": sys.stderr},
+            start_response))
+        assert len(chunks) > 1
+        assert response["Content-Encoding"] == "gzip"
+        data = b"".join(chunks)
+        assert int(response["Content-Length"]) == len(data)
+        assert gzip.decompress(data).decode() == answer
+
+    def test_get_calendar_export_cache(self):
+        """Verify that exports of collections are cached until they
+           change."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        export_folder = os.path.join(self.colpath, "collection-root",
+                                     "calendar.ics", ".Radicale.cache",
+                                     "export")
+        status, _, answer1 = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        export, = os.listdir(export_folder)
+        inode = os.stat(os.path.join(export_folder, export)).st_ino
+        status, _, answer2 = self.request("GET", "/calendar.ics/",
+                                          HTTP_ACCEPT_ENCODING="identity")
+        assert status == 200
+        assert answer1 == answer2
+        assert os.listdir(export_folder) == [export]
+        assert os.stat(os.path.join(export_folder, export)).st_ino == inode
+        event = get_file_content("event2.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event2.ics", event)
+        assert status == 201
+        status, _, answer = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert "UID:event2" in answer
+        assert len(os.listdir(export_folder)) == 1
+
     def test_hook(self):
         """Run hook."""
         self.configuration["storage"]["hook"] = (
@@ -1481,6 +1642,123 @@ class TestMultiFileSystem(BaseFileSystemTest, BaseRequestsMixIn):
         status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
         assert status == 201
 
+    def test_principal_locks(self):
+        """Verify that locks of different principals are independent."""
+        Collection = self.application.Collection
+        acquired = []
+
+        def acquire(mode, path):
+            with Collection.acquire_lock(mode, paths=(path,)):
+                acquired.append(path)
+
+        with Collection.acquire_lock("w", paths=("/user1/calendar.ics/",)):
+            threads = [threading.Thread(target=acquire, args=args)
+                       for args in (("r", "/user2/"), ("w", "/user1/"))]
+            for thread in threads:
+                thread.start()
+            threads[0].join(10)
+            threads[1].join(0.2)
+            assert acquired == ["/user2/"]
+        threads[1].join(10)
+        assert acquired == ["/user2/", "/user1/"]
+
+    def test_principal_writer_locks_caches(self):
+        """Verify that writers of principal collections lock the caches,
+           readers of the root collection might update them."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        lock_path = os.path.join(self.colpath, "collection-root",
+                                 "calendar.ics", ".Radicale.cache",
+                                 ".Radicale.lock.item")
+        statuses = []
+
+        def put():
+            status, _, _ = self.request("PUT", "/calendar.ics/event1.ics",
+                                        get_file_content("event1.ics"))
+            statuses.append(status)
+
+        with storage.FileBackedRwLock(lock_path).acquire("w"):
+            thread = threading.Thread(target=put)
+            thread.start()
+            thread.join(0.2)
+            assert not statuses
+        thread.join(10)
+        assert statuses == [201]
+
+    def test_lock_prefers_writers(self):
+        """Verify that waiting writers block new readers."""
+        Collection = self.application.Collection
+        acquired = []
+
+        def acquire(mode):
+            with Collection.acquire_lock(mode, paths=("/user1/",)):
+                acquired.append(mode)
+
+        with Collection.acquire_lock("r", paths=("/user1/",)):
+            writer = threading.Thread(target=acquire, args=("w",))
+            writer.start()
+            writer.join(0.2)
+            assert not acquired
+            reader = threading.Thread(target=acquire, args=("r",))
+            reader.start()
+            reader.join(0.2)
+            assert not acquired
+        writer.join(10)
+        reader.join(10)
+        assert acquired == ["w", "r"]
+
+    def test_lock_timeout(self):
+        """Verify that requests fail when the lock can't be acquired."""
+        self.configuration["storage"]["lock_timeout"] = "0, GET=0.1"
+        self.application = Application(self.configuration)
+        Collection = self.application.Collection
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with Collection.acquire_lock("w", paths=("/calendar.ics/",)):
+                locked.set()
+                release.wait(10)
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            assert locked.wait(10)
+            status, headers, _ = self.request("GET", "/calendar.ics/")
+            assert status == 503
+            assert headers["Retry-After"] == "1"
+        finally:
+            release.set()
+            thread.join(10)
+        status, _, _ = self.request("GET", "/calendar.ics/")
+        assert status == 404
+
+    def test_lock_timeout_cache_lock(self):
+        """Verify that the lock timeout applies to the cache locks."""
+        self.configuration["storage"]["lock_timeout"] = "0, PUT=0.1"
+        self.application = Application(self.configuration)
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        lock_path = os.path.join(self.colpath, "collection-root",
+                                 "calendar.ics", ".Radicale.cache",
+                                 ".Radicale.lock.item")
+        with storage.FileBackedRwLock(lock_path).acquire("w"):
+            status, headers, _ = self.request(
+                "PUT", "/calendar.ics/event1.ics",
+                get_file_content("event1.ics"))
+            assert status == 503
+            assert "Retry-After" in headers
+
+    def test_lock_timeout_argument(self):
+        """Verify that the lock timeout can be set like on the command
+           line."""
+        type_ = config.INITIAL_CONFIG["storage"]["lock_timeout"]["type"]
+        self.configuration.set("storage", "lock_timeout",
+                               type_("30, PUT=60"))
+        self.application = Application(self.configuration)
+        assert self.application._lock_timeout({"REQUEST_METHOD": "GET"}) == 30
+        assert self.application._lock_timeout({"REQUEST_METHOD": "PUT"}) == 60
+
     def test_hook_principal_collection_creation(self):
         """Verify that the hooks runs when a new user is created."""
         self.configuration["storage"]["hook"] = (
@@ -1491,12 +1769,75 @@ class TestMultiFileSystem(BaseFileSystemTest, BaseRequestsMixIn):
         status, _, _ = self.request("PROPFIND", "/created_by_hook/")
         assert status == 207
 
+    def test_hook_background(self):
+        """Verify that the hook runs in the background and that changes
+           are combined."""
+        self.configuration["storage"]["hook"] = (
+            "mkdir -p %s; echo x >> hook_runs" %
+            os.path.join("collection-root", "created_by_hook"))
+        self.configuration["storage"]["hook_background"] = "True"
+        self.application = Application(self.configuration)
+        Collection = self.application.Collection
+        # Delay the runner, the changes are only marked as pending
+        Collection._start_hook_runner = classmethod(lambda cls: None)
+        for i in range(3):
+            status, _, _ = self.request("MKCALENDAR", "/calendar%d.ics/" % i)
+            assert status == 201
+        del Collection._start_hook_runner
+        Collection._start_hook_runner()
+        Collection.shutdown()
+        status, _, _ = self.request("PROPFIND", "/created_by_hook/")
+        assert status == 207
+        with open(os.path.join(self.colpath, "hook_runs")) as f:
+            assert f.read() == "x\n"
+
+    def test_hook_background_writers_locked(self):
+        """Verify that only writers are locked out when the hook runs in
+           the background."""
+        self.configuration["storage"]["hook"] = (
+            "flock -n -s .Radicale.lock true || exit 1; "
+            "flock -n -s .Radicale.locks/hook.writers true && exit 1; exit 0")
+        self.configuration["storage"]["hook_background"] = "True"
+        self.application = Application(self.configuration)
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        self.application.Collection.shutdown()
+        assert not os.path.exists(os.path.join(
+            self.colpath, ".Radicale.locks", "hook.pending"))
+
+    def test_hook_background_fail(self, caplog):
+        """Verify that requests don't fail if the hook in the background
+           fails and that the hook stays pending."""
+        self.configuration["storage"]["hook"] = "exit 1"
+        self.configuration["storage"]["hook_background"] = "True"
+        self.application = Application(self.configuration)
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/", event)
+        assert status == 201
+        self.application.Collection.shutdown()
+        assert any(record.getMessage().startswith("Hook failed")
+                   for record in caplog.records)
+        locks_folder = os.path.join(self.colpath, ".Radicale.locks")
+        assert os.path.exists(os.path.join(locks_folder, "hook.pending"))
+        assert not os.path.exists(os.path.join(locks_folder, "hook.running"))
+        # The hook is run again after the next change
+        self.configuration["storage"]["hook"] = "true"
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        self.application.Collection.shutdown()
+        assert not os.path.exists(os.path.join(locks_folder, "hook.pending"))
+
     def test_hook_fail(self):
         """Verify that a request fails if the hook fails."""
         self.configuration["storage"]["hook"] = "exit 1"
         status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
         assert status != 201
 
+    def test_filesystem_collision_check(self):
+        """Add an event with checks for colliding file names enabled."""
+        self.application.Collection._filesystem_may_collide = True
+        BaseRequestsMixIn.test_add_event(self)
+
     def test_item_cache_rebuild(self):
         """Delete the item cache and verify that it is rebuild."""
         status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
@@ -1507,14 +1848,501 @@ class TestMultiFileSystem(BaseFileSystemTest, BaseRequestsMixIn):
         assert status == 201
         status, _, answer1 = self.request("GET", path)
         assert status == 200
-        cache_folder = os.path.join(self.colpath, "collection-root",
-                                    "calendar.ics", ".Radicale.cache", "item")
-        assert os.path.exists(os.path.join(cache_folder, "event1.ics"))
-        shutil.rmtree(cache_folder)
+        cache_path = os.path.join(self.colpath, "collection-root",
+                                  "calendar.ics", ".Radicale.cache", "items")
+        assert os.path.exists(cache_path)
+        os.remove(cache_path)
         status, _, answer2 = self.request("GET", path)
         assert status == 200
         assert answer1 == answer2
-        assert os.path.exists(os.path.join(cache_folder, "event1.ics"))
+        assert os.path.exists(cache_path)
+
+    def test_item_cache_damaged(self):
+        """Append garbage to the item cache and verify that it's ignored."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        path = "/calendar.ics/event1.ics"
+        status, _, _ = self.request("PUT", path, event)
+        assert status == 201
+        cache_path = os.path.join(self.colpath, "collection-root",
+                                  "calendar.ics", ".Radicale.cache", "items")
+        size = os.path.getsize(cache_path)
+        with open(cache_path, "ab") as f:
+            f.write(b"\x00" * 100)
+        # Reload the cache in a new process
+        self.application = Application(self.configuration)
+        status, _, answer = self.request("GET", path)
+        assert status == 200
+        assert "UID:event1" in answer
+        status, _, _ = self.request("PUT", path, event.replace(
+            "Event", "Modified event"))
+        assert status == 201
+        with open(cache_path, "rb") as f:
+            assert b"\x00" * 100 not in f.read()[size:]
+        status, _, answer = self.request("GET", path)
+        assert status == 200
+        assert "Modified event" in answer
+
+    def test_item_cache_migration(self):
+        """Verify that the item cache with one file per item is imported."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        path = "/calendar.ics/event1.ics"
+        status, _, _ = self.request("PUT", path, event)
+        assert status == 201
+        cache_folder = os.path.join(self.colpath, "collection-root",
+                                    "calendar.ics", ".Radicale.cache")
+        collection = next(self.application.Collection.discover(
+            "/calendar.ics/"))
+        os.makedirs(os.path.join(cache_folder, "item"))
+        with open(os.path.join(cache_folder, "item", "event1.ics"),
+                  "wb") as f:
+            pickle.dump(collection._get_item_cache().get("event1.ics"), f)
+        os.remove(os.path.join(cache_folder, "items"))
+        self.application = Application(self.configuration)
+        status, _, answer = self.request("GET", path)
+        assert status == 200
+        assert "UID:event1" in answer
+        assert not os.path.exists(os.path.join(cache_folder, "item"))
+        with open(os.path.join(cache_folder, "items"), "rb") as f:
+            assert f.read().count(b"UID:event1") == 1
+
+    def test_item_cache_stat_validation(self):
+        """Verify that items modified externally are detected by their
+        status."""
+        self.configuration["storage"]["item_cache_validation"] = "stat"
+        self.application = Application(self.configuration)
+        self.application.Collection._item_file_stat_min_age = 0
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        path = "/calendar.ics/event1.ics"
+        status, _, _ = self.request("PUT", path, event)
+        assert status == 201
+        status, _, answer = self.request("GET", path)
+        assert status == 200
+        assert "UID:event1" in answer
+        collection = next(self.application.Collection.discover(
+            "/calendar.ics/"))
+        assert collection._get_item_cache().get("event1.ics")[8] is not None
+        with open(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", "event1.ics"), "w") as f:
+            f.write(event.replace("Event", "Modified event"))
+        status, _, answer = self.request("GET", path)
+        assert status == 200
+        assert "Modified event" in answer
+
+    def test_index_promotes_loaded_items(self):
+        """Verify that unknown items are added to the indexes once they are
+        loaded."""
+        self.configuration["storage"]["item_cache_validation"] = "stat"
+        self.application = Application(self.configuration)
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        # The items are unknown without the item cache
+        os.remove(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", ".Radicale.cache", "items"))
+        self.application = Application(self.configuration)
+        collection = next(self.application.Collection.discover(
+            "/calendar.ics/"))
+        with collection._acquire_index(storage.UidIndex) as index:
+            assert list(index.unknown) == ["event1.ics"]
+            assert not index.find("event1")
+        assert collection.has_uid("event1")
+        with collection._acquire_index(storage.UidIndex) as index:
+            assert not index.unknown
+            assert index.find("event1") == {"event1.ics"}
+        with collection._acquire_index(storage.TimeRangeIndex) as index:
+            assert not index.unknown
+
+    def test_item_memory_cache(self):
+        """Verify that items are kept in memory and removed on changes."""
+        self.configuration["storage"]["item_cache_validation"] = "stat"
+        self.application = Application(self.configuration)
+        self.application.Collection._item_file_stat_min_age = 0
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        path = "/calendar.ics/event1.ics"
+        status, _, _ = self.request("PUT", path, event)
+        assert status == 201
+        status, _, _ = self.request("GET", path)
+        assert status == 200
+        memory_cache = self.application.Collection._item_memory_cache
+        key = (os.path.join(self.colpath, "collection-root", "calendar.ics"),
+               "event1.ics")
+        assert memory_cache.get(key) is not None
+        status, _, _ = self.request(
+            "MOVE", path, HTTP_DESTINATION="/calendar.ics/event2.ics",
+            HTTP_HOST="")
+        assert status == 201
+        assert memory_cache.get(key) is None
+        status, _, answer = self.request("GET", "/calendar.ics/event2.ics")
+        assert status == 200
+        assert "UID:event1" in answer
+        assert memory_cache.get((key[0], "event2.ics")) is not None
+        status, _, _ = self.request("DELETE", "/calendar.ics/event2.ics")
+        assert status == 200
+        assert memory_cache.get((key[0], "event2.ics")) is None
+
+    def test_report_sync_collection_external_change(self):
+        """Verify that items added outside of Radicale are reported."""
+        calendar_path = "/calendar.ics/"
+        status, _, _ = self.request("MKCALENDAR", calendar_path)
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request(
+            "PUT", posixpath.join(calendar_path, "event1.ics"), event)
+        assert status == 201
+        sync_token, xml = self._report_sync_token(calendar_path)
+        folder = os.path.join(self.colpath, "collection-root", "calendar.ics")
+        assert os.path.isfile(os.path.join(folder, ".Radicale.cache",
+                                           "journal"))
+        with open(os.path.join(folder, "event2.ics"), "w") as f:
+            f.write(get_file_content("event2.ics"))
+        # Force a different modification time of the folder
+        os.utime(folder, ns=(0, 0))
+        new_sync_token, xml = self._report_sync_token(calendar_path,
+                                                      sync_token)
+        assert new_sync_token != sync_token
+        responses = xml.findall("{DAV:}response")
+        assert len(responses) == 1
+        assert responses[0].find("{DAV:}href").text == posixpath.join(
+            calendar_path, "event2.ics")
+        new_sync_token2, xml = self._report_sync_token(calendar_path,
+                                                       new_sync_token)
+        assert new_sync_token2 == new_sync_token
+        assert xml.find("{DAV:}response") is None
+
+    def test_journal_encoding(self):
+        """Verify the encoding of the records of the change journal."""
+        journal = storage.ChangeJournal(os.path.join(self.colpath, "journal"))
+        records = [
+            ("base", "0123456789abcdef0123456789abcdef", 7,
+             {"event1.ics": '"0123456789abcdef0123456789abcdef"',
+              "ëvent2.ics": "W/\"other\""}),
+            ("change", "event1.ics", "", 1500000000),
+            ("change", "ëvent2.ics", '"00000000000000000000000000000000"',
+             1500000001),
+            ("folder", (123, 1500000000123456789)),
+            ("folder", None)]
+        for record in records:
+            data = journal._encode_record(record)
+            assert journal._decode_record(memoryview(data)) == record
+        assert len(journal._encode_record(records[2])) < 40
+
+    def test_item_cache_without_map(self):
+        """Verify that the item cache works without mapping the file (e.g.
+           on Windows)."""
+        cache = storage.ItemCache(os.path.join(self.colpath, "items"))
+        cache.map_file = False
+        entry = ("hash", "event1", '"etag"', "BEGIN:VCALENDAR", "name",
+                 "VEVENT", 0, 1, None)
+        cache.store([("event1.ics", entry), ("event2.ics", entry)])
+        assert isinstance(cache.buffer, bytes)
+        cache.store([("event2.ics", None)])
+        cache.compact(self.application.Collection("")._atomic_write)
+        cache.store([("event3.ics", entry)])
+        assert cache.get("event1.ics") == entry
+        assert cache.get("event2.ics") is None
+        assert cache.get("event3.ics") == entry
+
+    def test_gc(self):
+        """Verify that expired sync tokens and left over temporary files
+           are removed."""
+        self.configuration["storage"]["max_sync_token_age"] = "0"
+        self.application = Application(self.configuration)
+        Collection = self.application.Collection
+        calendar_path = "/calendar.ics/"
+        status, _, _ = self.request("MKCALENDAR", calendar_path)
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request(
+            "PUT", posixpath.join(calendar_path, "event1.ics"), event)
+        assert status == 201
+        sync_token, _ = self._report_sync_token(calendar_path)
+        event = get_file_content("event2.ics")
+        status, _, _ = self.request(
+            "PUT", posixpath.join(calendar_path, "event2.ics"), event)
+        assert status == 201
+        tmp_path = os.path.join(self.colpath, "collection-root",
+                                "calendar.ics", ".Radicale.tmp-test")
+        open(tmp_path, "w").close()
+        os.utime(tmp_path, (0, 0))
+        # Outdated data isn't removed during requests
+        assert self._report_sync_token(calendar_path, sync_token)[0]
+        with Collection.acquire_gc_lock():
+            Collection.gc()
+        assert not os.path.exists(tmp_path)
+        assert self._report_sync_token(calendar_path, sync_token)[0] is None
+
+    def test_gc_without_hook(self):
+        """Verify that the garbage collection doesn't load items or run the
+           hook."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics",
+                                    get_file_content("event1.ics"))
+        assert status == 201
+        # Damage an item without changing the collection folder
+        with open(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", "event1.ics"), "r+") as f:
+            f.write("INVALID")
+        self.configuration["storage"]["hook"] = "exit 1"
+        self.application = Application(self.configuration)
+        Collection = self.application.Collection
+        with Collection.acquire_gc_lock():
+            Collection.gc()
+
+    def test_collection_etag(self):
+        """Verify that the etag of a collection follows its items."""
+        calendar_path = "/calendar.ics/"
+        status, _, _ = self.request("MKCALENDAR", calendar_path)
+        assert status == 201
+        status, headers, _ = self.request("GET", calendar_path)
+        assert status == 200
+        etag = headers["ETag"]
+        event_path = posixpath.join(calendar_path, "event1.ics")
+        status, _, _ = self.request("PUT", event_path,
+                                    get_file_content("event1.ics"))
+        assert status == 201
+        status, headers, _ = self.request("GET", calendar_path)
+        assert headers["ETag"] != etag
+        status, _, _ = self.request("DELETE", event_path)
+        assert status == 200
+        status, headers, _ = self.request("GET", calendar_path)
+        assert headers["ETag"] == etag
+        folder = os.path.join(self.colpath, "collection-root", "calendar.ics")
+        with open(os.path.join(folder, "event2.ics"), "w") as f:
+            f.write(get_file_content("event2.ics"))
+        os.utime(folder, ns=(0, 0))
+        status, headers, _ = self.request("GET", calendar_path)
+        assert headers["ETag"] != etag
+
+    def test_collection_etag_item_edited_in_place(self):
+        """Verify that items edited in place outside of Radicale change the
+           etag and the sync token of the collection."""
+        calendar_path = "/calendar.ics/"
+        status, _, _ = self.request("MKCALENDAR", calendar_path)
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request(
+            "PUT", posixpath.join(calendar_path, "event1.ics"), event)
+        assert status == 201
+        status, headers, _ = self.request("GET", calendar_path)
+        assert status == 200
+        etag = headers["ETag"]
+        sync_token, _ = self._report_sync_token(calendar_path)
+        folder = os.path.join(self.colpath, "collection-root", "calendar.ics")
+        folder_mtime = os.stat(folder).st_mtime_ns
+        with open(os.path.join(folder, "event1.ics"), "r+") as f:
+            f.write(event.replace("Event", "Modified event"))
+            f.truncate()
+        assert os.stat(folder).st_mtime_ns == folder_mtime
+        status, headers, _ = self.request("GET", calendar_path)
+        assert status == 200
+        assert headers["ETag"] != etag
+        new_sync_token, xml = self._report_sync_token(calendar_path,
+                                                      sync_token)
+        assert new_sync_token != sync_token
+        assert len(xml.findall("{DAV:}response")) == 1
+
+    def test_export_item_edited_in_place(self):
+        """Verify that the cached export of a collection isn't used after an
+           item was edited in place outside of Radicale."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        status, _, answer = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert "Modified event" not in answer
+        with open(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", "event1.ics"), "r+") as f:
+            f.write(event.replace("Event", "Modified event"))
+            f.truncate()
+        status, _, answer = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert "Modified event" in answer
+
+    def test_collection_summary(self):
+        """Verify that the summary answers PROPFIND without the journal."""
+        self.configuration["storage"]["item_cache_validation"] = "stat"
+        self.application = Application(self.configuration)
+        calendar_path = "/calendar.ics/"
+        status, _, _ = self.request("MKCALENDAR", calendar_path)
+        assert status == 201
+        status, _, _ = self.request(
+            "PUT", posixpath.join(calendar_path, "event1.ics"),
+            get_file_content("event1.ics"))
+        assert status == 201
+        propfind = get_file_content("allprop.xml")
+        status, _, answer = self.request("PROPFIND", "/", propfind,
+                                         HTTP_DEPTH="1")
+        assert status == 207
+        sync_token = ET.fromstring(answer).find(
+            ".//{DAV:}sync-token").text.strip()
+        assert sync_token
+        # The journal is recreated with a new identifier, if it's loaded
+        os.remove(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", ".Radicale.cache", "journal"))
+        self.application = Application(self.configuration)
+        status, _, answer = self.request("PROPFIND", "/", propfind,
+                                         HTTP_DEPTH="1")
+        assert status == 207
+        assert ET.fromstring(answer).find(
+            ".//{DAV:}sync-token").text.strip() == sync_token
+        assert "<getlastmodified>" in answer
+
+    def test_collection_summary_proppatch(self):
+        """Verify that the journal and the summary are updated by
+        PROPPATCH."""
+        self.configuration["storage"]["item_cache_validation"] = "stat"
+        self.application = Application(self.configuration)
+        calendar_path = "/calendar.ics/"
+        status, _, _ = self.request("MKCALENDAR", calendar_path)
+        assert status == 201
+        status, _, _ = self.request(
+            "PUT", posixpath.join(calendar_path, "event1.ics"),
+            get_file_content("event1.ics"))
+        assert status == 201
+        status, headers, _ = self.request("GET", calendar_path)
+        assert status == 200
+        etag = headers["ETag"]
+        status, _, _ = self.request("PROPPATCH", calendar_path,
+                                    get_file_content("proppatch1.xml"))
+        assert status == 207
+        # Damage an item without changing the collection folder, it's only
+        # loaded when the collection is scanned
+        with open(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", "event1.ics"), "r+") as f:
+            f.write("INVALID")
+        propfind = """<?xml version="1.0" encoding="utf-8" ?>
+            <D:propfind xmlns:D="DAV:">
+              <D:prop>
+                <D:getetag/>
+              </D:prop>
+            </D:propfind>"""
+        status, _, answer = self.request("PROPFIND", calendar_path, propfind)
+        assert status == 207
+        new_etag = ET.fromstring(answer).find(".//{DAV:}getetag").text
+        assert new_etag and new_etag != etag
+
+    def test_put_whole_calendar_folder_stat_unchanged(self):
+        """Verify that the items of an uploaded calendar are found, if the
+           status of the collection folder doesn't change (e.g. on file
+           systems with coarse timestamps)."""
+        self.application.Collection._folder_stat = (
+            lambda self, check_age=False: (
+                os.stat(self._filesystem_path).st_ino, 0))
+        status, _, _ = self.request(
+            "PUT", "/empty.ics/", "BEGIN:VCALENDAR\r\nEND:VCALENDAR")
+        assert status == 201
+        status, _, _ = self.request(
+            "PUT", "/calendar.ics/", get_file_content("event_multiple.ics"))
+        assert status == 201
+        status, headers, _ = self.request("GET", "/empty.ics/")
+        assert status == 200
+        empty_etag = headers["ETag"]
+        status, headers, _ = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert headers["ETag"] != empty_etag
+        status, _, answer = self.request(
+            "REPORT", "/calendar.ics/",
+            """<?xml version="1.0" encoding="utf-8" ?>
+               <C:calendar-query xmlns:C="urn:ietf:params:xml:ns:caldav">
+                 <D:prop xmlns:D="DAV:">
+                   <D:getetag/>
+                 </D:prop>
+                 <C:filter>
+                   <C:comp-filter name="VCALENDAR">
+                     <C:comp-filter name="VEVENT"/>
+                   </C:comp-filter>
+                 </C:filter>
+               </C:calendar-query>""")
+        assert status == 207
+        assert len(ET.fromstring(answer).findall("{DAV:}response")) == 1
+        _, xml = self._report_sync_token("/calendar.ics/")
+        assert len(xml.findall("{DAV:}response")) == 2
+
+    def test_time_range_index(self):
+        """Verify that items outside of the time range are not loaded."""
+        self.configuration["storage"]["item_cache_validation"] = "stat"
+        self.application = Application(self.configuration)
+        self._test_filter([""], "event", items=range(1, 4))
+        # Damage an item without changing the collection folder
+        with open(os.path.join(self.colpath, "collection-root",
+                               "calendar.ics", "event3.ics"), "r+") as f:
+            f.write("INVALID")
+        report = """<?xml version="1.0" encoding="utf-8" ?>
+            <C:calendar-query xmlns:C="urn:ietf:params:xml:ns:caldav">
+              <D:prop xmlns:D="DAV:">
+                <D:getetag/>
+              </D:prop>
+              <C:filter>
+                <C:comp-filter name="VCALENDAR">
+                  <C:comp-filter name="VEVENT">
+                    <C:time-range start="%s" end="%s"/>
+                  </C:comp-filter>
+                </C:comp-filter>
+              </C:filter>
+            </C:calendar-query>"""
+        status, _, answer = self.request("REPORT", "/calendar.ics/", report % (
+            "20130901T000000Z", "20130902T000000Z"))
+        assert status == 207
+        assert "href>/calendar.ics/event1.ics</" in answer
+        assert "href>/calendar.ics/event2.ics</" not in answer
+        assert "href>/calendar.ics/event3.ics</" not in answer
+        status, _, answer = self.request("REPORT", "/calendar.ics/", report % (
+            "20130910T000000Z", "20130911T000000Z"))
+        assert status == 207
+        assert "href>/calendar.ics/event1.ics</" not in answer
+        assert "href>/calendar.ics/event2.ics</" in answer
+
+    def test_uid_index(self):
+        """Verify that UID conflicts are detected with the UID index."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request("PUT", "/calendar.ics/event1.ics", event)
+        assert status == 201
+        status, _, answer = self.request(
+            "PUT", "/calendar.ics/event1-copy.ics", event)
+        assert status == 409
+        assert "no-uid-conflict" in answer
+        status, _, _ = self.request("DELETE", "/calendar.ics/event1.ics")
+        assert status == 200
+        status, _, _ = self.request(
+            "PUT", "/calendar.ics/event1-copy.ics", event)
+        assert status == 201
+        assert self.application.Collection.verify()
+        # Add a conflicting item outside of Radicale
+        folder = os.path.join(self.colpath, "collection-root", "calendar.ics")
+        shutil.copy(os.path.join(folder, "event1-copy.ics"),
+                    os.path.join(folder, "event1.ics"))
+        os.utime(folder, ns=(0, 0))
+        status, _, _ = self.request(
+            "PUT", "/calendar.ics/event1-other.ics", event)
+        assert status == 409
+        assert not self.application.Collection.verify()
+
+    def test_verify_child_collections(self, caplog):
+        """Verify rejects child collections of calendars."""
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        assert self.application.Collection.verify()
+        # Create a child collection outside of Radicale
+        os.makedirs(os.path.join(self.colpath, "collection-root",
+                                 "calendar.ics", "child"))
+        assert not self.application.Collection.verify()
+        assert any("must not have child collections" in r.getMessage()
+                   for r in caplog.records)
 
     @pytest.mark.skipif(os.name not in ("nt", "posix"),
                         reason="Only supported on 'nt' and 'posix'")
@@ -1580,3 +2408,12 @@ class TestCustomStorageSystem(BaseFileSystemTest):
     def test_root(self):
         """A simple test to verify that the custom backend works."""
         BaseRequestsMixIn.test_root(self)
+
+
+class TestCustomStorageSystemSimpleLock(BaseFileSystemTest):
+    """Test custom backend with the older signature of acquire_lock."""
+    storage_type = "tests.custom.storage_simple_lock"
+
+    def test_add_event(self):
+        """Verify that requests work with the older signature."""
+        BaseRequestsMixIn.test_add_event(self)
@@ -25,6 +25,7 @@ import tempfile
 
 from radicale import Application, config
 
+from .helpers import get_file_content
 from .test_base import BaseTest
 
 
@@ -119,6 +120,73 @@ permissions: Rr""")
         self._test_rights("from_file", "", "/custom/sub", "w", 401)
         self._test_rights("from_file", "tmp", "/custom/sub", "w", 403)
 
+    def test_from_file_groups(self):
+        rights_file_path = os.path.join(self.colpath, "rights")
+        with open(rights_file_path, "w") as f:
+            f.write("""\
+[owner]
+user: (.+)
+collection: {0}(/.*)?
+permissions: RrWw""")
+        self.configuration["rights"]["file"] = rights_file_path
+        self._test_rights("from_file", "tmp", "/tmp", "w", 207)
+        self._test_rights("from_file", "tmp", "/other", "w", 403)
+        self._test_rights("from_file", "", "/other", "r", 401)
+
+    def test_from_file_reload(self):
+        rights_file_path = os.path.join(self.colpath, "rights")
+        with open(rights_file_path, "w") as f:
+            f.write("""\
+[owner]
+user: .+
+collection: %(login)s(/.*)?
+permissions: RrWw
+[custom]
+user: .*
+collection: custom(/.*)?
+permissions: Rr""")
+        self.configuration["rights"]["file"] = rights_file_path
+        self._test_rights("from_file", "tmp", "/custom/sub", "w", 403)
+        with open(rights_file_path, "w") as f:
+            f.write("""\
+[owner]
+user: .+
+collection: %(login)s(/.*)?
+permissions: RrWw
+[custom]
+user: .*
+collection: custom(/.*)?
+permissions: RrWw""")
+        status, _, _ = self.request(
+            "PROPPATCH", "/custom/sub", HTTP_AUTHORIZATION="Basic %s" %
+            base64.b64encode(b"tmp:bepo").decode())
+        assert status == 404
+
+    def test_decisions_cached(self):
+        """Rights are checked once per collection during a listing."""
+        self.application = Application(self.configuration)
+        status, _, _ = self.request("MKCOL", "/tmp/")
+        assert status == 201
+        status, _, _ = self.request("MKCALENDAR", "/tmp/calendar.ics/")
+        assert status == 201
+        for i in range(1, 4):
+            status, _, _ = self.request(
+                "PUT", "/tmp/calendar.ics/event%d.ics" % i,
+                get_file_content("event%d.ics" % i))
+            assert status == 201
+        authorized = self.application.Rights.authorized
+        calls = []
+
+        def counting_authorized(*args):
+            calls.append(args)
+            return authorized(*args)
+        self.application.Rights.authorized = counting_authorized
+        status, _, answer = self.request(
+            "PROPFIND", "/tmp/calendar.ics/", HTTP_DEPTH="1")
+        assert status == 207
+        assert answer.count("<response>") == 4
+        assert len(calls) == len(set(calls)) <= 3
+
     def test_custom(self):
         """Custom rights management."""
         self._test_rights("tests.custom.rights", "", "/", "r", 401)
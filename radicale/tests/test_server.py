@@ -0,0 +1,394 @@
+# This file is part of Radicale Server - Calendar Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Radicale.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the internal servers of Radicale.
+
+"""
+
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from http import client
+
+import pytest
+
+from radicale import Application, config, server
+
+from .helpers import get_file_content
+
+SERVER_TYPES = ("threaded", "asyncio")
+
+
+class ServerTestApplication(Application):
+    """Application with additional paths for testing the servers.
+
+    The process ID of the worker is added to every response.
+
+    """
+
+    # Number of requests that are currently handled by this process
+    active = 0
+    active_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ["PATH_INFO"]
+
+        def start_response_pid(status, headers, exc_info=None):
+            return start_response(
+                status, list(headers) + [("X-Pid", str(os.getpid()))],
+                exc_info)
+        if path == "/raise":
+            raise RuntimeError("test exception")
+        if path.startswith("/echo/"):
+            answer = path.encode("ascii")
+            start_response_pid("200 OK", [
+                ("Content-Length", str(len(answer)))])
+            return [answer]
+        if path == "/body":
+            answer = environ["wsgi.input"].read()
+            start_response_pid("200 OK", [
+                ("Content-Length", str(len(answer)))])
+            return [answer]
+        if path == "/chunked":
+            start_response_pid("200 OK", [("Content-Type", "text/plain")])
+            return [b"a" * 10, b"", b"b" * 10]
+        if path == "/sleep":
+            with self.active_lock:
+                ServerTestApplication.active += 1
+                active = self.active
+            try:
+                time.sleep(0.5)
+            finally:
+                with self.active_lock:
+                    ServerTestApplication.active -= 1
+            start_response_pid("200 OK", [
+                ("Content-Length", "0"), ("X-Active", str(active))])
+            return []
+        return super().__call__(environ, start_response_pid)
+
+
+def _serve(configuration):
+    """Target of the server process."""
+    server.Application = ServerTestApplication
+    server.serve(configuration)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"),
+                    reason="Only supported on systems with 'fork'")
+class TestServer:
+    """Tests with the internal servers."""
+
+    def setup(self):
+        self.configuration = config.load()
+        self.colpath = tempfile.mkdtemp()
+        self.configuration["storage"]["filesystem_folder"] = self.colpath
+        # Disable syncing to disk for better performance
+        self.configuration["internal"]["filesystem_fsync"] = "False"
+        # Allow access to anything for tests
+        rights_file_path = os.path.join(self.colpath, "rights")
+        with open(rights_file_path, "w") as f:
+            f.write("""\
+[allow all]
+user: .*
+collection: .*
+permissions: RrWw""")
+        self.configuration["rights"]["file"] = rights_file_path
+        self.configuration["rights"]["type"] = "from_file"
+        self.configuration["server"]["dns_lookup"] = "False"
+        self.configuration["server"]["workers"] = "1"
+        self.configuration["server"]["timeout"] = "10"
+        self.process = None
+
+    def teardown(self):
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        shutil.rmtree(self.colpath)
+
+    def start(self, server_type, **options):
+        """Start the server in a new process."""
+        self.configuration["server"]["type"] = server_type
+        for key, value in options.items():
+            self.configuration["server"][key] = str(value)
+        # Find an unused port
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.configuration["server"]["hosts"] = "127.0.0.1:%d" % self.port
+        self.process = multiprocessing.get_context("fork").Process(
+            target=_serve, args=(self.configuration,))
+        self.process.start()
+
+    def stop(self):
+        """Stop the server and check that it terminates cleanly."""
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.process.join(10)
+        assert self.process.exitcode == 0
+
+    def connect(self):
+        """Connect to the server, waiting until it is started."""
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                return socket.create_connection(("127.0.0.1", self.port), 10)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def connection(self):
+        """Create a ``HTTPConnection`` to the server."""
+        connection = client.HTTPConnection("127.0.0.1", self.port, 10)
+        connection.sock = self.connect()
+        return connection
+
+    def request(self, method, path, data=None, **headers):
+        """Send a request on a new connection."""
+        connection = self.connection()
+        try:
+            connection.request(method, path, data, headers)
+            response = connection.getresponse()
+            return response.status, response, response.read()
+        finally:
+            connection.close()
+
+    def raw_request(self, data):
+        """Send ``data`` and receive until the server closes the
+        connection."""
+        with self.connect() as sock:
+            sock.sendall(data)
+            answer = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return answer
+                answer += chunk
+
+    @pytest.mark.parametrize("server_type", SERVER_TYPES)
+    def test_collection(self, server_type):
+        """Upload and download an event through the server."""
+        self.start(server_type)
+        status, _, _ = self.request("MKCALENDAR", "/calendar.ics/")
+        assert status == 201
+        event = get_file_content("event1.ics")
+        status, _, _ = self.request(
+            "PUT", "/calendar.ics/event1.ics", event.encode("utf-8"),
+            **{"Content-Type": "text/calendar"})
+        assert status == 201
+        status, response, answer = self.request(
+            "GET", "/calendar.ics/event1.ics")
+        assert status == 200
+        assert "Event" in answer.decode("utf-8")
+        status, _, answer = self.request("GET", "/calendar.ics/")
+        assert status == 200
+        assert "BEGIN:VCALENDAR" in answer.decode("utf-8")
+        self.stop()
+
+    @pytest.mark.parametrize("server_type", SERVER_TYPES)
+    def test_prefork(self, server_type):
+        """Requests are handled by worker processes of the supervisor."""
+        self.start(server_type, workers=2)
+        pids = set()
+        for _ in range(4):
+            status, response, _ = self.request("GET", "/echo/")
+            assert status == 200
+            pids.add(int(response.getheader("X-Pid")))
+        assert self.process.pid not in pids
+        self.stop()
+        for pid in pids:
+            with pytest.raises(ProcessLookupError):
+                os.kill(pid, 0)
+
+    @pytest.mark.parametrize("server_type", SERVER_TYPES)
+    def test_worker_recycling(self, server_type):
+        """Workers are replaced after ``max_worker_requests``."""
+        self.start(server_type, max_worker_requests=2)
+        pids = []
+        for _ in range(2):
+            status, response, _ = self.request("GET", "/echo/")
+            assert status == 200
+            pids.append(int(response.getheader("X-Pid")))
+        assert pids[0] == pids[1]
+        # The asyncio server checks the limit periodically
+        deadline = time.monotonic() + 10
+        while pids[-1] == pids[0] and time.monotonic() < deadline:
+            status, response, _ = self.request("GET", "/echo/")
+            assert status == 200
+            pids.append(int(response.getheader("X-Pid")))
+            time.sleep(0.1)
+        assert pids[-1] != pids[0]
+        if server_type == "threaded":
+            assert len(pids) == 3
+        self.stop()
+
+    @pytest.mark.parametrize("server_type", SERVER_TYPES)
+    @pytest.mark.parametrize("max_connections", (1, 2))
+    def test_max_connections(self, server_type, max_connections):
+        """The number of parallel requests is limited."""
+        self.start(server_type, max_connections=max_connections)
+        # Wait for the server
+        status, _, _ = self.request("GET", "/echo/")
+        assert status == 200
+        results = []
+
+        def request():
+            status, response, _ = self.request("GET", "/sleep")
+            results.append((status, int(response.getheader("X-Active"))))
+        threads = [threading.Thread(target=request) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [status for status, _ in results] == [200, 200]
+        assert max(active for _, active in results) == max_connections
+        self.stop()
+
+    def test_keep_alive(self):
+        """Connections of the asyncio server are persistent."""
+        self.start("asyncio")
+        connection = self.connection()
+        sock = connection.sock
+        for i in range(3):
+            connection.request("GET", "/echo/%d" % i)
+            response = connection.getresponse()
+            assert response.status == 200
+            assert response.read() == b"/echo/%d" % i
+            assert connection.sock is sock
+        connection.close()
+        self.stop()
+
+    def test_keep_alive_http10(self):
+        """HTTP/1.0 connections are closed unless requested otherwise."""
+        self.start("asyncio")
+        answer = self.raw_request(
+            b"GET /echo/1 HTTP/1.0\r\nConnection: keep-alive\r\n\r\n"
+            b"GET /echo/2 HTTP/1.0\r\n\r\n"
+            b"GET /echo/3 HTTP/1.0\r\n\r\n")
+        assert answer.count(b"HTTP/1.1 200 OK") == 2
+        assert b"Connection: keep-alive" in answer
+        assert b"/echo/2" in answer
+        assert b"/echo/3" not in answer
+        self.stop()
+
+    def test_pipelining(self):
+        """Pipelined requests are answered in order."""
+        self.start("asyncio")
+        answer = self.raw_request(
+            b"GET /echo/1 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"PUT /body HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Length: 5\r\n\r\nhello"
+            b"GET /echo/3 HTTP/1.1\r\nHost: localhost\r\n"
+            b"Connection: close\r\n\r\n")
+        assert answer.count(b"HTTP/1.1 200 OK") == 3
+        assert (0 < answer.index(b"/echo/1") < answer.index(b"hello") <
+                answer.index(b"/echo/3"))
+        self.stop()
+
+    def test_discard_body(self):
+        """Unread request bodies are skipped before the next request."""
+        self.start("asyncio")
+        answer = self.raw_request(
+            b"PUT /echo/1 HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Length: 5\r\n\r\nhello"
+            b"GET /echo/2 HTTP/1.1\r\nHost: localhost\r\n"
+            b"Connection: close\r\n\r\n")
+        assert answer.count(b"HTTP/1.1 200 OK") == 2
+        assert b"hello" not in answer
+        self.stop()
+
+    def test_continue(self):
+        """``Expect: 100-continue`` is answered when the body is read."""
+        self.start("asyncio")
+        with self.connect() as sock:
+            sock.sendall(b"PUT /body HTTP/1.1\r\nHost: localhost\r\n"
+                         b"Content-Length: 5\r\nExpect: 100-continue\r\n"
+                         b"Connection: close\r\n\r\n")
+            expected = b"HTTP/1.1 100 Continue\r\n\r\n"
+            answer = b""
+            while len(answer) < len(expected):
+                chunk = sock.recv(len(expected) - len(answer))
+                assert chunk
+                answer += chunk
+            assert answer == expected
+            sock.sendall(b"hello")
+            answer = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                answer += chunk
+        assert answer.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert answer.endswith(b"\r\n\r\nhello")
+        self.stop()
+
+    def test_continue_unread(self):
+        """The connection is closed when the body is never requested."""
+        self.start("asyncio")
+        answer = self.raw_request(
+            b"PUT /echo/1 HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Length: 5\r\nExpect: 100-continue\r\n\r\n")
+        assert b"100 Continue" not in answer
+        assert answer.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"Connection: close\r\n" in answer
+        self.stop()
+
+    @pytest.mark.parametrize("server_type", SERVER_TYPES)
+    def test_chunked(self, server_type):
+        """Answers without ``Content-Length`` are sent chunked."""
+        self.start(server_type)
+        status, response, answer = self.request("GET", "/chunked")
+        assert status == 200
+        assert answer == b"a" * 10 + b"b" * 10
+        if server_type == "asyncio":
+            assert response.getheader("Transfer-Encoding") == "chunked"
+            answer = self.raw_request(b"GET /chunked HTTP/1.1\r\n"
+                                      b"Connection: close\r\n\r\n")
+            assert answer.endswith(b"\r\n\r\na\r\n%s\r\na\r\n%s\r\n0\r\n\r\n"
+                                   % (b"a" * 10, b"b" * 10))
+            # HTTP/1.0 doesn't support chunked transfer encoding
+            answer = self.raw_request(b"GET /chunked HTTP/1.0\r\n\r\n")
+            assert b"Transfer-Encoding" not in answer
+            assert b"Connection: close\r\n" in answer
+            assert answer.endswith(b"\r\n\r\n%s%s" % (b"a" * 10, b"b" * 10))
+        self.stop()
+
+    @pytest.mark.parametrize("server_type", SERVER_TYPES)
+    def test_internal_server_error(self, server_type):
+        """Exceptions of the application are answered with status 500."""
+        self.start(server_type)
+        status, _, _ = self.request("GET", "/raise")
+        assert status == 500
+        # The server continues to work
+        status, _, _ = self.request("GET", "/echo/")
+        assert status == 200
+        self.stop()
+
+    def test_bad_request(self):
+        """Malformed requests are rejected by the asyncio server."""
+        self.start("asyncio")
+        answer = self.raw_request(b"GET /echo/\r\n\r\n")
+        assert answer.startswith(b"HTTP/1.1 400 ")
+        answer = self.raw_request(b"GET /echo/ HTTP/2.0\r\n\r\n")
+        assert answer.startswith(b"HTTP/1.1 505 ")
+        answer = self.raw_request(b"GET /echo/ HTTP/1.1\r\n"
+                                  b"Transfer-Encoding: chunked\r\n\r\n")
+        assert answer.startswith(b"HTTP/1.1 501 ")
+        self.stop()
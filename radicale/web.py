@@ -22,7 +22,7 @@ from importlib import import_module
 
 import pkg_resources
 
-from radicale import storage
+from radicale import httputils, storage
 from radicale.log import logger
 
 NOT_FOUND = (
@@ -113,11 +113,14 @@ class Web(BaseWeb):
             return NOT_FOUND
         content_type = MIMETYPES.get(
             os.path.splitext(filesystem_path)[1].lower(), FALLBACK_MIMETYPE)
+        last_modified = time.strftime(
+            "%a, %d %b %Y %H:%M:%S GMT",
+            time.gmtime(os.stat(filesystem_path).st_mtime))
+        # Check the condition before the file is read
+        if httputils.not_modified(environ, last_modified=last_modified):
+            return client.NOT_MODIFIED, {"Last-Modified": last_modified}, None
         with open(filesystem_path, "rb") as f:
             answer = f.read()
-            last_modified = time.strftime(
-                "%a, %d %b %Y %H:%M:%S GMT",
-                time.gmtime(os.fstat(f.fileno()).st_mtime))
         headers = {
             "Content-Type": content_type,
             "Last-Modified": last_modified}